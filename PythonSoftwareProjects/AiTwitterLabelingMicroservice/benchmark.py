@@ -0,0 +1,544 @@
+"""
+End-to-end benchmark of the tagger.
+
+Starts a stub of the OpenAI chat-completions endpoint with configurable
+latency, jitter and error rate, a throwaway Postgres (initdb/pg_ctl from PATH,
+or --dsn for an existing one) and a throwaway Redis (redis-server from PATH, or
+--redis-host), loads a synthetic table_9/table_8, then drives
+post_labeling_program, the trend queries and the writers of tagger.py.
+
+Results are written as JSON so runs can be compared between commits:
+
+    python benchmark.py run --tweets 5000 --llm-latency 0.2 --output before.json
+    python benchmark.py run --tweets 5000 --llm-latency 0.2 --output after.json
+    python benchmark.py compare before.json after.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import logging
+import argparse
+import resource
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('benchmark')
+logging.basicConfig(level=logging.INFO)
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#-------------------------- SYNTHETIC DATA ----------------------------
+WORDS = [
+    'market', 'pump', 'launch', 'chart', 'holders', 'volume', 'breakout', 'airdrop', 'listing', 'community',
+    'bullish', 'dip', 'moon', 'whales', 'liquidity', 'roadmap', 'partnership', 'staking', 'bridge', 'wallet',
+]
+
+TABLE_9_DDL = """
+    CREATE TABLE table_9 (
+        id bigint PRIMARY KEY,
+        column_19_id text,
+        content text,
+        column_40 text,
+        column_41 text,
+        column_42 text,
+        name text,
+        column_43 text,
+        column_44 timestamp,
+        column_45 text,
+        column_46 text,
+        column_47 text,
+        column_48 text,
+        column_49 text,
+        tags text[],
+        column_50 text
+    );
+    CREATE INDEX table_9_column_44_idx ON table_9 (column_44);
+    """
+
+TABLE_8_DDL = """
+    CREATE TABLE table_8 (
+        id bigint PRIMARY KEY,
+        content text,
+        datetime timestamp,
+        column_33 text,
+        tags text[]
+    );
+    CREATE INDEX table_8_datetime_idx ON table_8 (datetime);
+    """
+
+# Stand-in for the upsert tables of TABLE_CONFLICT_CONFIG, used to time the insert paths
+TABLE_1_DDL = """
+    CREATE TABLE table_1 (
+        column_1 text PRIMARY KEY,
+        column_2 text,
+        column_3 text,
+        column_4 text
+    );
+    """
+
+def synthetic_post(rng, vocabulary, handles):
+    """
+    Returns (content, tags) for one synthetic tweet: a few words, hashtags,
+    cashtags and handles, sometimes a retweet.
+    """
+    tags = rng.sample(vocabulary, rng.randint(1, 3))
+    words = rng.sample(WORDS, rng.randint(4, 12))
+    content = ' '.join(words[:3] + tags + words[3:])
+    if rng.random() < 0.2:
+        content = f"RT @{rng.choice(handles)}: {content}"
+    return content, tags
+
+def load_synthetic_data(tagger, tweets, posts, seed):
+    """
+    Creates table_9 with tweets untagged rows and table_8 with posts tagged
+    rows spread over the last 10 days. About 10% of the tweets are exact
+    duplicates, like copy-pasted posts and retweets are in production.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"#topic{i}" for i in range(300)] + [f"$coin{i}" for i in range(200)] + [f"@user{i}" for i in range(200)]
+    handles = [f"user{i}" for i in range(500)]
+    users = [f"user{i}" for i in range(2000)]
+    now = datetime.now().replace(microsecond=0)
+
+    table_9_rows = []
+    for i in range(tweets):
+        if table_9_rows and rng.random() < 0.1:
+            content = rng.choice(table_9_rows)[2]
+        else:
+            content, _ = synthetic_post(rng, vocabulary, handles)
+        created = now - timedelta(seconds=rng.randint(0, 240 * 3600))
+        table_9_rows.append((i + 1, str(i + 1), content, None, None, None, rng.choice(users), None, created, None, None, None, None, None, None, rng.choice(users)))
+
+    table_8_rows = []
+    for i in range(posts):
+        content, tags = synthetic_post(rng, vocabulary, handles)
+        created = now - timedelta(seconds=rng.randint(0, 240 * 3600))
+        table_8_rows.append((i + 1, content, created, rng.choice(users), tags))
+
+    with tagger.get_connection() as connection:
+        for table in ('table_9', 'table_8', 'table_1'):
+            connection.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        connection.execute(TABLE_9_DDL)
+        connection.execute(TABLE_8_DDL)
+        connection.execute(TABLE_1_DDL)
+        with connection.cursor() as cursor:
+            with cursor.copy("COPY table_9 FROM STDIN") as copy:
+                for row in table_9_rows:
+                    copy.write_row(row)
+            with cursor.copy("COPY table_8 FROM STDIN") as copy:
+                for row in table_8_rows:
+                    copy.write_row(row)
+        connection.execute("ANALYZE table_9")
+        connection.execute("ANALYZE table_8")
+    tagger.invalidate_table_writers()
+    logger.info(f"Loaded {tweets} tweets into table_9 and {posts} posts into table_8")
+
+#-------------------------- FAKE LLM SERVER ----------------------------
+FAKE_TAG_PATTERN = re.compile(r'[#@$][A-Za-z0-9_]+')
+
+def fake_tags(text):
+    return sorted({tag.lower() for tag in FAKE_TAG_PATTERN.findall(text)}) or ['benchmark']
+
+def fake_completion(request):
+    """
+    Content of a plausible reply to a tagger request: {"tags": [...]} for a
+    single tweet, {"results": [...]} for a batch, plain text for a summary.
+    """
+    messages = request.get('messages') or [{}]
+    user_prompt = messages[-1].get('content') or ''
+    batch = re.search(r'Tweets: (\[.*\])', user_prompt, re.S)
+    if batch:
+        try:
+            items = json.loads(batch.group(1))
+            return json.dumps({"results": [{"id": item["id"], "tags": fake_tags(item["tweet"])} for item in items]})
+        except (ValueError, KeyError, TypeError):
+            return json.dumps({"results": []})
+    if request.get('response_format'):
+        return json.dumps({"tags": fake_tags(user_prompt)})
+    return f"Summary of {len(user_prompt)} characters of posts."
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            request = {}
+        settings = self.server.settings
+        time.sleep(max(0.0, settings['rng'].gauss(settings['latency'], settings['jitter'])))
+        with settings['lock']:
+            settings['requests'] += 1
+            failed = settings['rng'].random() < settings['error_rate']
+            settings['errors'] += failed
+        if failed:
+            self._reply(500, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+
+        content = fake_completion(request)
+        prompt_tokens = sum(len(message.get('content') or '') for message in request.get('messages', [])) // 4
+        completion_tokens = len(content) // 4
+        self._reply(200, {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'benchmark'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_llm(latency, jitter, error_rate, seed):
+    """
+    Serves the fake chat-completions endpoint on a free local port from a daemon thread.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLLMHandler)
+    server.daemon_threads = True
+    server.settings = {
+        'latency': latency, 'jitter': jitter, 'error_rate': error_rate,
+        'rng': random.Random(seed), 'lock': threading.Lock(), 'requests': 0, 'errors': 0,
+    }
+    threading.Thread(target=server.serve_forever, name='fake-llm', daemon=True).start()
+    logger.info(f"Fake LLM listening on 127.0.0.1:{server.server_address[1]} (latency {latency}s, jitter {jitter}s, error rate {error_rate})")
+    return server
+
+#-------------------------- THROWAWAY SERVICES ----------------------------
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def find_binary(name, directory=None):
+    path = os.path.join(directory, name) if directory else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise SystemExit(f"{name} not found{' in ' + directory if directory else ' on PATH'}; pass --dsn / --redis-host to use running services")
+    return path
+
+def start_postgres(workdir, pg_bin=None):
+    """
+    Initializes and starts a Postgres cluster in workdir, listening on a Unix
+    socket there. Returns (connection settings, stop function).
+    """
+    data_dir = os.path.join(workdir, 'pgdata')
+    port = free_port()
+    initdb = subprocess.run([find_binary('initdb', pg_bin), '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if initdb.returncode != 0:
+        # initdb refuses to run as root, for example
+        raise SystemExit(f"initdb failed: {initdb.stderr.strip()}\nPass --dsn to use a running Postgres instead")
+    options = f"-c listen_addresses='' -c unix_socket_directories='{workdir}' -p {port} -c fsync=off"
+    subprocess.run([find_binary('pg_ctl', pg_bin), '-D', data_dir, '-o', options, '-l', os.path.join(workdir, 'postgres.log'), '-w', 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    def stop():
+        subprocess.run([find_binary('pg_ctl', pg_bin), '-D', data_dir, '-m', 'immediate', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    settings = {'POSTGRESQL_HOST': workdir, 'POSTGRESQL_PORT': str(port), 'POSTGRESQL_DB_NAME': 'postgres',
+                'POSTGRESQL_USER': 'postgres', 'POSTGRESQL_PASSWORD': ''}
+    logger.info(f"Started a throwaway Postgres in {data_dir}")
+    return settings, stop
+
+def dsn_settings(dsn):
+    from psycopg.conninfo import conninfo_to_dict
+    params = conninfo_to_dict(dsn)
+    return {'POSTGRESQL_HOST': params.get('host', 'localhost'), 'POSTGRESQL_PORT': str(params.get('port', 5432)),
+            'POSTGRESQL_DB_NAME': params.get('dbname', 'postgres'), 'POSTGRESQL_USER': params.get('user', 'postgres'),
+            'POSTGRESQL_PASSWORD': params.get('password', '')}
+
+def start_redis(workdir):
+    """
+    Starts a redis-server without persistence on a free port. Returns (settings, stop function).
+    """
+    port = free_port()
+    process = subprocess.Popen([find_binary('redis-server'), '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no', '--dir', workdir],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    def stop():
+        process.terminate()
+        process.wait(timeout=10)
+
+    logger.info(f"Started a throwaway Redis on port {port}")
+    return {'REDIS_HOST': '127.0.0.1', 'REDIS_PORT': str(port), 'REDIS_DB': '0'}, stop
+
+#-------------------------- MEASUREMENT ----------------------------
+def percentile(samples, q):
+    """
+    Linear-interpolated percentile of samples, q in [0, 100].
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize_samples(samples):
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) if samples else None,
+        'p50': percentile(samples, 50),
+        'p99': percentile(samples, 99),
+        'max': max(samples) if samples else None,
+    }
+
+def time_calls(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_revision():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARK_DIR, capture_output=True, text=True).stdout.strip()
+        return sha + ('-dirty' if dirty else '')
+    except Exception:
+        return None
+
+#-------------------------- SCENARIOS ----------------------------
+def run_tagging(tagger, tweets):
+    """
+    Runs post_labeling_program until table_9 has no untagged tweet left.
+    """
+    started = time.perf_counter()
+    runs = 0
+    backlog = tweets
+    while True:
+        tagger.post_labeling_program()
+        runs += 1
+        previous, backlog = backlog, tagger.count_unlabeled_tweets()
+        if not backlog or backlog >= previous:
+            break
+    elapsed = time.perf_counter() - started
+    tagged = tweets - (backlog or 0)
+    return {'runs': runs, 'tweets_tagged': tagged, 'seconds': elapsed, 'tweets_per_sec': tagged / elapsed if elapsed else None}
+
+def run_trend_queries(tagger, repeat):
+    as_of = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    samples = {
+        'function_3_scan': time_calls(lambda: tagger.function_3(as_of, source='scan'), repeat),
+        'function_1': time_calls(lambda: tagger.function_1(as_of), repeat),
+        'function_2': time_calls(tagger.function_2, repeat),
+    }
+    tagger.install_tag_rollup()
+    samples['function_3_rollup'] = time_calls(lambda: tagger.function_3(as_of, source='rollup'), repeat)
+    return samples
+
+def run_writers(tagger, rows, repeat, seed):
+    """
+    Times insert_df_to_table on its three paths: the key-column UPDATE of
+    table_9 tags, and the COPY and executemany upserts into table_1.
+    """
+    pd = tagger.pd
+    rng = random.Random(seed)
+    ids = tagger.Send_query_to_DB_silent("SELECT id FROM table_9 ORDER BY id LIMIT %(rows)s", {'rows': rows})['id'].tolist()
+    columns = tagger.get_table_writer('table_9').columns
+    updates = pd.DataFrame({column: [None] * len(ids) for column in columns})
+    updates['id'] = ids
+    updates['tags'] = [[f"#topic{rng.randint(0, 300)}", f"$coin{rng.randint(0, 200)}"] for _ in ids]
+
+    def upserts(count):
+        return pd.DataFrame({
+            'column_1': [f"key{rng.randint(0, rows * 2)}" for _ in range(count)],
+            'column_2': ['a' * 20] * count,
+            'column_3': ['b' * 20] * count,
+            'column_4': ['c' * 20] * count,
+        }).drop_duplicates('column_1')
+
+    small = max(1, min(rows, tagger.bulk_insert_threshold - 1))
+    return {
+        'update_table_9': time_calls(lambda: tagger.insert_df_to_table(updates, 'table_9'), repeat),
+        'upsert_copy': time_calls(lambda: tagger.insert_df_to_table(upserts(max(rows, tagger.bulk_insert_threshold)), 'table_1'), repeat),
+        'upsert_executemany': time_calls(lambda: tagger.insert_df_to_table(upserts(small), 'table_1'), repeat),
+    }
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='tagger-benchmark-')
+    stops = []
+    try:
+        llm = start_fake_llm(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.seed)
+        stops.append(llm.shutdown)
+        if args.dsn:
+            pg_settings = dsn_settings(args.dsn)
+        else:
+            pg_settings, stop = start_postgres(workdir, args.pg_bin)
+            stops.append(stop)
+        if args.redis_host:
+            redis_settings = {'REDIS_HOST': args.redis_host, 'REDIS_PORT': str(args.redis_port), 'REDIS_DB': str(args.redis_db)}
+        else:
+            redis_settings, stop = start_redis(workdir)
+            stops.append(stop)
+
+        # tagger reads its configuration at import time
+        os.environ.update(pg_settings)
+        os.environ.update(redis_settings)
+        os.environ.update({
+            'LOCALAI_ENDPOINT': f"http://127.0.0.1:{llm.server_address[1]}/v1",
+            'LOCALAI_API_KEY': 'benchmark',
+            'TAGGER_DRAIN_MODE': 'true',
+            'TAGGER_DRAIN_TIME_BUDGET': str(args.drain_budget),
+        })
+        os.environ.setdefault('RABBITMQ_PORT', '5672')
+        for assignment in args.env:
+            key, _, value = assignment.partition('=')
+            os.environ[key] = value
+        sys.path.insert(0, BENCHMARK_DIR)
+        # label_batch dumps its batch to the working directory
+        os.chdir(workdir)
+        import tagger
+        logging.getLogger('tagger').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+        tagger.initialize_connection()
+        load_synthetic_data(tagger, args.tweets, args.posts, args.seed)
+        tagger.install_tagger_schema()
+
+        tagging = run_tagging(tagger, args.tweets)
+        logger.info(f"Tagged {tagging['tweets_tagged']} tweets at {tagging['tweets_per_sec']:.1f} tweets/sec")
+        with tagger.stage_samples_lock:
+            pipeline_samples = {stage: list(samples) for stage, samples in tagger.stage_samples.items()}
+        query_samples = run_trend_queries(tagger, args.repeat)
+        writer_samples = run_writers(tagger, args.writer_rows, args.repeat, args.seed)
+
+        results = {
+            'git_revision': git_revision(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'parameters': {key: value for key, value in vars(args).items() if key != 'func'},
+            'tweets_per_sec': tagging['tweets_per_sec'],
+            'tagging': tagging,
+            'llm_requests': llm.settings['requests'],
+            'llm_injected_errors': llm.settings['errors'],
+            'stages': {stage: summarize_samples(samples) for stage, samples in pipeline_samples.items()},
+            'queries': {name: summarize_samples(samples) for name, samples in query_samples.items()},
+            'writers': {name: summarize_samples(samples) for name, samples in writer_samples.items()},
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        tagger.close_connection()
+        return results
+    finally:
+        for stop in reversed(stops):
+            try:
+                stop()
+            except Exception as e:
+                logger.warning(f"Cleanup failed: {e}")
+        os.chdir(BENCHMARK_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+#-------------------------- COMPARISON ----------------------------
+# Metrics where a higher value is better, all others are durations or sizes
+HIGHER_IS_BETTER = {'tweets_per_sec'}
+
+def flatten_metrics(results):
+    metrics = {'tweets_per_sec': results.get('tweets_per_sec'), 'peak_rss_mb': results.get('peak_rss_mb')}
+    for group in ('stages', 'queries', 'writers'):
+        for name, summary in (results.get(group) or {}).items():
+            for statistic in ('p50', 'p99'):
+                metrics[f"{group}.{name}.{statistic}"] = summary.get(statistic)
+    return metrics
+
+def compare_results(before, after, threshold):
+    """
+    Prints every metric of two result files with its relative change.
+
+    Returns:
+    - list: names of the metrics that got worse by more than threshold percent.
+    """
+    old, new = flatten_metrics(before), flatten_metrics(after)
+    print(f"{'metric':<40} {'before':>12} {'after':>12} {'change':>9}")
+    print(f"{'revision':<40} {str(before.get('git_revision'))[:12]:>12} {str(after.get('git_revision'))[:12]:>12}")
+    regressions = []
+    for name in sorted(old.keys() | new.keys()):
+        a, b = old.get(name), new.get(name)
+        if a is None or b is None:
+            print(f"{name:<40} {str(a):>12} {str(b):>12} {'':>9}")
+            continue
+        change = (b - a) / a * 100 if a else 0.0
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = '  <-- regression' if worse > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<40} {a:>12.4f} {b:>12.4f} {change:>8.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Run the benchmark and write JSON results')
+    run.add_argument('--tweets', type=int, default=2000, help='Untagged tweets loaded into table_9')
+    run.add_argument('--posts', type=int, default=20000, help='Tagged posts loaded into table_8')
+    run.add_argument('--llm-latency', type=float, default=0.1, help='Mean fake LLM latency in seconds')
+    run.add_argument('--llm-jitter', type=float, default=0.02, help='Standard deviation of the fake LLM latency')
+    run.add_argument('--llm-error-rate', type=float, default=0.0, help='Fraction of fake LLM requests answered with HTTP 500')
+    run.add_argument('--repeat', type=int, default=5, help='Repetitions of every query and writer measurement')
+    run.add_argument('--writer-rows', type=int, default=2000, help='Rows per writer call')
+    run.add_argument('--drain-budget', type=float, default=600, help='TAGGER_DRAIN_TIME_BUDGET for the tagging runs')
+    run.add_argument('--seed', type=int, default=42)
+    run.add_argument('--dsn', help='Use this Postgres instead of a throwaway one (its table_9/table_8/table_1 are replaced!)')
+    run.add_argument('--pg-bin', help='Directory with initdb and pg_ctl, defaults to PATH')
+    run.add_argument('--redis-host', help='Use this Redis instead of a throwaway redis-server')
+    run.add_argument('--redis-port', type=int, default=6379)
+    run.add_argument('--redis-db', type=int, default=0)
+    run.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='Extra tagger setting, e.g. --env LLM_BATCH_SIZE=8')
+    run.add_argument('--output', help='Write results to this file instead of stdout')
+    run.add_argument('--verbose', action='store_true', help='Keep the tagger INFO logs')
+
+    compare = subparsers.add_parser('compare', help='Compare two result files')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=10.0, help='Percent change reported as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            regressions = compare_results(json.load(before), json.load(after), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    output = os.path.abspath(args.output) if args.output else None
+    results = run_benchmark(args)
+    payload = json.dumps(results, indent=2, default=str)
+    if output:
+        with open(output, 'w') as f:
+            f.write(payload + '\n')
+        logger.info(f"Results written to {output}")
+    else:
+        print(payload)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,57 @@
 import os
+import re
 import sys
 import ast
+import csv
 import json
+import socket
 import time
-import pika
-import redis
-import psycopg
+import uuid
+import random
+import hashlib
 import logging
-import logging
-import numpy as np
-import pandas as pd
-from psycopg import sql
-from openai import OpenAI
+import importlib
+import threading
+import subprocess
 from typing import Dict, Any
 from dotenv import load_dotenv
-from psycopg.rows import dict_row
-from dateutil.parser import isoparse
+from dataclasses import dataclass, fields
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access, so that
+    entry points which never touch pandas, the LLM client or the brokers
+    (e.g. 'tagger.py crontab add') do not pay for importing them.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+pd = _LazyModule('pandas')
+np = _LazyModule('numpy')
+pika = _LazyModule('pika')
+redis = _LazyModule('redis')
+openai = _LazyModule('openai')
+psycopg = _LazyModule('psycopg')
+sql = _LazyModule('psycopg.sql')
+psycopg_rows = _LazyModule('psycopg.rows')
+psycopg_pool = _LazyModule('psycopg_pool')
+tiktoken = _LazyModule('tiktoken')
+dateutil_parser = _LazyModule('dateutil.parser')
+prometheus_client = _LazyModule('prometheus_client')
 
 load_dotenv()
 
@@ -27,13 +62,14 @@ logging.basicConfig(level=logging.INFO)
 rabbitmq_host = os.getenv('RABBITMQ_HOST')
 rabbitmq_user = os.getenv('RABBITMQ_USER')
 rabbitmq_password = os.getenv('RABBITMQ_PASS')
-rabbitmq_port = int(os.getenv('RABBITMQ_PORT'))
+rabbitmq_port = os.getenv('RABBITMQ_PORT')
+rabbitmq_prefetch = int(os.getenv('RABBITMQ_PREFETCH', 100))  # Unacked start_tagging messages held while a run is in progress
 
 def create_connection():
     return pika.BlockingConnection(
         pika.ConnectionParameters(
             rabbitmq_host, 
-            rabbitmq_port, 
+            int(rabbitmq_port), 
             '/', 
             pika.PlainCredentials(rabbitmq_user, rabbitmq_password), 
             heartbeat=600, 
@@ -41,68 +77,277 @@ def create_connection():
         )
     )
 
-# Point to the local server
-llm_client = OpenAI(tag_5_url=os.getenv('LOCALAI_ENDPOINT'), api_key=os.getenv('LOCALAI_API_KEY'))
+#llm tagging engine
+llm_model = os.getenv('LLM_MODEL', 'qwen2.5-14b-instruct')
+llm_max_in_flight = int(os.getenv('LLM_MAX_IN_FLIGHT', 8))           # Concurrent requests sent to the LLM server
+llm_request_timeout = float(os.getenv('LLM_REQUEST_TIMEOUT', 120))   # Per-request timeout in seconds
+llm_batch_size = int(os.getenv('LLM_BATCH_SIZE', 1))                 # Tweets packed into one request, 1 disables batching
+
+#token budget
+llm_context_window = int(os.getenv('LLM_CONTEXT_WINDOW', 32768))     # Context length the LLM server is loaded with
+llm_completion_reserve = int(os.getenv('LLM_COMPLETION_RESERVE', 1024))  # Tokens kept free for the reply
+tiktoken_encoding_name = os.getenv('TIKTOKEN_ENCODING', 'cl100k_base')  # Approximation of the served model's tokenizer
+summary_chunk_tokens = int(os.getenv('SUMMARY_CHUNK_TOKENS', 6000))  # Posts per summarisation request, larger tags are map-reduced
+
+#tag cache
+tag_cache_enabled = os.getenv('TAG_CACHE_ENABLED', 'true').lower() == 'true'
+tag_cache_ttl = int(os.getenv('TAG_CACHE_TTL', 7 * 24 * 3600))       # Seconds before a cached entry expires
+
+#summary cache
+summary_cache_enabled = os.getenv('SUMMARY_CACHE_ENABLED', 'true').lower() == 'true'
+summary_cache_ttl = int(os.getenv('SUMMARY_CACHE_TTL', 3 * 24 * 3600))      # Seconds before a cached summary expires
+summary_cache_max_stale = float(os.getenv('SUMMARY_CACHE_MAX_STALE', 0.3))  # Fraction of covered posts that may have left the window
+
+#tag vocabulary
+tag_vocabulary_enabled = os.getenv('TAG_VOCABULARY_ENABLED', 'true').lower() == 'true'
+tag_vocabulary_size = int(os.getenv('TAG_VOCABULARY_SIZE', 50000))                   # Most used tags held in the local index
+tag_vocabulary_max_tags = int(os.getenv('TAG_VOCABULARY_MAX_TAGS', 200000))          # Tags kept in Redis, the least used are dropped beyond it
+tag_vocabulary_min_count = int(os.getenv('TAG_VOCABULARY_MIN_COUNT', 3))              # Uses before a tag can be a canonical target
+tag_vocabulary_refresh_seconds = float(os.getenv('TAG_VOCABULARY_REFRESH_SECONDS', 300))  # Seconds between reloads from Redis
+
+#tag fast path
+# - 'off':      only the LLM produces tags
+# - 'merge':    hashtags, handles, cashtags and ==== markers are extracted locally and merged with the LLM tags
+# - 'skip_llm': like 'merge', and tweets made only of such tokens (plus URLs) are not sent to the LLM at all
+tag_fast_path = os.getenv('TAG_FAST_PATH', 'merge').lower()
+
+#drain mode
+# - when enabled, a run keeps pulling batches until the backlog is empty or the time budget is spent
+drain_mode = os.getenv('TAGGER_DRAIN_MODE', 'false').lower() == 'true'
+drain_time_budget = float(os.getenv('TAGGER_DRAIN_TIME_BUDGET', 240))      # Seconds a run may keep pulling batches
+target_batch_seconds = float(os.getenv('TAGGER_TARGET_BATCH_SECONDS', 60))  # Batch size is adapted to take about this long
+min_batch_size = int(os.getenv('TAGGER_MIN_BATCH_SIZE', 50))
+max_batch_size = int(os.getenv('TAGGER_MAX_BATCH_SIZE', 2000))
+default_batch_size = int(os.getenv('TAGGER_BATCH_SIZE', 300))
+
+#progress events
+# - a batch is tagged and committed in slices, the consumer can announce each one as {"event": "progress", ...}
+# - they go to their own queue, generate_top_20 only gets the done message of a run
+commit_chunk_size = int(os.getenv('TAGGER_COMMIT_CHUNK_SIZE', 100))  # Tweets tagged and committed together while progress events are on
+progress_events_enabled = os.getenv('TAGGER_PROGRESS_EVENTS', 'false').lower() == 'true'  # true once something consumes the progress queue
+progress_queue = os.getenv('TAGGER_PROGRESS_QUEUE', 'tagging_progress')  # Queue the progress events are published to
+
+#work distribution
+# - 'lock':  one process tags at a time under post_labeling_program_lock
+# - 'claim': any number of workers run in parallel, each claiming a disjoint batch of table_9 rows
+tagger_work_mode = os.getenv('TAGGER_WORK_MODE', 'lock').lower()
+tagger_worker_id = os.getenv('TAGGER_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+claim_lease_seconds = int(os.getenv('CLAIM_LEASE_SECONDS', 600))     # Claimed rows not tagged within this time are reclaimed
+claim_columns_ready = False
+
+#rt handle cleanup
+rt_cleanup_watermark_key = os.getenv('RT_CLEANUP_WATERMARK_KEY', 'rt_cleanup_watermark')  # Redis key of the last function_4 pass
+rt_cleanup_overlap_seconds = int(os.getenv('RT_CLEANUP_OVERLAP_SECONDS', 300))  # Rows tagged this long before the last pass are scanned again, for writes still in flight then
+
+#redis lock
+lock_ttl = float(os.getenv('LOCK_TTL', 60))                                   # Seconds the lease lasts without a heartbeat
+lock_heartbeat_interval = float(os.getenv('LOCK_HEARTBEAT_INTERVAL', lock_ttl / 3))  # Seconds between lease extensions
 
 # Datatag_5 connection parameters
-# - Declare the connection as a global variable
-connection = None
+# - Process-wide connection pool shared by the consumer loop and all query helpers
+db_pool = None
+db_pool_lock = threading.Lock()
+db_pool_min_size = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+db_pool_max_size = int(os.getenv('DB_POOL_MAX_SIZE', 4))
+db_pool_max_idle = float(os.getenv('DB_POOL_MAX_IDLE', 300))          # Seconds before an idle connection is recycled
+db_pool_max_lifetime = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))  # Seconds before any connection is replaced
+# - Row count from which insert_df_to_table streams rows with COPY instead of executemany
+bulk_insert_threshold = int(os.getenv('BULK_INSERT_THRESHOLD', 500))
+# - Rows per UPDATE statement on the key_columns path
+update_chunk_size = int(os.getenv('UPDATE_CHUNK_SIZE', 5000))
+# - Rows fetched per round trip by the streaming query helpers
+query_itersize = int(os.getenv('QUERY_ITERSIZE', 2000))
+
+#scheduler
+# - the consumer runs post_labeling_program every TAGGER_SCHEDULE_INTERVAL seconds itself, 0 leaves it to cron (`tagger.py run-once`)
+schedule_interval = float(os.getenv('TAGGER_SCHEDULE_INTERVAL', 300))  # Seconds between scheduled runs
+schedule_jitter = float(os.getenv('TAGGER_SCHEDULE_JITTER', 15))       # Up to this many seconds are added to each tick
+
+#metrics
+metrics_port = int(os.getenv('METRICS_PORT', 80))                        # /metrics and /healthz, published as 8000 by docker-compose
+metrics_probe_interval = float(os.getenv('METRICS_PROBE_INTERVAL', 10))  # Seconds between DB/Redis round-trip probes
+metrics_sample_size = int(os.getenv('METRICS_SAMPLE_SIZE', 10000))       # Raw durations kept per stage
+
+#trend rollup
+# - 'scan':   function_3 aggregates 240 hours of table_9 on every call
+# - 'rollup': function_3 reads the trigger-maintained table_9_tag_rollup (run `tagger.py rollup install` first)
+trend_score_source = os.getenv('TREND_SCORE_SOURCE', 'scan').lower()
+tag_rollup_retention_hours = int(os.getenv('TAG_ROLLUP_RETENTION_HOURS', 720))  # Older hour buckets are pruned
+tag_rollup_prune_interval = int(os.getenv('TAG_ROLLUP_PRUNE_INTERVAL', 3600))   # Seconds between prunes after tagging runs, 0 leaves it to `tagger.py rollup prune`
+tag_rollup_prune_key = os.getenv('TAG_ROLLUP_PRUNE_KEY', 'tag_rollup_prune')    # Redis key marking a recent prune
 
 def initialize_connection():
     """
-    Initializes the global datatag_5 connection.
+    Opens the global datatag_5 connection pool. Does nothing if it is already open,
+    so it is cheap to call at the start of every run.
+    Connections are checked before being handed out, recycled after
+    DB_POOL_MAX_IDLE / DB_POOL_MAX_LIFETIME seconds and re-established in the
+    background when the server goes away.
     """
-    global connection
-    try:
-        connection = psycopg.connect(
-            dbname=os.getenv('POSTGRESQL_DB_NAME'),
-            user=os.getenv('POSTGRESQL_USER'),
-            password=os.getenv('POSTGRESQL_PASSWORD'),
-            host=os.getenv('POSTGRESQL_HOST'),
-            port=os.getenv('POSTGRESQL_PORT')
-        )
-        logger.info("Datatag_5 connection initialized.")
-    except Exception as e:
-        logger.error(f"Failed to initialize datatag_5 connection: {e}")
-        connection = None
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            return
+        pool = None
+        try:
+            pool = psycopg_pool.ConnectionPool(
+                kwargs={
+                    'dbname': os.getenv('POSTGRESQL_DB_NAME'),
+                    'user': os.getenv('POSTGRESQL_USER'),
+                    'password': os.getenv('POSTGRESQL_PASSWORD'),
+                    'host': os.getenv('POSTGRESQL_HOST'),
+                    'port': os.getenv('POSTGRESQL_PORT')
+                },
+                min_size=db_pool_min_size,
+                max_size=db_pool_max_size,
+                max_idle=db_pool_max_idle,
+                max_lifetime=db_pool_max_lifetime,
+                check=psycopg_pool.ConnectionPool.check_connection,
+                name='tagger',
+                open=True
+            )
+            pool.wait(timeout=30)
+            db_pool = pool
+            logger.info("Datatag_5 connection pool initialized.")
+        except Exception as e:
+            logger.error(f"Failed to initialize datatag_5 connection pool: {e}")
+            if pool is not None:
+                pool.close()
+            db_pool = None
 
 def get_connection():
     """
-    Returns the global datatag_5 connection.
-    If the connection is not initialized, it raises an error.
+    Checks a connection out of the global datatag_5 pool, to be used as
+    'with get_connection() as connection:'. The connection goes back to the pool
+    at the end of the block, committed if the block succeeded and rolled back otherwise.
+    If the pool is not initialized, it raises an error.
     """
-    if connection is None:
+    if db_pool is None:
         raise Exception("Datatag_5 connection is not initialized. Call 'initialize_connection' first.")
-    return connection
+    return db_pool.connection()
 
 def close_connection():
     """
-    Closes the global datatag_5 connection.
+    Closes the global datatag_5 connection pool.
     """
-    global connection
-    if connection is not None:
-        connection.close()
-        logger.info("Datatag_5 connection closed.")
-        connection = None
-    else:
-        logger.warning("No active datatag_5 connection to close.")
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.close()
+            logger.info("Datatag_5 connection pool closed.")
+            db_pool = None
+        else:
+            logger.warning("No active datatag_5 connection pool to close.")
 
 #-------------------------- CUSTOM SQL FUNCTIONS ----------------------------
 # Function for executing Queries
 def Send_query_to_DB_silent(query, params=None):
     try:
         #close_old_connections()
-        connection = get_connection()
-        with connection.cursor() as cursor:
+        with get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                data = cursor.fetchall()
+                col_names = [desc[0] for desc in cursor.description]
+        df = pd.DataFrame(data, columns=col_names)
+        return df
+    except Exception as error:
+        logger.error(f"Error while running a query: {error}")
+        return pd.DataFrame()
+
+# Typed rows for the common result shapes, used with psycopg's class_row
+@dataclass(slots=True)
+class TweetRecord:
+    id: int
+    content: str
+    column_44: datetime
+    column_50: str
+    tags: list
+
+@dataclass(slots=True)
+class TagPostsRecord:
+    tag: str
+    posts: list
+    users: list
+    post_dates: list
+
+@contextmanager
+def server_side_cursor(query, params=None, itersize=None, row_factory=None):
+    """
+    Executes the query on a named (server-side) cursor, so rows are kept on the
+    server and fetched itersize at a time. The transaction is committed when the
+    block exits normally and rolled back otherwise.
+    """
+    if isinstance(query, str):
+        query = query.strip().rstrip(';')
+    with get_connection() as connection:
+        cursor = connection.cursor(name=f"stream_{uuid.uuid4().hex}", row_factory=row_factory or psycopg_rows.tuple_row)
+        try:
+            cursor.itersize = itersize or query_itersize
             cursor.execute(query, params)
-            data = cursor.fetchall()
+            yield cursor
+            cursor.close()
+            connection.commit()
+        except BaseException:
+            cursor.close()
+            connection.rollback()
+            raise
+
+def stream_query_from_DB(query, params=None, itersize=None, row_factory=None):
+    """
+    Yields the query result in lists of up to itersize rows, so processing can
+    start before the last row arrives and memory stays bounded.
+
+    Parameters:
+    - row_factory: psycopg row factory, e.g. class_row(TweetRecord); tuples by default.
+    """
+    with server_side_cursor(query, params, itersize, row_factory) as cursor:
+        while True:
+            rows = cursor.fetchmany(cursor.itersize)
+            if not rows:
+                return
+            yield rows
+
+def Send_query_to_DB_columnar(query, params=None, itersize=None):
+    """
+    Same result as Send_query_to_DB_silent, but rows are streamed from a
+    server-side cursor and appended column by column, so the full result is
+    never held both as row tuples and as a DataFrame.
+    """
+    try:
+        with server_side_cursor(query, params, itersize) as cursor:
             col_names = [desc[0] for desc in cursor.description]
-            df = pd.DataFrame(data, columns=col_names)
-            return df
+            columns = [[] for _ in col_names]
+            while True:
+                rows = cursor.fetchmany(cursor.itersize)
+                if not rows:
+                    break
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values)
+                del rows
+        df = pd.DataFrame(dict(enumerate(columns)))
+        df.columns = col_names
+        return df
     except Exception as error:
-        logger.error(f"Error while running a query: {error}")
+        logger.error(f"Error while running a streaming query: {error}")
         return pd.DataFrame()
 
+def Send_query_to_DB_records(query, params=None, row_factory=None):
+    """
+    Same as Send_query_to_DB_silent, but returns the rows as a list built by
+    row_factory (e.g. class_row(TweetRecord)) instead of a DataFrame, for the
+    paths that only iterate over the rows.
+    Returns an empty list on error.
+    """
+    try:
+        with get_connection() as connection:
+            with connection.cursor(row_factory=row_factory or psycopg_rows.tuple_row) as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+    except Exception as error:
+        logger.error(f"Error while running a query: {error}")
+        return []
+
 # helper function for getting names from the table in the db
 def get_table_columns(table_name):
     """
@@ -145,69 +390,297 @@ def get_table_columns(table_name):
         logger.exception(f"Failed to get columns for table '{table_name}': {e}")
         raise
 
+def get_table_column_types(table_name):
+    """
+    Retrieves the type of every column of the specified table as a castable
+    type name, e.g. {'id': 'int8', 'tags': 'text[]'}.
+    """
+    query = """
+        SELECT column_name, udt_name
+        FROM information_schema.columns
+        WHERE LOWER(table_name) = LOWER(%s)
+        ORDER BY ordinal_position
+    """
+    result = Send_query_to_DB_silent(query, [table_name])
+    if result.empty:
+        raise ValueError(f"No columns found for table '{table_name}' in information_schema.")
+    # Array types are listed as _<element type>
+    return {
+        column: f"{udt[1:]}[]" if udt.startswith('_') else udt
+        for column, udt in zip(result['column_name'], result['udt_name'])
+    }
+
+def to_pg_array_literal(values):
+    """
+    Encodes a list of strings as a Postgres array literal ('{"a","b"}'), so a
+    whole column of arrays can travel as one text[] parameter and be cast back
+    per row. String input in Python list syntax is parsed first; None stays None.
+    """
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = ast.literal_eval(values)
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+# Conflict handling configuration per table
+# - special_handling values are SQL templates, {table} is replaced with the table identifier
+TABLE_CONFLICT_CONFIG = {
+    'table_1': {
+        'conflict_fields': ['column_1'],
+        'update_fields': ['column_2', 'column_3', 'column_4'],
+        'special_handling': None
+    },
+    'table_2': {
+        'conflict_fields': ['column_5'],
+        'update_fields': ['column_6', 'column_7'],
+        'special_handling': {
+            'column_6': "COALESCE(EXCLUDED.column_6, {table}.column_6)"
+        }
+    },
+    'table_3': {
+        'conflict_fields': ['column_5', 'column_8', 'column_9'],
+        'update_fields': ['column_10'],
+        'special_handling': None
+    },
+    'table_4': {
+        'conflict_fields': ['column_8'],
+        'update_fields': ['column_10', 'column_11', 'column_12', 'column_13', 'column_14', 'column_15', 'column_16', 'column_17', 'column_18', 'column_19', 'column_20', 'column_21', 'column_22', 'column_23', 'column_24', 'column_25', 'column_26', 'column_27', 'column_28', 'column_29', 'column_30', 'column_31'],
+        'special_handling': None
+    },
+    'table_5': {
+        'conflict_fields': ['column_8', 'column_10'],
+        'update_fields': [],  # Do not update any fields on conflict
+        'special_handling': None,
+        'do_nothing_on_conflict': True
+    },
+    'table_6': {
+        'conflict_fields': ['column_8', 'column_10'],
+        'update_fields': [],  # Do not update any fields on conflict
+        'special_handling': None,
+        'do_nothing_on_conflict': True
+    },
+    'table_7': {
+        'conflict_fields': ['column_10'],
+        'update_fields': ['data', 'column_32'],
+        'special_handling': None
+    },
+    'table_8': {
+        'conflict_fields': [],
+        'update_fields': ['tags'],
+        'key_columns': ['content', 'datetime', 'column_33'],
+        'special_handling': None
+    },
+    'table_9': {
+        'conflict_fields': [],
+        'update_fields': ['tags'],
+        'key_columns': ['id'],
+        'special_handling': None
+    },
+}
+
+class TableWriter:
+    """
+    Write plan for one table: the column order from information_schema and the
+    SQL statements insert_df_to_table needs, compiled once per process.
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+        config = TABLE_CONFLICT_CONFIG.get(table_name, {})
+        self.conflict_fields = config.get('conflict_fields', [])
+        self.update_fields = config.get('update_fields', [])
+        self.key_columns = config.get('key_columns', [])
+        self.do_nothing_on_conflict = config.get('do_nothing_on_conflict', False)
+        special_handling = config.get('special_handling') or {}
+
+        # Retrieve datatag_5 columns
+        self.columns = get_table_columns(table_name)
+
+        # UPDATE using key_columns when there is nothing to conflict on
+        self.is_key_update = not self.conflict_fields and bool(self.update_fields)
+
+        # If update_fields is None, update all columns except conflict_fields
+        if self.update_fields is None:
+            self.update_fields = [col for col in self.columns if col not in self.conflict_fields]
+
+        table = sql.Identifier(table_name)
+        fields = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+
+        if self.is_key_update:
+            if not self.key_columns:
+                logger.error(f"No key_columns specified for table '{table_name}'. Cannot perform update without key columns.")
+                raise ValueError(f"No key_columns specified for table '{table_name}'.")
+
+            # Fixed-shape UPDATE taking one array parameter per column, unnested
+            # server side. Array columns travel as text[] of array literals and
+            # are cast back per row, since unnest would flatten a text[][].
+            column_types = get_table_column_types(table_name)
+            self.data_columns = self.key_columns + self.update_fields
+            self.array_columns = [col for col in self.data_columns if column_types[col].endswith('[]')]
+
+            arrays = []
+            for col in self.data_columns:
+                element_type = 'text' if col in self.array_columns else column_types[col]
+                arrays.append(sql.SQL("%s::{}[]").format(sql.Identifier(element_type)))
+
+            assignments = []
+            for col in self.update_fields:
+                if col in self.array_columns:
+                    assignment = sql.SQL("{col} = data.{col}::{type}").format(
+                        col=sql.Identifier(col),
+                        type=sql.SQL(column_types[col])
+                    )
+                else:
+                    assignment = sql.SQL("{col} = data.{col}").format(col=sql.Identifier(col))
+                assignments.append(assignment)
+
+            where_clause = sql.SQL(' AND ').join(
+                sql.SQL("{table}.{col} = data.{col}").format(table=table, col=sql.Identifier(col))
+                for col in self.key_columns
+            )
+            self.update_query = self._compile(sql.SQL(
+                "UPDATE {table} SET {assignments} FROM unnest({arrays}) AS data ({data_columns}) WHERE {where_clause}"
+            ).format(
+                table=table,
+                assignments=sql.SQL(', ').join(assignments),
+                arrays=sql.SQL(', ').join(arrays),
+                data_columns=sql.SQL(', ').join(map(sql.Identifier, self.data_columns)),
+                where_clause=where_clause
+            ))
+            return
+
+        if self.do_nothing_on_conflict:
+            conflict_clause = sql.SQL("ON CONFLICT ({}) DO NOTHING").format(
+                sql.SQL(', ').join(map(sql.Identifier, self.conflict_fields))
+            )
+        elif self.conflict_fields:
+            update_assignments = [
+                sql.SQL("{col} = {value}").format(
+                    col=sql.Identifier(col),
+                    value=sql.SQL(special_handling[col]).format(table=table) if col in special_handling
+                    else sql.SQL("EXCLUDED.{col}").format(col=sql.Identifier(col)))
+                for col in self.update_fields
+            ]
+            conflict_clause = sql.SQL("ON CONFLICT ({fields}) DO UPDATE SET {assignments}").format(
+                fields=sql.SQL(', ').join(map(sql.Identifier, self.conflict_fields)),
+                assignments=sql.SQL(', ').join(update_assignments)
+            )
+        else:
+            conflict_clause = sql.SQL("")
+
+        # Row by row insert with placeholders
+        self.insert_query = self._compile(sql.SQL(
+            "INSERT INTO {table} ({fields}) VALUES ({placeholders}) {conflict}"
+        ).format(
+            table=table,
+            fields=fields,
+            placeholders=sql.SQL(', ').join(sql.Placeholder() for _ in self.columns),
+            conflict=conflict_clause
+        ))
+
+        # COPY path: session temp table shaped like the target, then one INSERT ... SELECT.
+        # For DO UPDATE, rows repeating a conflict key are collapsed to the last one,
+        # as executemany would have left them.
+        staging = sql.Identifier(f"{table_name}_staging")
+        self.create_staging_query = self._compile(sql.SQL(
+            "CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        ).format(staging=staging, table=table))
+        self.copy_query = self._compile(sql.SQL("COPY {staging} ({fields}) FROM STDIN").format(staging=staging, fields=fields))
+        if self.conflict_fields and not self.do_nothing_on_conflict:
+            keys = sql.SQL(', ').join(map(sql.Identifier, self.conflict_fields))
+            source = sql.SQL("SELECT DISTINCT ON ({keys}) {fields} FROM {staging} ORDER BY {keys}, ctid DESC").format(
+                keys=keys, fields=fields, staging=staging
+            )
+        else:
+            source = sql.SQL("SELECT {fields} FROM {staging}").format(fields=fields, staging=staging)
+        self.bulk_insert_query = self._compile(sql.SQL("INSERT INTO {table} ({fields}) {source} {conflict}").format(
+            table=table, fields=fields, source=source, conflict=conflict_clause
+        ))
+
+    @staticmethod
+    def _compile(query):
+        # Render the composed statement once; psycopg then reuses the same text
+        # and can keep it prepared on the server between calls
+        with get_connection() as connection:
+            return query.as_string(connection)
+
+# Compiled TableWriter per table, filled on first use
+table_writers = {}
+table_writers_lock = threading.Lock()
+
+def get_table_writer(table_name):
+    """
+    Returns the cached TableWriter for table_name, introspecting the table on first use.
+    """
+    writer = table_writers.get(table_name)
+    if writer is None:
+        with table_writers_lock:
+            writer = table_writers.get(table_name)
+            if writer is None:
+                writer = TableWriter(table_name)
+                table_writers[table_name] = writer
+                logger.info(f"Table writer for '{table_name}' compiled with {len(writer.columns)} columns.")
+    return writer
+
+def invalidate_table_writers(table_name=None):
+    """
+    Drops the cached writer for table_name, or all of them, e.g. after a schema change.
+    """
+    with table_writers_lock:
+        if table_name is None:
+            table_writers.clear()
+        else:
+            table_writers.pop(table_name, None)
+
+def copy_upsert(cursor, writer, records):
+    """
+    Bulk variant of the INSERT ... ON CONFLICT path of insert_df_to_table.
+
+    Streams the records with COPY into the writer's session temp table and
+    applies the table's conflict clause in one set-based INSERT ... SELECT.
+    Runs inside the caller's transaction; the temp table is emptied on commit.
+    """
+    cursor.execute(writer.create_staging_query)
+    with cursor.copy(writer.copy_query) as copy:
+        for record in records:
+            copy.write_row(record)
+    cursor.execute(writer.bulk_insert_query, prepare=True)
+    logger.info(f"Bulk upserted {len(records)} rows into '{writer.table_name}' with COPY.")
+
+def execute_key_update(writer, column_arrays, row_count):
+    """
+    Runs the writer's unnest UPDATE over one list of values per data column,
+    update_chunk_size rows per statement, in one transaction.
+    """
+    table_name = writer.table_name
+    try:
+        with get_connection() as connection:
+            with connection.cursor() as cursor:
+                for start in range(0, row_count, update_chunk_size):
+                    params = [values[start:start + update_chunk_size] for values in column_arrays]
+                    cursor.execute(writer.update_query, params, prepare=True)
+            connection.commit()
+        logger.info(f"Data updated successfully in '{table_name}'.")
+    except Exception as e:
+        # The pool rolls the connection back when the block fails
+        if isinstance(e, (psycopg.errors.UndefinedColumn, psycopg.errors.UndefinedTable)):
+            invalidate_table_writers(table_name)
+        logger.exception(f"Failed to update data in '{table_name}': {str(e)}")
+        raise
+
 def insert_df_to_table(df, table_name):
     """
     Inserts data from a DataFrame into the specified PostgreSQL table with hybrid conflict handling.
     If an error occurs, it attempts to identify the exact column and value causing the error.
     """
     try:
-        # Define conflict handling configurations per table
-        conflict_config = {
-            'table_1': {
-                'conflict_fields': ['column_1'],
-                'update_fields': ['column_2', 'column_3', 'column_4'],
-                'special_handling': None
-            },
-            'table_2': {
-                'conflict_fields': ['column_5'],
-                'update_fields': ['column_6', 'column_7'],
-                'special_handling': {
-                    'column_6': sql.SQL("COALESCE(EXCLUDED.column_6, {table}.column_6)").format(table=sql.Identifier(table_name))
-                }
-            },
-            'table_3': {
-                'conflict_fields': ['column_5', 'column_8', 'column_9'],
-                'update_fields': ['column_10'],
-                'special_handling': None
-            },
-            'table_4': {
-                'conflict_fields': ['column_8'],
-                'update_fields': ['column_10', 'column_11', 'column_12', 'column_13', 'column_14', 'column_15', 'column_16', 'column_17', 'column_18', 'column_19', 'column_20', 'column_21', 'column_22', 'column_23', 'column_24', 'column_25', 'column_26', 'column_27', 'column_28', 'column_29', 'column_30', 'column_31'],
-                'special_handling': None
-            },
-            'table_5': {
-                'conflict_fields': ['column_8', 'column_10'],
-                'update_fields': [],  # Do not update any fields on conflict
-                'special_handling': None,
-                'do_nothing_on_conflict': True
-            },
-            'table_6': {
-                'conflict_fields': ['column_8', 'column_10'],
-                'update_fields': [],  # Do not update any fields on conflict
-                'special_handling': None,
-                'do_nothing_on_conflict': True
-            },
-            'table_7': {
-                'conflict_fields': ['column_10'],
-                'update_fields': ['data', 'column_32'],
-                'special_handling': None
-            },
-            'table_8': {
-                'conflict_fields': [],
-                'update_fields': ['tags'],
-                'key_columns': ['content', 'datetime', 'column_33'],
-                'special_handling': None
-            },
-            'table_9': {
-                'conflict_fields': [],
-                'update_fields': ['tags'],
-                'key_columns': ['id'],
-                'special_handling': None
-            },
-        }
-
-        # Retrieve datatag_5 columns
-        db_columns = get_table_columns(table_name)
+        writer = get_table_writer(table_name)
+        db_columns = writer.columns
 
         # Remove 'column_34' if it exists in the DataFrame
         if 'column_34' in df.columns:
@@ -234,23 +707,9 @@ def insert_df_to_table(df, table_name):
         df = df.replace({pd.NA: None})
         df = df.where(pd.notnull(df), None)
 
-        # Prepare data for insertion or update
-        config = conflict_config.get(table_name, {})
-        conflict_fields = config.get('conflict_fields', [])
-        update_fields = config.get('update_fields', [])
-        key_columns = config.get('key_columns', [])
-        special_handling = config.get('special_handling', {})
-        do_nothing_on_conflict = config.get('do_nothing_on_conflict', False)
-
-        # Ensure special_handling is a dictionary
-        if special_handling is None:
-            special_handling = {}
-
-        if not conflict_fields and update_fields:
+        if writer.is_key_update:
             # Perform an UPDATE using key_columns
-            if not key_columns:
-                logger.error(f"No key_columns specified for table '{table_name}'. Cannot perform update without key columns.")
-                raise ValueError(f"No key_columns specified for table '{table_name}'.")
+            key_columns = writer.key_columns
 
             # Ensure key_columns are present in the DataFrame
             missing_keys = [col for col in key_columns if col not in df.columns]
@@ -258,67 +717,15 @@ def insert_df_to_table(df, table_name):
                 logger.error(f"Key columns {missing_keys} not found in DataFrame for table '{table_name}'.")
                 raise ValueError(f"Key columns {missing_keys} not found in DataFrame for table '{table_name}'.")
 
-            # Build the UPDATE query
-            update_assignments = []
-            for col in update_fields:
-                if col == 'tags':
-                    assignment = sql.SQL("{col} = data.{col}::text[]").format(col=sql.Identifier(col))
-                else:
-                    assignment = sql.SQL("{col} = data.{col}").format(col=sql.Identifier(col))
-                update_assignments.append(assignment)
-
-            # Construct the VALUES clause
-            values_list = []
-            params = []
-            data_columns = key_columns + update_fields
-            for idx, row in df.iterrows():
-                values = []
-                for col in data_columns:
-                    value = row[col]
-                    # For 'tags' column, make sure the value is a list
-                    if col == 'tags':
-                        if isinstance(value, str):
-                            # Convert the string representation of array to an actual list
-                            import ast
-                            value = ast.literal_eval(value)
-                    values.append(value)
-                placeholders = [sql.Placeholder() for _ in values]
-                values_list.append(sql.SQL('({})').format(sql.SQL(', ').join(placeholders)))
-                params.extend(values)
-
-            values_clause = sql.SQL(', ').join(values_list)
-
-            # Build the WHERE clause for matching records
-            where_conditions = [
-                sql.SQL("{table}.{col} = data.{col}").format(
-                    table=sql.Identifier(table_name),
-                    col=sql.Identifier(col)
-                ) for col in key_columns
-            ]
-            where_clause = sql.SQL(' AND ').join(where_conditions)
-
-            # Build the full UPDATE query
-            update_query = sql.SQL(
-                "UPDATE {table} SET {assignments} FROM (VALUES {values}) AS data ({data_columns}) WHERE {where_clause}"
-            ).format(
-                table=sql.Identifier(table_name),
-                assignments=sql.SQL(', ').join(update_assignments),
-                values=values_clause,
-                data_columns=sql.SQL(', ').join(map(sql.Identifier, data_columns)),
-                where_clause=where_clause
-            )
+            # One array per column, array columns encoded as literals
+            column_arrays = []
+            for col in writer.data_columns:
+                values = df[col].tolist()
+                if col in writer.array_columns:
+                    values = [to_pg_array_literal(value) for value in values]
+                column_arrays.append(values)
 
-            # Execute the UPDATE query
-            try:
-                connection = get_connection()
-                with connection.cursor() as cursor:
-                    cursor.execute(update_query, params)
-                connection.commit()
-                logger.info(f"Data updated successfully in '{table_name}'.")
-            except Exception as e:
-                connection.rollback()
-                logger.exception(f"Failed to update data in '{table_name}': {str(e)}")
-                raise
+            execute_key_update(writer, column_arrays, len(df))
 
             # Exit the function after successful UPDATE
             return  # Prevent further execution
@@ -326,50 +733,23 @@ def insert_df_to_table(df, table_name):
         else:
             # Existing logic for INSERT with conflict handling
             # Prepare data for insertion using records with preserved data types
-            records = [tuple(x) for x in df.itertuples(incolumn_3=False, name=None)]
-
-            # If update_fields is None or empty, update all columns except conflict_fields
-            if update_fields is None:
-                update_fields = [col for col in db_columns if col not in conflict_fields]
-
-            if do_nothing_on_conflict:
-                conflict_clause = sql.SQL("ON CONFLICT ({}) DO NOTHING").format(
-                    sql.SQL(', ').join(map(sql.Identifier, conflict_fields))
-                )
-            else:
-                update_assignments = [
-                    sql.SQL("{col} = {value}").format(
-                        col=sql.Identifier(col),
-                        value=special_handling.get(col, sql.SQL("EXCLUDED.{col}").format(col=sql.Identifier(col))))
-                    for col in update_fields
-                ]
-                if conflict_fields:
-                    conflict_clause = sql.SQL("ON CONFLICT ({fields}) DO UPDATE SET {assignments}").format(
-                        fields=sql.SQL(', ').join(map(sql.Identifier, conflict_fields)),
-                        assignments=sql.SQL(', ').join(update_assignments)
-                    )
-                else:
-                    conflict_clause = sql.SQL("")
-
-            # Construct the insert query with placeholders
-            insert_query = sql.SQL(
-                "INSERT INTO {table} ({fields}) VALUES ({placeholders}) {conflict}"
-            ).format(
-                table=sql.Identifier(table_name),
-                fields=sql.SQL(', ').join(map(sql.Identifier, db_columns)),
-                placeholders=sql.SQL(', ').join(sql.Placeholder() for _ in db_columns),
-                conflict=conflict_clause
-            )
+            records = [tuple(x) for x in df.itertuples(index=False, name=None)]
 
-            # Execute the query using batch execution
+            # Execute the query using batch execution, large frames go through COPY.
+            # executemany prepares the repeated INSERT on the server by itself.
             try:
-                connection = get_connection()
-                with connection.cursor() as cursor:
-                    cursor.executemany(insert_query, records)
-                connection.commit()
+                with get_connection() as connection:
+                    with connection.cursor() as cursor:
+                        if len(records) >= bulk_insert_threshold:
+                            copy_upsert(cursor, writer, records)
+                        else:
+                            cursor.executemany(writer.insert_query, records)
+                    connection.commit()
                 logger.info(f"Data inserted successfully into '{table_name}'.")
             except Exception as e:
-                connection.rollback()
+                # The pool rolls the connection back when the block fails
+                if isinstance(e, (psycopg.errors.UndefinedColumn, psycopg.errors.UndefinedTable)):
+                    invalidate_table_writers(table_name)
                 logger.exception(f"Failed to insert data into '{table_name}': {str(e)}")
                 raise
 
@@ -377,230 +757,214 @@ def insert_df_to_table(df, table_name):
         logger.exception(f"Failed to process data for '{table_name}': {str(e)}")
         raise
 
-def function_5():
+def function_5(limit=300):
+    """
+    Returns up to limit of the newest untagged tweets as a list of TweetRecord.
+    """
     query = """
-    SELECT id, content, column_44, column_50, tags FROM table_9 WHERE tags IS NULL ORDER BY column_44 DESC LIMIT 300;
+    SELECT id, content, column_44, column_50, tags FROM table_9 WHERE tags IS NULL ORDER BY column_44 DESC LIMIT %(limit)s;
     """
 
     try:
-        logger.info("Executing query to retrieve last 100 unlabeled tweets")
-        # Execute the query and return the DataFrame
-        df = Send_query_to_DB_silent(query)
-        
-        if df.empty:
+        logger.info(f"Executing query to retrieve last {limit} unlabeled tweets")
+        tweets = Send_query_to_DB_records(query, {'limit': limit}, psycopg_rows.class_row(TweetRecord))
+
+        if not tweets:
             logger.warning("No unlabeled tweets found for recent tweets")
-            return pd.DataFrame(columns=['id', 'content', 'column_44', 'column_50', 'tags'])
         else:
-            num_tweets = len(df)
-            logger.info(f"Retrieved  {num_tweets}  unlabeled tweets")
-            return df
+            logger.info(f"Retrieved  {len(tweets)}  unlabeled tweets")
+        return tweets
 
     except Exception as e:
         logger.error(f"An error occurred while retrieving unlabeled tweets: {e}")
-        return pd.DataFrame(columns=['id', 'content', 'column_44', 'column_50', 'tags'])
+        return []
+
+def count_unlabeled_tweets():
+    query = """
+    SELECT COUNT(*) AS backlog FROM table_9 WHERE tags IS NULL;
+    """
+    try:
+        df = Send_query_to_DB_silent(query)
+        if df.empty:
+            logger.warning("Could not count unlabeled tweets")
+            return None
+        backlog = int(df['backlog'].iloc[0])
+        BACKLOG.set(backlog)
+        return backlog
+    except Exception as e:
+        logger.error(f"An error occurred while counting unlabeled tweets: {e}")
+        return None
+
+def check_claim_columns():
+    """
+    Checks once per process that table_9 has the claimed_by / claimed_at lease
+    columns. They are added by 'tagger.py schema install', never at runtime.
+
+    Returns:
+    - bool: True if claim mode can run.
+    """
+    global claim_columns_ready
+    if claim_columns_ready:
+        return True
+    missing = {'claimed_by', 'claimed_at'} - set(get_table_column_types('table_9'))
+    if missing:
+        logger.error(f"table_9 has no {', '.join(sorted(missing))} for TAGGER_WORK_MODE=claim, run 'tagger.py schema install' once")
+        return False
+    claim_columns_ready = True
+    return True
+
+def claim_unlabeled_tweets(limit=300):
+    """
+    Atomically claims up to limit of the newest untagged tweets for this worker.
+
+    Rows locked by a concurrent claim are skipped (FOR UPDATE SKIP LOCKED), so
+    workers get disjoint batches. A claim is a lease: rows still untagged
+    CLAIM_LEASE_SECONDS after being claimed (e.g. the worker died or the LLM
+    failed) become claimable again. Returns a list of TweetRecord.
+    """
+    if not check_claim_columns():
+        return []
+    query = """
+    WITH candidates AS (
+        SELECT id
+        FROM table_9
+        WHERE tags IS NULL
+          AND (claimed_at IS NULL OR claimed_at < now() - make_interval(secs => %(lease)s))
+        ORDER BY column_44 DESC
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    claimed AS (
+        UPDATE table_9
+        SET claimed_by = %(worker)s, claimed_at = now()
+        FROM candidates
+        WHERE table_9.id = candidates.id
+        RETURNING table_9.id, table_9.content, table_9.column_44, table_9.column_50, table_9.tags
+    )
+    SELECT id, content, column_44, column_50, tags FROM claimed ORDER BY column_44 DESC;
+    """
+    try:
+        logger.info(f"Claiming up to {limit} unlabeled tweets as worker {tagger_worker_id}")
+        params = {'lease': claim_lease_seconds, 'limit': limit, 'worker': tagger_worker_id}
+        tweets = Send_query_to_DB_records(query, params, psycopg_rows.class_row(TweetRecord))
+
+        if not tweets:
+            logger.warning("No unclaimed unlabeled tweets found")
+        else:
+            logger.info(f"Claimed  {len(tweets)}  unlabeled tweets")
+        return tweets
+
+    except Exception as e:
+        logger.error(f"An error occurred while claiming unlabeled tweets: {e}")
+        return []
 
 def function_4():
+    """
+    Catch-up pass for RT handles. label_batch already strips the retweeted
+    author's handle from the tags it writes, so this only looks at rows tagged
+    since the previous successful pass (tagged_at against the watermark kept in
+    Redis, bounded to the last 24 hours) and only rewrites rows that still
+    contain the handle. tagged_at is the start of the writing transaction, so
+    rows tagged up to RT_CLEANUP_OVERLAP_SECONDS before the watermark are
+    scanned again; rows already clean are left alone.
+    Until 'tagger.py schema install' has added tagged_at, the tweets created in
+    the last 24 hours are scanned instead.
+    """
+    if check_tagger_schema()['tagged_at']:
+        window = "tagged_at >= GREATEST(%(watermark)s::timestamptz - make_interval(secs => %(overlap)s), now() - interval '24 hour')"
+    else:
+        window = "column_44 >= now() - interval '24 hour' AND column_44 <= now()"
     query = """
     WITH updated AS (
         SELECT id,
                '@' || LOWER((regexp_matches(content, '^RT @([^:]+): .*'))[1]) AS handle_to_remove
         FROM table_9
         WHERE content ~ '^RT @[A-Za-z0-9_]+: '
-          AND column_44 >= (now() - interval '24 hour')
-          AND column_44 <= now()
+          AND {window}
+          AND tags IS NOT NULL
     ),
     upd AS (
         UPDATE table_9
         SET tags = ARRAY_REMOVE(tags, updated.handle_to_remove)
         FROM updated
         WHERE table_9.id = updated.id
+          AND updated.handle_to_remove = ANY(table_9.tags)
         RETURNING table_9.id
     )
-    SELECT COUNT(*) AS removed FROM upd;
-    """
+    SELECT COUNT(*) AS removed, now() AS watermark FROM upd;
+    """.format(window=window)
 
     try:
-        logger.info("Executing query to remove RT handles from tags")
+        watermark = get_rt_cleanup_watermark()
+        logger.info(f"Executing query to remove RT handles from tags (rows tagged since {watermark or 'the last 24 hours'})")
         # Execute the query and return the DataFrame
-        df = Send_query_to_DB_silent(query)
+        df = Send_query_to_DB_silent(query, {'watermark': watermark, 'overlap': rt_cleanup_overlap_seconds})
         
         if df.empty:
             logger.warning("Problem with RT handle removal")
             return pd.DataFrame(columns=['removed'])
         else:
+            set_rt_cleanup_watermark(df['watermark'].iloc[0])
             num_tweets = df['removed'].iloc[0]
             if num_tweets > 0:
                 logger.info(f"Removed: {num_tweets} handles from labeled tweets")
             else:
                 logger.info("No RT handles were found/removed during this run.")
-            return df
+            return df[['removed']]
 
     except Exception as e:
         logger.error(f"An error occurred while removing RT handles: {e}")
         return pd.DataFrame(columns=['removed'])
 
-def function_3(tag_5_time_str):
+def get_rt_cleanup_watermark():
     """
-    Retrieves the top 20 results by score from the datatag_5.
-
-    Parameters:
-    - tag_5_time_str (str): tag_5 time as a string in 'YYYY-MM-DD HH:MM:SS' format.
-    - positive_offset_hours (int): Number of hours to add to the tag_5 time.
-    - look_back_hours (int): Number of hours to look back from the positive time.
-
-    Returns:
-    - pd.DataFrame: DataFrame containing the top 20 results.
+    Start time of the last successful function_4 pass, None if unknown.
     """
     try:
-        logger.info("Executing query to retrieve top 20 results by score")
-
-        # Convert tag_5_time_str to datetime
-        tag_5_time = datetime.strptime(tag_5_time_str, '%Y-%m-%d %H:%M:%S')
-        start_time = tag_5_time
-
-        # Prepare the SQL query
-        query = """
-        WITH calculated AS (
-            SELECT
-                t.tag,
-                p.column_50 AS "user",
-                p.column_44,
-                EXTRACT(EPOCH FROM (p.column_44 - %(start_time)s)) / 3600.0 AS timediff,
-                p.content
-            FROM
-                table_9 p
-            CROSS JOIN LATERAL
-                unnest(p.tags) AS t(tag)
-            WHERE
-                p.column_44 < %(start_time)s
-                AND p.column_44 >= (%(start_time)s - interval '240 hour')
-                AND p.tags IS NOT NULL
-        ),
-        avg_fx_per_user AS (
-            SELECT
-                tag,
-                "user",
-                --AVG(f_x) AS avg_fx
-                (SUM(f_x)/POWER(0.8, LEAST(GREATEST(COUNT(f_x), 1.0), 3))) as avg_fx
-            FROM (
-                SELECT
-                    tag,
-                    "user",
-                    CASE
-                        WHEN timediff >= -240 AND timediff <= 0 THEN
-                            ((timediff + 24) / 24.0)+3
-                        ELSE
-                            0
-                    END AS f_x
-                FROM
-                    calculated
-            ) sub
-            WHERE f_x IS NOT NULL
-            GROUP BY
-                tag,
-                "user"
-        ),
-        total_avg_fx_per_tag AS (
-            SELECT
-                tag,
-                SUM(avg_fx) AS total_avg_fx,
-                COUNT(DISTINCT "user") AS unique_user_count
-            FROM
-                avg_fx_per_user
-            GROUP BY
-                tag
-        ),
-        final_score as (
-            SELECT
-                tag,
-                --total_avg_fx AS score, 
-                total_avg_fx - 10*unique_user_count AS score,
-                unique_user_count as users
-            FROM
-                total_avg_fx_per_tag
-            WHERE
-                (tag LIKE '%%$%%' OR tag LIKE '%%#%%' OR tag LIKE '%%@%%')
-                AND unique_user_count <= 10
-        )
-        SELECT ROW_NUMBER() OVER (ORDER BY score DESC) AS pos, * FROM final_score ORDER BY score DESC limit 20;
-        """
-
-        # Define the parameters for the query
-        params = {
-            'start_time': start_time
-        }
-
-        # Execute the query and return the DataFrame
-        df = Send_query_to_DB_silent(query, params)
-
-        if df.empty:
-            logger.warning("No results found for the given parameters")
-            return pd.DataFrame(columns=['pos', 'tag', 'score', 'users'])
-        else:
-            num_results = len(df)
-            logger.info(f"Retrieved {num_results} results")
-            return df
-
+        value = get_redis_client().get(rt_cleanup_watermark_key)
+        return dateutil_parser.isoparse(value) if value else None
     except Exception as e:
-        logger.error(f"An error occurred while retrieving results: {e}")
-        return pd.DataFrame(columns=['pos', 'tag', 'score', 'users'])
-
-def function_2():
-    query = """
-    SELECT ARRAY_AGG(DISTINCT tag) AS unique_tags
-    FROM table_8, UNNEST(tags) AS tag;
-    """
+        logger.warning(f"Could not read the RT cleanup watermark, scanning the last 24 hours: {e}")
+        return None
 
+def set_rt_cleanup_watermark(watermark):
     try:
-        logger.info("Executing query to retrieve existing tags")
-        # Execute the query and return the DataFrame
-        df = Send_query_to_DB_silent(query)
-        
-        if df.empty:
-            logger.warning("No tags found???")
-            return pd.DataFrame(columns=['unique_tags'])
-        else:
-            num_tags = len(df)
-            logger.info(f"Retrieved  {num_tags}  tags")
-            return df
-
+        get_redis_client().set(rt_cleanup_watermark_key, pd.Timestamp(watermark).isoformat())
     except Exception as e:
-        logger.error(f"An error occurred while retrieving tags: {e}")
-        return pd.DataFrame(columns=['unique_tags'])
+        logger.warning(f"Could not store the RT cleanup watermark: {e}")
 
-def function_1():
-    query = """
+FUNCTION_3_SCAN_QUERY = """
     WITH calculated AS (
         SELECT
             t.tag,
-            p.column_33 AS "user",
-            p.datetime,
-            EXTRACT(EPOCH FROM (p.datetime - (timestamp '2024-11-15 13:00:00' - interval '12 hour'))) / 3600.0 AS timediff,
+            p.column_50 AS "user",
+            p.column_44,
+            EXTRACT(EPOCH FROM (p.column_44 - %(start_time)s)) / 3600.0 AS timediff,
             p.content
         FROM
-            table_8 p
+            table_9 p
         CROSS JOIN LATERAL
             unnest(p.tags) AS t(tag)
         WHERE
-            p.datetime < (timestamp '2024-11-15 13:00:00' - interval '12 hour')
-            AND p.datetime >= (timestamp '2024-11-15 13:00:00'  - interval '12 hour') - interval '72 hour'
+            p.column_44 < %(start_time)s
+            AND p.column_44 >= (%(start_time)s - interval '240 hour')
+            AND p.tags IS NOT NULL
     ),
     avg_fx_per_user AS (
         SELECT
             tag,
             "user",
-            AVG(f_x) AS avg_fx
+            --AVG(f_x) AS avg_fx
+            (SUM(f_x)/POWER(0.8, LEAST(GREATEST(COUNT(f_x), 1.0), 3))) as avg_fx
         FROM (
             SELECT
                 tag,
                 "user",
                 CASE
-                    WHEN timediff >= -96 AND timediff < -24 THEN
-                        (3 * timediff + 3 * 72) / 72.0
-                    WHEN timediff >= -24 AND timediff <= 0 THEN
-                        POWER(1.0695, timediff) * 10
+                    WHEN timediff >= -240 AND timediff <= 0 THEN
+                        ((timediff + 24) / 24.0)+3
                     ELSE
-                        NULL
+                        0
                 END AS f_x
             FROM
                 calculated
@@ -620,20 +984,429 @@ def function_1():
         GROUP BY
             tag
     ),
-    top_tags AS (
+    final_score as (
         SELECT
-            tag
+            tag,
+            --total_avg_fx AS score, 
+            total_avg_fx - 10*unique_user_count AS score,
+            unique_user_count as users
         FROM
             total_avg_fx_per_tag
         WHERE
-            unique_user_count <= 4 AND
-            unique_user_count > 1
-        ORDER BY
-            total_avg_fx DESC
-        LIMIT 20
-    ),
-    unique_posts AS (
-        SELECT DISTINCT ON (tag, content)
+            (tag LIKE '%%$%%' OR tag LIKE '%%#%%' OR tag LIKE '%%@%%')
+            AND unique_user_count <= 10
+    )
+    SELECT ROW_NUMBER() OVER (ORDER BY score DESC) AS pos, * FROM final_score ORDER BY score DESC limit 20;
+    """
+
+# Same score computed from table_9_tag_rollup. Every post in the window has
+# f_x = ((timediff + 24) / 24) + 3 = timediff / 24 + 4, so a (tag, user) group only
+# needs its post count n and the sum of its offsets from start_time:
+#   SUM(f_x) = SUM(seconds) / 86400 + 4 * n
+# Hour buckets fully inside the window come from the rollup; the at most two
+# buckets cut by the window edges are read from table_9 directly.
+FUNCTION_3_ROLLUP_QUERY = """
+    WITH bounds AS (
+        SELECT
+            %(start_time)s AS start_time,
+            %(start_time)s - interval '240 hour' AS window_start
+    ),
+    full_buckets AS (
+        SELECT
+            r.tag,
+            r."user",
+            r.post_count AS n,
+            r.post_count * EXTRACT(EPOCH FROM (r.hour_bucket - b.start_time)) + r.offset_seconds AS seconds_sum
+        FROM
+            table_9_tag_rollup r, bounds b
+        WHERE
+            r.hour_bucket >= b.window_start
+            AND r.hour_bucket + interval '1 hour' <= b.start_time
+    ),
+    edge_posts AS (
+        SELECT
+            t.tag,
+            COALESCE(p.column_50, '') AS "user",
+            1 AS n,
+            EXTRACT(EPOCH FROM (p.column_44 - b.start_time)) AS seconds_sum
+        FROM
+            bounds b, table_9 p
+        CROSS JOIN LATERAL
+            unnest(p.tags) AS t(tag)
+        WHERE
+            p.tags IS NOT NULL
+            AND t.tag IS NOT NULL
+            AND p.column_44 < b.start_time
+            AND p.column_44 >= b.window_start
+            AND (p.column_44 < b.window_start + interval '1 hour' OR p.column_44 >= b.start_time - interval '1 hour')
+            AND NOT (date_trunc('hour', p.column_44) >= b.window_start
+                     AND date_trunc('hour', p.column_44) + interval '1 hour' <= b.start_time)
+    ),
+    per_user AS (
+        SELECT
+            tag,
+            "user",
+            SUM(n) AS n,
+            SUM(seconds_sum) AS seconds_sum
+        FROM (
+            SELECT tag, "user", n, seconds_sum FROM full_buckets
+            UNION ALL
+            SELECT tag, "user", n, seconds_sum FROM edge_posts
+        ) combined
+        GROUP BY
+            tag,
+            "user"
+        HAVING SUM(n) > 0
+    ),
+    avg_fx_per_user AS (
+        SELECT
+            tag,
+            "user",
+            ((seconds_sum / 86400.0 + 4 * n) / POWER(0.8, LEAST(GREATEST(n, 1.0), 3))) AS avg_fx
+        FROM
+            per_user
+    ),
+    total_avg_fx_per_tag AS (
+        SELECT
+            tag,
+            SUM(avg_fx) AS total_avg_fx,
+            COUNT(DISTINCT NULLIF("user", '')) AS unique_user_count
+        FROM
+            avg_fx_per_user
+        GROUP BY
+            tag
+    ),
+    final_score as (
+        SELECT
+            tag,
+            (total_avg_fx - 10*unique_user_count)::numeric AS score,
+            unique_user_count as users
+        FROM
+            total_avg_fx_per_tag
+        WHERE
+            (tag LIKE '%%$%%' OR tag LIKE '%%#%%' OR tag LIKE '%%@%%')
+            AND unique_user_count <= 10
+    )
+    SELECT ROW_NUMBER() OVER (ORDER BY score DESC) AS pos, * FROM final_score ORDER BY score DESC limit 20;
+    """
+
+def function_3(tag_5_time_str, source=None):
+    """
+    Retrieves the top 20 results by score from the datatag_5.
+
+    Parameters:
+    - tag_5_time_str (str): tag_5 time as a string in 'YYYY-MM-DD HH:MM:SS' format.
+    - source (str): 'scan' to aggregate table_9 directly or 'rollup' to read
+      table_9_tag_rollup. Defaults to TREND_SCORE_SOURCE.
+
+    Returns:
+    - pd.DataFrame: DataFrame containing the top 20 results.
+    """
+    source = source or trend_score_source
+    try:
+        logger.info(f"Executing query to retrieve top 20 results by score ({source})")
+
+        # Convert tag_5_time_str to datetime
+        tag_5_time = datetime.strptime(tag_5_time_str, '%Y-%m-%d %H:%M:%S')
+        start_time = tag_5_time
+
+        # Prepare the SQL query
+        query = FUNCTION_3_ROLLUP_QUERY if source == 'rollup' else FUNCTION_3_SCAN_QUERY
+
+        # Define the parameters for the query
+        params = {
+            'start_time': start_time
+        }
+
+        # Execute the query and return the DataFrame
+        df = Send_query_to_DB_silent(query, params)
+
+        if df.empty:
+            logger.warning("No results found for the given parameters")
+            return pd.DataFrame(columns=['pos', 'tag', 'score', 'users'])
+        else:
+            num_results = len(df)
+            logger.info(f"Retrieved {num_results} results")
+            return df
+
+    except Exception as e:
+        logger.error(f"An error occurred while retrieving results: {e}")
+        return pd.DataFrame(columns=['pos', 'tag', 'score', 'users'])
+
+#-------------------------- TREND ROLLUP ----------------------------
+
+# Hourly per-(tag, user) aggregate of table_9 maintained by triggers, so every
+# insert/update/delete of tags applies its delta in the same transaction.
+# hour_bucket takes the type of column_44 so date_trunc matches the raw query.
+TAG_ROLLUP_DDL = """
+    CREATE TABLE IF NOT EXISTS table_9_tag_rollup (
+        tag text NOT NULL,
+        "user" text NOT NULL,
+        hour_bucket {ts_type} NOT NULL,
+        post_count bigint NOT NULL,
+        offset_seconds double precision NOT NULL,
+        PRIMARY KEY (tag, "user", hour_bucket)
+    );
+
+    CREATE INDEX IF NOT EXISTS table_9_tag_rollup_hour_idx ON table_9_tag_rollup (hour_bucket);
+
+    CREATE OR REPLACE FUNCTION table_9_tag_rollup_apply(p_tags text[], p_user text, p_ts {ts_type}, p_sign integer)
+    RETURNS void AS $$
+    BEGIN
+        IF p_tags IS NULL OR p_ts IS NULL THEN
+            RETURN;
+        END IF;
+        INSERT INTO table_9_tag_rollup AS r (tag, "user", hour_bucket, post_count, offset_seconds)
+        SELECT
+            t.tag,
+            COALESCE(p_user, ''),
+            date_trunc('hour', p_ts),
+            p_sign * COUNT(*),
+            p_sign * COUNT(*) * EXTRACT(EPOCH FROM (p_ts - date_trunc('hour', p_ts)))
+        FROM unnest(p_tags) AS t(tag)
+        WHERE t.tag IS NOT NULL
+        GROUP BY t.tag
+        ON CONFLICT (tag, "user", hour_bucket) DO UPDATE
+        SET post_count = r.post_count + EXCLUDED.post_count,
+            offset_seconds = r.offset_seconds + EXCLUDED.offset_seconds;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION table_9_tag_rollup_maintain()
+    RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM table_9_tag_rollup_apply(OLD.tags, OLD.column_50, OLD.column_44, -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM table_9_tag_rollup_apply(NEW.tags, NEW.column_50, NEW.column_44, 1);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS table_9_tag_rollup_write ON table_9;
+    CREATE TRIGGER table_9_tag_rollup_write
+    AFTER INSERT OR DELETE ON table_9
+    FOR EACH ROW EXECUTE FUNCTION table_9_tag_rollup_maintain();
+
+    DROP TRIGGER IF EXISTS table_9_tag_rollup_update ON table_9;
+    CREATE TRIGGER table_9_tag_rollup_update
+    AFTER UPDATE OF tags, column_44, column_50 ON table_9
+    FOR EACH ROW
+    WHEN (OLD.tags IS DISTINCT FROM NEW.tags
+          OR OLD.column_44 IS DISTINCT FROM NEW.column_44
+          OR OLD.column_50 IS DISTINCT FROM NEW.column_50)
+    EXECUTE FUNCTION table_9_tag_rollup_maintain();
+    """
+
+TAG_ROLLUP_BACKFILL_QUERY = """
+    INSERT INTO table_9_tag_rollup (tag, "user", hour_bucket, post_count, offset_seconds)
+    SELECT
+        t.tag,
+        COALESCE(p.column_50, ''),
+        date_trunc('hour', p.column_44),
+        COUNT(*),
+        SUM(EXTRACT(EPOCH FROM (p.column_44 - date_trunc('hour', p.column_44))))
+    FROM
+        table_9 p
+    CROSS JOIN LATERAL
+        unnest(p.tags) AS t(tag)
+    WHERE
+        p.tags IS NOT NULL
+        AND t.tag IS NOT NULL
+        AND p.column_44 IS NOT NULL
+    GROUP BY
+        1, 2, 3;
+    """
+
+def install_tag_rollup():
+    """
+    Creates table_9_tag_rollup and the triggers that keep it current, then
+    backfills it from table_9. Safe to run again; the backfill starts from scratch.
+
+    Returns:
+    - int: Number of rollup rows written by the backfill.
+    """
+    ts_type = get_table_column_types('table_9').get('column_44', 'timestamp')
+    logger.info(f"Installing table_9_tag_rollup (hour_bucket {ts_type})")
+    with get_connection() as connection:
+        connection.execute(TAG_ROLLUP_DDL.format(ts_type=ts_type))
+    return backfill_tag_rollup()
+
+def backfill_tag_rollup():
+    """
+    Rebuilds table_9_tag_rollup from table_9 in one transaction. Writes to table_9
+    are blocked meanwhile so no trigger delta is lost between the two steps.
+
+    Returns:
+    - int: Number of rollup rows written.
+    """
+    start = time.time()
+    with get_connection() as connection:
+        with connection.transaction():
+            connection.execute("LOCK TABLE table_9 IN SHARE MODE")
+            connection.execute("TRUNCATE table_9_tag_rollup")
+            rows = connection.execute(TAG_ROLLUP_BACKFILL_QUERY).rowcount
+    logger.info(f"Backfilled {rows} rollup rows in {time.time() - start:.1f}s")
+    return rows
+
+def prune_tag_rollup(retention_hours=None):
+    """
+    Deletes rollup rows emptied by deletes/retags and buckets older than
+    retention_hours (TAG_ROLLUP_RETENTION_HOURS), which no trend query reads.
+
+    Returns:
+    - int: Number of rollup rows removed.
+    """
+    retention_hours = retention_hours or tag_rollup_retention_hours
+    query = """
+    DELETE FROM table_9_tag_rollup
+    WHERE post_count = 0
+       OR hour_bucket < now() - make_interval(hours => %(hours)s);
+    """
+    with get_connection() as connection:
+        rows = connection.execute(query, {'hours': retention_hours}).rowcount
+    logger.info(f"Pruned {rows} rollup rows")
+    return rows
+
+def prune_tag_rollup_if_due(redis_client):
+    """
+    Runs prune_tag_rollup at most once per TAG_ROLLUP_PRUNE_INTERVAL across all
+    tagger processes: only the run that sets the Redis marker prunes.
+    post_labeling_program calls it after every run while TREND_SCORE_SOURCE is 'rollup'.
+
+    Returns:
+    - int: Number of rollup rows removed, None if no prune was due.
+    """
+    if not redis_client.set(tag_rollup_prune_key, datetime.now().isoformat(), nx=True, ex=tag_rollup_prune_interval):
+        return None
+    return prune_tag_rollup()
+
+def check_tag_rollup(tag_5_time_str=None, tolerance=1e-6):
+    """
+    Compares the rollup-based top 20 against the scan query for the same time.
+
+    Parameters:
+    - tag_5_time_str (str): Time to score at, 'YYYY-MM-DD HH:MM:SS'. Defaults to now.
+    - tolerance (float): Allowed relative difference between scores.
+
+    Returns:
+    - bool: True if both queries return the same tags, user counts and scores.
+    """
+    tag_5_time_str = tag_5_time_str or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    scan = function_3(tag_5_time_str, source='scan')
+    rollup = function_3(tag_5_time_str, source='rollup')
+
+    scan_scores = {row.tag: (float(row.score), int(row.users)) for row in scan.itertuples()}
+    rollup_scores = {row.tag: (float(row.score), int(row.users)) for row in rollup.itertuples()}
+
+    mismatches = []
+    for tag in sorted(scan_scores.keys() | rollup_scores.keys()):
+        expected = scan_scores.get(tag)
+        actual = rollup_scores.get(tag)
+        if expected is None or actual is None:
+            mismatches.append(f"{tag}: scan={expected} rollup={actual}")
+        elif expected[1] != actual[1] or abs(expected[0] - actual[0]) > tolerance * max(1.0, abs(expected[0])):
+            mismatches.append(f"{tag}: scan={expected} rollup={actual}")
+
+    if mismatches:
+        logger.error(f"Rollup check at {tag_5_time_str} found {len(mismatches)} mismatches: " + "; ".join(mismatches))
+        return False
+    logger.info(f"Rollup check at {tag_5_time_str} passed for {len(scan_scores)} tags")
+    return True
+
+def function_2():
+    query = """
+    SELECT ARRAY_AGG(DISTINCT tag) AS unique_tags
+    FROM table_8, UNNEST(tags) AS tag;
+    """
+
+    try:
+        logger.info("Executing query to retrieve existing tags")
+        # Execute the query and return the DataFrame
+        df = Send_query_to_DB_silent(query)
+        
+        if df.empty:
+            logger.warning("No tags found???")
+            return pd.DataFrame(columns=['unique_tags'])
+        else:
+            num_tags = len(df)
+            logger.info(f"Retrieved  {num_tags}  tags")
+            return df
+
+    except Exception as e:
+        logger.error(f"An error occurred while retrieving tags: {e}")
+        return pd.DataFrame(columns=['unique_tags'])
+
+# As-of time function_1 has always been evaluated at; pass as_of to score another time
+FUNCTION_1_AS_OF = '2024-11-15 13:00:00'
+
+FUNCTION_1_QUERY = """
+    WITH calculated AS (
+        SELECT
+            t.tag,
+            p.column_33 AS "user",
+            p.datetime,
+            EXTRACT(EPOCH FROM (p.datetime - (%(as_of)s::timestamp - interval '12 hour'))) / 3600.0 AS timediff,
+            p.content
+        FROM
+            table_8 p
+        CROSS JOIN LATERAL
+            unnest(p.tags) AS t(tag)
+        WHERE
+            p.datetime < (%(as_of)s::timestamp - interval '12 hour')
+            AND p.datetime >= (%(as_of)s::timestamp  - interval '12 hour') - interval '72 hour'
+    ),
+    avg_fx_per_user AS (
+        SELECT
+            tag,
+            "user",
+            AVG(f_x) AS avg_fx
+        FROM (
+            SELECT
+                tag,
+                "user",
+                CASE
+                    WHEN timediff >= -96 AND timediff < -24 THEN
+                        (3 * timediff + 3 * 72) / 72.0
+                    WHEN timediff >= -24 AND timediff <= 0 THEN
+                        POWER(1.0695, timediff) * 10
+                    ELSE
+                        NULL
+                END AS f_x
+            FROM
+                calculated
+        ) sub
+        WHERE f_x IS NOT NULL
+        GROUP BY
+            tag,
+            "user"
+    ),
+    total_avg_fx_per_tag AS (
+        SELECT
+            tag,
+            SUM(avg_fx) AS total_avg_fx,
+            COUNT(DISTINCT "user") AS unique_user_count
+        FROM
+            avg_fx_per_user
+        GROUP BY
+            tag
+    ),
+    top_tags AS (
+        SELECT
+            tag
+        FROM
+            total_avg_fx_per_tag
+        WHERE
+            unique_user_count <= 4 AND
+            unique_user_count > 1
+        ORDER BY
+            total_avg_fx DESC
+        LIMIT 20
+    ),
+    unique_posts AS (
+        SELECT DISTINCT ON (tag, content)
             tag,
             p.content,
             p.column_33 AS "user",
@@ -644,8 +1417,8 @@ def function_1():
             unnest(p.tags) AS t(tag)
         WHERE
             t.tag IN (SELECT tag FROM top_tags)
-            AND p.datetime < (timestamp '2024-11-15 13:00:00' - interval '12 hour')
-            AND p.datetime >= (timestamp '2024-11-15 13:00:00' - interval '12 hour') - interval '72 hour'
+            AND p.datetime < (%(as_of)s::timestamp - interval '12 hour')
+            AND p.datetime >= (%(as_of)s::timestamp - interval '12 hour') - interval '72 hour'
         ORDER BY
             tag, content, p.datetime DESC
     )
@@ -661,117 +1434,1727 @@ def function_1():
     ORDER BY
         tag;
     """
+
+def iter_function_1(itersize=None, as_of=None):
+    """
+    Streams the function_1 result as TagPostsRecord rows, one tag at a time.
+    """
+    params = {'as_of': as_of or FUNCTION_1_AS_OF}
+    for rows in stream_query_from_DB(FUNCTION_1_QUERY, params, itersize=itersize, row_factory=psycopg_rows.class_row(TagPostsRecord)):
+        yield from rows
+
+def function_1(as_of=None):
+    """
+    Retrieves the posts of the top 20 tags of table_8.
+
+    Parameters:
+    - as_of (str): Time to score at, 'YYYY-MM-DD HH:MM:SS'. Defaults to FUNCTION_1_AS_OF.
+    """
+    query = FUNCTION_1_QUERY
+    params = {'as_of': as_of or FUNCTION_1_AS_OF}
     try:
         logger.info("Executing query to retrieve posts with top20 tags")
-        # Execute the query and return the DataFrame
-        df = Send_query_to_DB_silent(query)
+        # Execute the query and return the DataFrame, streamed to keep the post arrays from being held twice
+        df = Send_query_to_DB_columnar(query, params)
         
         if df.empty:
             logger.warning("No posts found???")
             return pd.DataFrame(columns=['tag', 'posts', 'users', 'post_dates'])
         else:
-            num_tags = len(df)
-            logger.info(f"Retrieved  {num_tags}  tags with posts 72 hour period")
-            return df
+            num_tags = len(df)
+            logger.info(f"Retrieved  {num_tags}  tags with posts 72 hour period")
+            return df
+
+    except Exception as e:
+        logger.error(f"An error occurred while retrieving posts with tags: {e}")
+        return pd.DataFrame(columns=['tag', 'posts', 'users', 'post_dates'])
+
+#-------------------------- TREND BACKTEST ----------------------------
+
+# (tag, user, timestamp) triples behind each trend score. start/end bound the
+# timestamps so one load covers every window of the backtest grid.
+TREND_TRIPLES_QUERIES = {
+    'function_3': """
+    SELECT t.tag, p.column_50 AS "user", p.column_44 AS ts
+    FROM table_9 p
+    CROSS JOIN LATERAL unnest(p.tags) AS t(tag)
+    WHERE p.column_44 >= %(start)s AND p.column_44 < %(end)s
+      AND p.tags IS NOT NULL AND t.tag IS NOT NULL;
+    """,
+    'function_1': """
+    SELECT t.tag, p.column_33 AS "user", p.datetime AS ts
+    FROM table_8 p
+    CROSS JOIN LATERAL unnest(p.tags) AS t(tag)
+    WHERE p.datetime >= %(start)s AND p.datetime < %(end)s
+      AND t.tag IS NOT NULL;
+    """,
+}
+
+# Window of each score relative to its as-of time, in hours: rows with
+# timestamp in [as_of - before, as_of - after) are scored
+TREND_WINDOWS = {
+    'function_3': (240, 0),
+    'function_1': (84, 12),
+}
+
+class TrendBacktest:
+    """
+    In-memory copy of the trend score inputs for offline evaluation of
+    function_3 / function_1 over a whole grid of as-of times.
+
+    Tags, users and groups are integer coded and the rows are sorted by
+    (tag, user, timestamp), so for every as-of time the window of each group
+    is a slice found by binary search. Both formulas reduce to counts, prefix
+    sums of timestamps and prefix sums of exponential weights over those
+    slices, which are evaluated for a chunk of as-of times at once.
+
+    Timestamps are naive; timezone-aware input is converted to UTC.
+    """
+
+    def __init__(self, tags, users, timestamps):
+        frame = pd.DataFrame({'tag': tags, 'user': users, 'ts': pd.to_datetime(timestamps, utc=True)})
+        frame = frame.dropna(subset=['tag', 'ts'])
+
+        tag_codes, self.tag_names = pd.factorize(frame['tag'], sort=True)
+        user_codes, self.user_names = pd.factorize(frame['user'])      # -1 for a missing user
+        seconds = frame['ts'].dt.tz_localize(None).to_numpy('datetime64[s]').astype(np.int64)
+
+        # Group id orders by tag first, so the groups of one tag are adjacent
+        raw_groups = tag_codes.astype(np.int64) * (len(self.user_names) + 1) + user_codes + 1
+        group_keys, group_codes = np.unique(raw_groups, return_inverse=True)
+        self.group_tags = group_keys // (len(self.user_names) + 1)
+        self.group_has_user = group_keys % (len(self.user_names) + 1) != 0
+
+        order = np.lexsort((seconds, group_codes))
+        self.group_codes = group_codes[order]
+        self.seconds = seconds[order]
+        self.tag_names = np.asarray(self.tag_names, dtype=object)
+        self.tag_is_trend = np.array(['$' in tag or '#' in tag or '@' in tag for tag in self.tag_names], dtype=bool)
+        logger.info(f"Backtest loaded {len(self.seconds)} rows, {len(self.tag_names)} tags, {len(group_keys)} (tag, user) groups")
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def _chunks(self, as_of, before, after, chunk_size):
+        """
+        Yields (as_of chunk, window) pairs. window slices the rows that any
+        as-of time of the chunk can see.
+        """
+        for start in range(0, len(as_of), chunk_size):
+            chunk = as_of[start:start + chunk_size]
+            yield chunk, _TrendWindow(self, chunk[0] - before, chunk[-1] - after)
+
+    def score_function_3(self, as_of_times, top_k=20, chunk_size=24):
+        """
+        function_3 score for every as-of time: per (tag, user) the sum of
+        f_x = ((timediff + 24) / 24) + 3 damped by 0.8^min(n, 3), summed per tag,
+        minus 10 per distinct user, for $/#/@ tags with at most 10 users.
+
+        Returns:
+        - pd.DataFrame: as_of, pos, tag, score, users for the top_k tags of each as-of time.
+        """
+        as_of = to_epoch_seconds(as_of_times)
+        before, after = (hours * 3600 for hours in TREND_WINDOWS['function_3'])
+        results = []
+        for chunk, window in self._chunks(as_of, before, after, chunk_size):
+            lo = window.bounds(chunk - before)
+            hi = window.bounds(chunk - after)
+            n = hi - lo
+            # SUM(timediff) in hours from prefix sums of the row timestamps
+            timediff_sum = (window.sum_seconds(lo, hi) - n * (chunk - window.origin)[None, :]) / 3600.0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg_fx = (timediff_sum / 24.0 + 4 * n) / np.power(0.8, np.clip(n, 1, 3))
+            avg_fx = np.where(n > 0, avg_fx, 0.0)
+
+            tags, total, users, rows = window.per_tag(avg_fx, n)
+            score = total - 10 * users
+            eligible = (rows > 0) & self.tag_is_trend[tags][:, None] & (users <= 10)
+            results.append(self._top_k(chunk, tags, score, users, eligible, top_k))
+        return self._frame(results)
+
+    def score_function_1(self, as_of_times, top_k=20, chunk_size=24):
+        """
+        function_1 tag ranking for every as-of time: per (tag, user) the
+        average of f_x over the 72 hours before as_of - 12h, linear
+        (3 * timediff + 216) / 72 up to 24 hours back and 10 * 1.0695^timediff
+        after, summed per tag, for tags used by 2 to 4 users.
+
+        Returns:
+        - pd.DataFrame: as_of, pos, tag, score, users for the top_k tags of each as-of time.
+        """
+        as_of = to_epoch_seconds(as_of_times)
+        before, after = (hours * 3600 for hours in TREND_WINDOWS['function_1'])
+        results = []
+        for chunk, window in self._chunks(as_of, before, after, chunk_size):
+            reference = chunk - after                   # timediff is measured from as_of - 12h
+            lo = window.bounds(chunk - before)
+            mid = window.bounds(reference - 24 * 3600)
+            hi = window.bounds(reference)
+            n = hi - lo
+            linear_n = mid - lo
+            linear_timediff = (window.sum_seconds(lo, mid) - linear_n * (reference - window.origin)[None, :]) / 3600.0
+            linear_sum = (3 * linear_timediff + 216 * linear_n) / 72.0
+            # 1.0695^timediff = 1.0695^((ts - end) / 3600) * 1.0695^((end - reference) / 3600)
+            decay_sum = window.sum_decay(mid, hi, 1.0695) * np.power(1.0695, (window.end - reference) / 3600.0)[None, :]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg_fx = np.where(n > 0, (linear_sum + 10 * decay_sum) / n, 0.0)
+
+            tags, total, users, rows = window.per_tag(avg_fx, n)
+            eligible = (rows > 0) & (users > 1) & (users <= 4)
+            results.append(self._top_k(chunk, tags, total, users, eligible, top_k))
+        return self._frame(results)
+
+    def _top_k(self, chunk, tags, score, users, eligible, top_k):
+        ranked = np.where(eligible, score, -np.inf)
+        order = np.argsort(-ranked, axis=0, kind='stable')[:top_k]
+        rows = []
+        for column, as_of in enumerate(chunk):
+            for pos, index in enumerate(order[:, column], start=1):
+                if not eligible[index, column]:
+                    break
+                rows.append((as_of, pos, self.tag_names[tags[index]], score[index, column], int(users[index, column])))
+        return rows
+
+    @staticmethod
+    def _frame(results):
+        df = pd.DataFrame([row for rows in results for row in rows], columns=['as_of', 'pos', 'tag', 'score', 'users'])
+        df['as_of'] = pd.to_datetime(df['as_of'], unit='s')
+        return df
+
+class _TrendWindow:
+    """
+    Rows of a TrendBacktest with timestamps in [origin, end), re-coded so the
+    groups present are 0..k-1 and a (group, second) pair maps to one sorted key.
+    """
+
+    def __init__(self, backtest, origin, end):
+        mask = (backtest.seconds >= origin) & (backtest.seconds < end)
+        self.backtest = backtest
+        self.origin = origin
+        self.end = end
+        self.stride = end - origin + 1
+        self.groups, local = np.unique(backtest.group_codes[mask], return_inverse=True)
+        offsets = backtest.seconds[mask] - origin
+        self.keys = local * self.stride + offsets
+        self.offsets = offsets
+        self.seconds_prefix = np.concatenate(([0.0], np.cumsum(offsets, dtype=np.float64)))
+        self.decay_prefix = {}
+
+    def bounds(self, boundaries):
+        """
+        Index of the first row at or after each boundary, per group: shape (groups, len(boundaries)).
+        """
+        queries = np.arange(len(self.groups), dtype=np.int64)[:, None] * self.stride + (boundaries - self.origin)[None, :]
+        return np.searchsorted(self.keys, queries, side='left')
+
+    def sum_seconds(self, lo, hi):
+        """Sum of (timestamp - origin) over rows [lo, hi)."""
+        return self.seconds_prefix[hi] - self.seconds_prefix[lo]
+
+    def sum_decay(self, lo, hi, base):
+        """Sum of base^((timestamp - end) / 3600) over rows [lo, hi)."""
+        if base not in self.decay_prefix:
+            weights = np.power(base, (self.offsets - (self.end - self.origin)) / 3600.0)
+            self.decay_prefix[base] = np.concatenate(([0.0], np.cumsum(weights)))
+        prefix = self.decay_prefix[base]
+        return prefix[hi] - prefix[lo]
+
+    def per_tag(self, values, n):
+        """
+        Sums per-group values up to tags. Returns (tag codes, total, distinct
+        users, row count), each of shape (tags, as-of times) except the codes.
+        """
+        if len(self.groups) == 0:
+            empty = np.zeros((0, n.shape[1]))
+            return np.zeros(0, dtype=np.int64), empty, empty, empty
+        group_tags = self.backtest.group_tags[self.groups]
+        starts = np.flatnonzero(np.r_[True, group_tags[1:] != group_tags[:-1]])
+        has_user = self.backtest.group_has_user[self.groups][:, None]
+        total = np.add.reduceat(values, starts, axis=0)
+        users = np.add.reduceat((n > 0) & has_user, starts, axis=0)
+        rows = np.add.reduceat(n, starts, axis=0)
+        return group_tags[starts], total, users, rows
+
+def to_epoch_seconds(times):
+    """
+    Converts 'YYYY-MM-DD HH:MM:SS' strings / datetimes to sorted int64 epoch seconds.
+    """
+    return np.sort(pd.to_datetime(pd.Series(times)).to_numpy('datetime64[s]').astype(np.int64))
+
+def load_trend_backtest(source, start_time_str, end_time_str):
+    """
+    Loads the rows needed to score source ('function_3' or 'function_1') at
+    any as-of time between start and end, with one streaming query.
+
+    Returns:
+    - TrendBacktest
+    """
+    before, after = TREND_WINDOWS[source]
+    start = datetime.strptime(start_time_str, '%Y-%m-%d %H:%M:%S') - timedelta(hours=before)
+    end = datetime.strptime(end_time_str, '%Y-%m-%d %H:%M:%S') - timedelta(hours=after)
+    logger.info(f"Loading {source} backtest rows between {start} and {end}")
+    df = Send_query_to_DB_columnar(TREND_TRIPLES_QUERIES[source], {'start': start, 'end': end})
+    if df.empty:
+        df = pd.DataFrame(columns=['tag', 'user', 'ts'])
+    return TrendBacktest(df['tag'], df['user'], df['ts'])
+
+def backtest_trends(source, start_time_str, end_time_str, step_hours=1, top_k=20):
+    """
+    Top-k tags of source at every step_hours between start and end (inclusive).
+
+    Returns:
+    - pd.DataFrame: as_of, pos, tag, score, users.
+    """
+    as_of_times = pd.date_range(start_time_str, end_time_str, freq=pd.Timedelta(hours=step_hours))
+    backtest = load_trend_backtest(source, start_time_str, end_time_str)
+    start = time.time()
+    if source == 'function_3':
+        df = backtest.score_function_3(as_of_times, top_k=top_k)
+    else:
+        df = backtest.score_function_1(as_of_times, top_k=top_k)
+    logger.info(f"Scored {len(as_of_times)} as-of times in {time.time() - start:.2f}s")
+    return df
+
+#-------------------------- TOKEN ACCOUNTING ----------------------------
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+def get_token_encoding():
+    """
+    Returns the tiktoken encoding, loaded once per process.
+    Returns None if it cannot be loaded (e.g. no network to fetch the BPE file),
+    in which case token counts fall back to a characters/4 estimate.
+    """
+    global _token_encoding
+    if _token_encoding is None:
+        with _token_encoding_lock:
+            if _token_encoding is None:
+                try:
+                    _token_encoding = tiktoken.get_encoding(tiktoken_encoding_name)
+                except Exception as e:
+                    logger.warning(f"tiktoken encoding '{tiktoken_encoding_name}' unavailable, estimating tokens from length: {e}")
+                    _token_encoding = False
+    return _token_encoding or None
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages):
+    # ~4 tokens of chat-template overhead per message plus the reply primer
+    return sum(count_tokens(message['content']) + 4 for message in messages) + 2
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ''
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+class TokenUsage:
+    """
+    Thread-safe totals of LLM requests, tokens and time spent waiting on the LLM.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.llm_seconds = 0.0
+            self.started_at = time.time()
+
+    def record(self, prompt_tokens, completion_tokens, elapsed):
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.llm_seconds += elapsed
+
+    def log_summary(self, label='Run'):
+        with self._lock:
+            wall_time = max(time.time() - self.started_at, 1e-9)
+            total_tokens = self.prompt_tokens + self.completion_tokens
+            logger.info(
+                f"{label} token usage: {self.requests} requests, {self.prompt_tokens} prompt + "
+                f"{self.completion_tokens} completion = {total_tokens} tokens, "
+                f"{total_tokens / wall_time:.1f} tokens/sec, {self.completion_tokens / wall_time:.1f} completion tokens/sec"
+            )
+
+# Totals for the current run, reset by post_labeling_program and summarise_top_tags
+token_usage = TokenUsage()
+
+def chat_completion(messages, **kwargs):
+    """
+    Sends a chat completion to the LLM server and records its token usage.
+    The server-reported usage is used when present, otherwise tokens are counted locally.
+    """
+    started = time.time()
+    response = get_llm_client().chat.completions.create(model=llm_model, messages=messages, **kwargs)
+    elapsed = time.time() - started
+    observe_stage('llm', elapsed)
+
+    usage = getattr(response, 'usage', None)
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    completion_tokens = getattr(usage, 'completion_tokens', None)
+    if prompt_tokens is None:
+        prompt_tokens = count_message_tokens(messages)
+    if completion_tokens is None:
+        completion_tokens = count_tokens(response.choices[0].message.content)
+    token_usage.record(prompt_tokens, completion_tokens, elapsed)
+    return response
+
+TAGGING_SYSTEM_PROMPT = """
+    Assign the most accurate tags for a give tweet about tag_25. If the very similar tag already exists in Existing_Tags, use that one. If tweet contains a column_14 (starts with ====) ALWAYS extract the column_14 as a tag in small letters. If tweet has a hashtag (starts with #) ALWAYS collect the hashtag. If tweet has a handle (starts with @) ALWAYS collect the handle. try to find and identify names of the tag_25 and save them as well. Do not use tags from Banned_Tags list.
+    Existing_Tags: ["tag_1", "tag_2", "tag_3", "tag_4", "tag_5", "tag_6", "tag_7", "tag_8", "tag_9", "tag_10", "tag_11", "tag_12"]
+    Banned_Tags: ["tag_25", "tag_27"]
+    Examples:
+    1.
+        Tweet: "Imagine that the king of #hashtag_1 tag_13 will hit $1+ this cycle and the king of AI tag_14 will hit $5K.
+            The two biggest column_12s: AI + hashtag_1. @handle_1"
+        Output: { "tags": ["tag_13", "tag_14", "ai", "tag_15", "@handle_1", "#hashtag_1"] }
+    2.
+        Tweet: "Welcome to the $PNUT fam."
+        Output: { "tags": ["$pnut"] }
+    3.
+        Tweet: "tag_16 continues to make new highs. tag_17 is the biggest tag_15 on #hashtag_2. tag_18 is my favorite runner up after tag_17.
+            Both will send hard this cycle."
+        Output: { "tags": ["#hashtag_2", "tag_16", "tag_15", "tag_17", "tag_18"] }
+    4.
+        Tweet: "tag_19 IS DESTINED FOR 1 BILLION."
+        Output: { "tags": ["tag_19"] }
+    5.
+        Tweet: "@handle_2 predicted that tag_5 is going to kick off in a big way, The #tag_6 tag_20 has been designed specifically to onboard new retail. Currently accumulating a bunch of tag_5 hashtag_1 including this one $tag_9 - any pullbacks into blue ill be adding"
+        Output: { "tags": ["tag_5", "tag_6", "tag_20", "$tag_9", "#tag_6", "@handle_2"] }
+    6.
+        Tweet: "tag_21 I think you know what’s about to happen "
+        Output: { "tags": ["tag_22", "tag_21"] }
+    7.
+        Tweet: "This 440 point move on tag_23 was shared in the Hedge Experimental zone. 
+            tag_9 signals or conservative scalps on big caps, we’ve got you covered. 
+            Sign up for our automation: https://tag_24.finance
+            tag_26 #tag_24"
+        Output: { "tags": ["tag_25", "tag_23", "tag_24", "tag_9", "tag_26", "#tag_24"] }
+    8.
+        Tweet: "Zero1 Labs is excited to unveil our v2 token vision next week.
+            A bold step forward for the only community-run and launched AI ecosystem.
+            tag_28 will be the primary asset driving decentralized AI, supporting both tag_29 and tag_30s.
+            The first PoS chain with full…"
+        Output: { "tags": ["tag_28", "tag_29", "tag_30", "tag_31", "tag_32", "ai", "pos"] }
+    9.
+        Tweet: "tag_6 and tag_7 to list #moodeng"
+        Output: { "tags": ["moodeng", "tag_6", "tag_7"]
+    """
+
+TAGGING_OUTPUT_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tags_schema",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "tags": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                        "pattern": "^[a-z0-9 @#$_]+$"
+                    },
+                    "minItems": 1,
+                    "maxItems": 17
+                }
+            },
+            "required": ["tags"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def request_tags(content, timeout=None):
+    """
+    Asks the LLM for the tags of a single tweet.
+
+    Parameters:
+    - content (str): Tweet text.
+    - timeout (float): Per-request timeout in seconds, defaults to llm_request_timeout.
+
+    Returns:
+    - list of unique tags, or None if the response could not be parsed.
+    """
+    user_prompt = f"""
+    Tweet: {content}
+    """
+    
+    response = chat_completion(
+      messages=[
+        {"role": "system", "content": TAGGING_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+      ],
+      response_format=TAGGING_OUTPUT_SCHEMA,
+      temperature=0.3,
+      timeout=timeout if timeout is not None else llm_request_timeout,
+    )
+    resp_content = response.choices[0].message.content
+    try:
+        extracted_json = json.loads(resp_content)
+        tags = extracted_json.get("tags", [])
+        unique_tags = list(set(tags))  # Convert the set back to a list
+        #logger.info(f"{unique_tags}")
+        return unique_tags
+    except json.JSONDecodeError as e:
+        logger.error(f"Error parsing JSON: {e}")
+        return None
+
+BATCH_TAGGING_INSTRUCTIONS = """
+    You will receive several tweets as a JSON list, each with a numeric id. Tag every tweet independently, following the rules and examples above.
+    Return exactly one entry per tweet with the same id: { "results": [{ "id": 1, "tags": [...] }, { "id": 2, "tags": [...] }] }
+    """
+
+TAG_PATTERN = re.compile(TAGGING_OUTPUT_SCHEMA['json_schema']['schema']['properties']['tags']['items']['pattern'])
+
+def batch_output_schema(size):
+    tags_schema = TAGGING_OUTPUT_SCHEMA['json_schema']['schema']['properties']['tags']
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "batch_tags_schema",
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "id": {"type": "integer"},
+                                "tags": tags_schema
+                            },
+                            "required": ["id", "tags"],
+                            "additionalProperties": False
+                        },
+                        "minItems": size,
+                        "maxItems": size
+                    }
+                },
+                "required": ["results"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+def request_tags_batch(contents, timeout=None):
+    """
+    Asks the LLM for the tags of several tweets in one request, so the long
+    system prompt is prefilled once per batch instead of once per tweet.
+
+    Parameters:
+    - contents (list of str): Tweet texts, their position is used as the item id.
+    - timeout (float): Per-request timeout in seconds, defaults to llm_request_timeout.
+
+    Returns:
+    - dict {position: list of unique tags} for every item that came back valid.
+      Missing, duplicated or malformed items are left out.
+    """
+    items = [{"id": position, "tweet": content} for position, content in enumerate(contents)]
+    user_prompt = f"""
+    Tweets: {json.dumps(items, ensure_ascii=False)}
+    """
+    response = chat_completion(
+      messages=[
+        {"role": "system", "content": TAGGING_SYSTEM_PROMPT + BATCH_TAGGING_INSTRUCTIONS},
+        {"role": "user", "content": user_prompt}
+      ],
+      response_format=batch_output_schema(len(contents)),
+      temperature=0.3,
+      timeout=timeout if timeout is not None else llm_request_timeout,
+    )
+    resp_content = response.choices[0].message.content
+    try:
+        results = json.loads(resp_content).get("results", [])
+    except (json.JSONDecodeError, AttributeError) as e:
+        logger.error(f"Error parsing batch JSON: {e}")
+        return {}
+
+    tags_by_position = {}
+    for result in results if isinstance(results, list) else []:
+        if not isinstance(result, dict):
+            continue
+        position = result.get("id")
+        tags = result.get("tags")
+        if not isinstance(position, int) or not 0 <= position < len(contents) or position in tags_by_position:
+            continue
+        if not isinstance(tags, list) or not tags:
+            continue
+        if not all(isinstance(tag, str) and TAG_PATTERN.match(tag) for tag in tags):
+            continue
+        tags_by_position[position] = list(set(tags))
+    return tags_by_position
+
+def request_tags_for_chunk(contents, timeout=None):
+    """
+    Tags a chunk of tweets with one batched request and falls back to
+    single-tweet requests for the items that did not come back valid.
+
+    Returns:
+    - dict {content: list of tags or None}
+    """
+    tagged = {}
+    if len(contents) > 1:
+        try:
+            batch_tags = request_tags_batch(contents, timeout=timeout)
+        except Exception as e:
+            logger.error(f"Batched tagging request for {len(contents)} tweets failed: {e}")
+            batch_tags = {}
+        for position, tags in batch_tags.items():
+            tagged[contents[position]] = tags
+        missing = len(contents) - len(tagged)
+        if missing:
+            logger.warning(f"Batched tagging returned {missing} of {len(contents)} tweets missing or malformed, retrying them one by one")
+
+    for content in contents:
+        if content in tagged:
+            continue
+        try:
+            tagged[content] = request_tags(content, timeout=timeout)
+        except Exception as e:
+            logger.error(f"Error tagging tweet: {e}")
+            tagged[content] = None
+    return tagged
+
+def update_tags(row, timeout=None):
+    tags = request_tags(row['content'], timeout=timeout)
+    if tags is not None:
+        row['tags'] = tags  # Assign the list to row['tags']
+    return row
+
+#-------------------------- TAG CACHE ----------------------------
+RT_PREFIX_PATTERN = re.compile(r'^RT @[A-Za-z0-9_]+:\s*')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_content(content):
+    """
+    Normalizes tweet content for caching: drops the 'RT @handle:' prefix and
+    collapses whitespace, so retweets and copy-pasted posts share one entry.
+    """
+    if not isinstance(content, str):
+        return ''
+    content = RT_PREFIX_PATTERN.sub('', content.strip())
+    return WHITESPACE_PATTERN.sub(' ', content).strip()
+
+class TagCache:
+    """
+    Redis cache of LLM tag results keyed by a hash of the normalized content.
+
+    Keys are namespaced with a version derived from the system prompt and the
+    model name, so changing either one makes the old entries unreachable and
+    they age out through their TTL (Redis evicts them earlier under memory
+    pressure with the volatile-lru policy set in docker-compose).
+    """
+    key_prefix = 'tag_cache'
+
+    def __init__(self, redis_client, ttl=None):
+        self.redis_client = redis_client
+        self.ttl = ttl or tag_cache_ttl
+        self.version = hashlib.sha256(f"{llm_model}\n{TAGGING_SYSTEM_PROMPT}".encode('utf-8')).hexdigest()[:12]
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, normalized_content):
+        digest = hashlib.sha256(normalized_content.encode('utf-8')).hexdigest()
+        return f"{self.key_prefix}:{self.version}:{digest}"
+
+    def get_many(self, normalized_contents):
+        """
+        Returns the cached tags for each content, None for a miss.
+        Redis errors are logged and treated as misses.
+        """
+        if not normalized_contents:
+            return []
+        try:
+            values = self.redis_client.mget([self.key_for(content) for content in normalized_contents])
+        except Exception as e:
+            logger.warning(f"Tag cache lookup failed, falling back to the LLM: {e}")
+            values = [None] * len(normalized_contents)
+
+        results = []
+        for value in values:
+            tags = None
+            if value is not None:
+                try:
+                    tags = json.loads(value)
+                except (TypeError, ValueError):
+                    tags = None
+            if tags is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            results.append(tags)
+        return results
+
+    def set_many(self, tags_by_content):
+        """
+        Stores {normalized_content: tags} with the configured TTL.
+        """
+        if not tags_by_content:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for content, tags in tags_by_content.items():
+                pipe.set(self.key_for(content), json.dumps(tags), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to store {len(tags_by_content)} entries in the tag cache: {e}")
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        logger.info(f"Tag cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)")
+
+# Shared Redis client, its connection pool is reused across runs
+redis_client = None
+redis_client_lock = threading.Lock()
+
+def get_redis_client():
+    """
+    Returns the process-wide Redis client, created on first use.
+    Pooled connections are health-checked when they have been idle and
+    re-established transparently after a timeout or a dropped connection.
+    """
+    global redis_client
+    if redis_client is None:
+        with redis_client_lock:
+            if redis_client is None:
+                redis_client = redis.Redis(
+                    host=os.getenv('REDIS_HOST', 'localhost'),       # Redis server host
+                    port=int(os.getenv('REDIS_PORT', 6379)),         # Redis server port
+                    password=os.getenv('REDIS_PASSWORD', None),      # Redis password, if any
+                    db=int(os.getenv('REDIS_DB', 0)),                # Redis datatag_5 number
+                    decode_responses=True,                           # Decode responses as strings
+                    health_check_interval=30,                        # PING connections idle for longer than 30s
+                    socket_keepalive=True,
+                    retry_on_timeout=True
+                )
+    return redis_client
+
+# Shared LLM client, pointed at the local server on first use
+llm_client = None
+llm_client_lock = threading.Lock()
+
+def get_llm_client():
+    """
+    Returns the process-wide OpenAI client for the local LLM server, created on first use.
+    """
+    global llm_client
+    if llm_client is None:
+        with llm_client_lock:
+            if llm_client is None:
+                llm_client = openai.OpenAI(base_url=os.getenv('LOCALAI_ENDPOINT'), api_key=os.getenv('LOCALAI_API_KEY'))
+    return llm_client
+
+#-------------------------- SUMMARY CACHE ----------------------------
+def post_hash(post):
+    return hashlib.sha256(normalize_content(post).encode('utf-8')).hexdigest()[:16]
+
+class SummaryCache:
+    """
+    Redis cache of the last summary of each tag together with the hashes of
+    the posts it covers.
+
+    plan() compares a tag's current posts with the cached entry: the summary
+    is reused when it already covers every post and updated with only the new
+    posts otherwise, as long as at most max_stale of the posts it covers have
+    left the window since. Past that it is rebuilt, so aged-out posts cannot
+    dominate a summary that has only ever been patched. Keys are versioned by
+    model and prompts like TagCache.
+    """
+    key_prefix = 'summary_cache'
+
+    def __init__(self, redis_client, ttl=None, max_stale=None):
+        self.redis_client = redis_client
+        self.ttl = ttl or summary_cache_ttl
+        self.max_stale = summary_cache_max_stale if max_stale is None else max_stale
+        prompts = '\n'.join([llm_model, SUMMARY_SYSTEM_PROMPT, SUMMARY_REDUCE_SYSTEM_PROMPT, SUMMARY_DELTA_SYSTEM_PROMPT])
+        self.version = hashlib.sha256(prompts.encode('utf-8')).hexdigest()[:12]
+        self.reused = 0
+        self.updated = 0
+        self.rebuilt = 0
+
+    def key_for(self, tag):
+        digest = hashlib.sha256(str(tag).encode('utf-8')).hexdigest()
+        return f"{self.key_prefix}:{self.version}:{digest}"
+
+    def get_many(self, tags):
+        """
+        Returns the cached {'posts': [...], 'summary': str} for each tag, None for a miss.
+        Redis errors are logged and treated as misses.
+        """
+        if not tags:
+            return []
+        try:
+            values = self.redis_client.mget([self.key_for(tag) for tag in tags])
+        except Exception as e:
+            logger.warning(f"Summary cache lookup failed, summarising from scratch: {e}")
+            return [None] * len(tags)
+
+        entries = []
+        for value in values:
+            entry = None
+            if value is not None:
+                try:
+                    entry = json.loads(value)
+                except (TypeError, ValueError):
+                    entry = None
+            entries.append(entry)
+        return entries
+
+    def plan(self, entry, post_hashes):
+        """
+        Decides how to summarise a tag with the given post hashes.
+
+        Returns:
+        - (plan, entry): 'reuse' or 'delta' with the cached entry, or ('full', None).
+        """
+        if not entry or not entry.get('posts') or not entry.get('summary'):
+            self.rebuilt += 1
+            return 'full', None
+        summarised = set(entry['posts'])
+        current = set(post_hashes)
+        stale = len(summarised - current) / len(summarised)
+        if stale > self.max_stale:
+            self.rebuilt += 1
+            return 'full', None
+        if current <= summarised:
+            self.reused += 1
+            return 'reuse', entry
+        self.updated += 1
+        return 'delta', entry
+
+    def set_many(self, entries_by_tag):
+        """
+        Stores {tag: (post_hashes, summary)} with the configured TTL.
+        """
+        if not entries_by_tag:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for tag, (post_hashes, summary) in entries_by_tag.items():
+                pipe.set(self.key_for(tag), json.dumps({'posts': sorted(post_hashes), 'summary': summary}), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to store {len(entries_by_tag)} entries in the summary cache: {e}")
+
+    def log_stats(self):
+        logger.info(f"Summary cache: {self.reused} reused, {self.updated} updated with new posts, {self.rebuilt} summarised from scratch")
+
+#-------------------------- TAG VOCABULARY ----------------------------
+TAG_KEY_STRIP_PATTERN = re.compile(r'[\W_]+')
+TAG_SIGILS = '#$@'
+
+TAG_VOCABULARY_SEED_QUERY = """
+    SELECT tag, COUNT(*) AS uses
+    FROM (
+        SELECT UNNEST(tags) AS tag FROM table_8
+        UNION ALL
+        SELECT UNNEST(tags) AS tag FROM table_9
+    ) all_tags
+    WHERE tag IS NOT NULL AND tag <> ''
+    GROUP BY tag
+    ORDER BY uses DESC
+    LIMIT %(limit)s;
+    """
+
+def tag_key(tag):
+    """
+    Normalized form used to find near-duplicate tags: lowercase, without the
+    leading #/$/@ and without spaces or punctuation, e.g. '$PNUT' -> 'pnut'.
+    """
+    return TAG_KEY_STRIP_PATTERN.sub('', tag.lower().lstrip(TAG_SIGILS))
+
+def is_plain_word_key(key):
+    """
+    True for keys made of letters only, the only ones fuzzy matching may touch.
+    """
+    return key.isalpha()
+
+def tag_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def bounded_levenshtein(a, b, max_distance):
+    """
+    Edit distance between a and b, or max_distance + 1 once it is known to be larger.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i] + [0] * len(b)
+        for j, char_b in enumerate(b, start=1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+class TagVocabulary:
+    """
+    Tags written so far with their use counts, kept in the Redis sorted set
+    tag_vocabulary (ZINCRBY on every write) and mirrored in memory with an
+    index for canonicalizing LLM tags locally. It only serves canonicalization;
+    function_2 still lists the tags of table_8 from the datatag_5.
+
+    canonicalize() maps a tag to the most used vocabulary tag with the same
+    normalized key ('pnut' -> '$pnut', '#Bitcoin' -> '#bitcoin') and otherwise,
+    for plain-word keys of 5+ characters, to the most used plain-word tag
+    within a small edit distance found through a trigram index. Only tags used
+    at least TAG_VOCABULARY_MIN_COUNT times are targets, so one-off typos never
+    become canonical. A tag with a sigil only maps to tags with the same sigil.
+    $tickers, #hashtags, @handles and tags containing digits are never fuzzy
+    matched: a new '$coin2' one edit away from a popular '$coin1' is exactly
+    the kind of tag trend detection has to see.
+    """
+    key = 'tag_vocabulary'
+
+    def __init__(self, redis_client, size=None, min_count=None, refresh_seconds=None):
+        self.redis_client = redis_client
+        self.size = size or tag_vocabulary_size
+        self.min_count = tag_vocabulary_min_count if min_count is None else min_count
+        self.refresh_seconds = tag_vocabulary_refresh_seconds if refresh_seconds is None else refresh_seconds
+        self._lock = threading.RLock()
+        self.loaded_at = None
+        self.counts = {}
+        self.by_key = {}
+        self.trigrams = {}
+        self.resolved = {}
+        self.mapped = 0
+
+    # -- Redis side --
+    def ensure_seeded(self):
+        """
+        Seeds the sorted set from the tags already in table_8 and table_9 the
+        first time it is found empty. Only one process seeds at a time.
+        """
+        if self.redis_client.zcard(self.key):
+            return
+        if not self.redis_client.set(f"{self.key}:seeding", tagger_worker_id, nx=True, ex=600):
+            return
+        try:
+            logger.info("Seeding the tag vocabulary from the datatag_5")
+            df = Send_query_to_DB_columnar(TAG_VOCABULARY_SEED_QUERY, {'limit': tag_vocabulary_max_tags})
+            if not df.empty:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for start in range(0, len(df), 10000):
+                    chunk = df.iloc[start:start + 10000]
+                    pipe.zadd(self.key, dict(zip(chunk['tag'], chunk['uses'].astype(float))))
+                pipe.execute()
+            logger.info(f"Seeded the tag vocabulary with {len(df)} tags")
+        finally:
+            self.redis_client.delete(f"{self.key}:seeding")
+
+    def refresh(self, force=False):
+        """
+        Reloads the most used tags from Redis when the local copy is older than refresh_seconds.
+        """
+        with self._lock:
+            if not force and self.loaded_at is not None and time.time() - self.loaded_at < self.refresh_seconds:
+                return
+            try:
+                entries = self.redis_client.zrevrange(self.key, 0, self.size - 1, withscores=True)
+            except Exception as e:
+                logger.warning(f"Could not load the tag vocabulary: {e}")
+                self.loaded_at = time.time()
+                return
+            self.counts = {}
+            self.by_key = {}
+            self.trigrams = {}
+            self.resolved = {}
+            for tag, count in entries:
+                self._index(tag, int(count))
+            self.loaded_at = time.time()
+            logger.info(f"Loaded {len(self.counts)} tags into the tag vocabulary index")
+
+    def record(self, tag_lists):
+        """
+        Adds one use of every tag in tag_lists to the vocabulary, in Redis and
+        locally. The sorted set is trimmed to TAG_VOCABULARY_MAX_TAGS, dropping
+        the least used tags; it is kept well above TAG_VOCABULARY_SIZE so new
+        tags have room to reach TAG_VOCABULARY_MIN_COUNT.
+        """
+        uses = {}
+        for tags in tag_lists:
+            for tag in tags or []:
+                if isinstance(tag, str) and tag:
+                    uses[tag] = uses.get(tag, 0) + 1
+        if not uses:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for tag, count in uses.items():
+                pipe.zincrby(self.key, count, tag)
+            pipe.zremrangebyrank(self.key, 0, -tag_vocabulary_max_tags - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to record {len(uses)} tags in the tag vocabulary: {e}")
+        with self._lock:
+            for tag, count in uses.items():
+                self._index(tag, self.counts.get(tag, 0) + count)
+            self.resolved = {}
+
+    # -- local index --
+    def _index(self, tag, count):
+        key = tag_key(tag)
+        if not key:
+            return
+        if tag not in self.counts:
+            self.by_key.setdefault(key, []).append(tag)
+            if len(self.by_key[key]) == 1:
+                for trigram in tag_trigrams(key):
+                    self.trigrams.setdefault(trigram, set()).add(key)
+        self.counts[tag] = count
+
+    def _best(self, candidates, sigil):
+        best = None
+        for tag in candidates:
+            if sigil and tag[0] != sigil:
+                continue
+            count = self.counts[tag]
+            if count >= self.min_count and (best is None or count > self.counts[best]):
+                best = tag
+        return best
+
+    def _resolve(self, tag):
+        key = tag_key(tag)
+        if not key:
+            return tag
+        sigil = tag[0] if tag[0] in TAG_SIGILS else ''
+        best = self._best(self.by_key.get(key, ()), sigil)
+        if best is not None:
+            return best
+        if sigil or len(key) < 5 or not is_plain_word_key(key):
+            return tag
+
+        max_distance = 1 if len(key) < 9 else 2
+        shared = {}
+        for trigram in tag_trigrams(key):
+            for candidate_key in self.trigrams.get(trigram, ()):
+                shared[candidate_key] = shared.get(candidate_key, 0) + 1
+        # Keys within max_distance edits share at least this many trigrams
+        needed = len(tag_trigrams(key)) - 3 * max_distance
+        match, match_distance = None, max_distance + 1
+        for candidate_key, count in shared.items():
+            if count < needed or candidate_key == key or not is_plain_word_key(candidate_key):
+                continue
+            candidate = self._best([t for t in self.by_key[candidate_key] if t[0] not in TAG_SIGILS], '')
+            if candidate is None:
+                continue
+            distance = bounded_levenshtein(key, candidate_key, max_distance)
+            if distance > max_distance:
+                continue
+            if distance < match_distance or (distance == match_distance and self.counts[candidate] > self.counts[match]):
+                match, match_distance = candidate, distance
+        return match if match is not None else tag
+
+    def canonicalize(self, tags):
+        """
+        Maps each tag to its canonical vocabulary form, without duplicates.
+        """
+        if not tags:
+            return tags
+        self.refresh()
+        canonical = []
+        with self._lock:
+            for tag in tags:
+                if not isinstance(tag, str) or not tag:
+                    continue
+                if tag not in self.resolved:
+                    self.resolved[tag] = self._resolve(tag)
+                if self.resolved[tag] != tag:
+                    self.mapped += 1
+                canonical.append(self.resolved[tag])
+        return list(dict.fromkeys(canonical))
+
+# Shared vocabulary, its index is reused across runs
+tag_vocabulary = None
+tag_vocabulary_lock = threading.Lock()
+
+def get_tag_vocabulary():
+    """
+    Returns the process-wide TagVocabulary, seeding Redis on first use.
+    """
+    global tag_vocabulary
+    if tag_vocabulary is None:
+        with tag_vocabulary_lock:
+            if tag_vocabulary is None:
+                vocabulary = TagVocabulary(get_redis_client())
+                try:
+                    vocabulary.ensure_seeded()
+                except Exception as e:
+                    logger.warning(f"Could not seed the tag vocabulary: {e}")
+                tag_vocabulary = vocabulary
+    return tag_vocabulary
+
+#-------------------------- REDIS LEASE LOCK ----------------------------
+class LeaseLock:
+    """
+    Redis lock held as a lease instead of forever.
+
+    The lock value is '<fencing token>:<random token>' set with NX and a TTL, so
+    a process that dies mid-run stops blocking the others once the TTL runs out.
+    A background heartbeat extends the TTL while the owner is alive, and release
+    only deletes the key if it still holds our value (compare-and-delete).
+    The fencing token comes from an INCR counter, so it grows with every
+    acquisition. write_tweet_tags stores it with each write and refuses writes
+    carrying an older token, so a holder whose lease ran out cannot overwrite
+    the work of the one that took over.
+    """
+    EXTEND_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client, key, ttl=None, heartbeat_interval=None):
+        self.redis_client = redis_client
+        self.key = key
+        self.ttl = ttl or lock_ttl
+        self.heartbeat_interval = heartbeat_interval or lock_heartbeat_interval
+        self.value = None
+        self.fencing_token = None
+        self._lost = threading.Event()
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = None
+        self._extend = redis_client.register_script(self.EXTEND_SCRIPT)
+        self._release = redis_client.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self):
+        """
+        Tries to take the lock once. Returns True if it is now held by this instance.
+        """
+        fencing_token = self.redis_client.incr(f"{self.key}:fence")
+        value = f"{fencing_token}:{uuid.uuid4().hex}"
+        if not self.redis_client.set(self.key, value, nx=True, px=int(self.ttl * 1000)):
+            return False
+
+        self.value = value
+        self.fencing_token = fencing_token
+        self._lost.clear()
+        self._stop_heartbeat.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name=f"{self.key}-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stop_heartbeat.wait(self.heartbeat_interval):
+            try:
+                if not self._extend(keys=[self.key], args=[self.value, int(self.ttl * 1000)]):
+                    logger.error(f"Lease on '{self.key}' was lost (fencing token {self.fencing_token}).")
+                    self._lost.set()
+                    return
+            except Exception as e:
+                # Keep trying until the TTL runs out, a transient Redis error is not a lost lease
+                logger.warning(f"Failed to extend lease on '{self.key}': {e}")
+
+    def is_held(self):
+        """
+        True if the lease is still ours, checked against Redis. Call it before
+        side effects that must not run twice, such as DB writes.
+        """
+        if self.value is None or self._lost.is_set():
+            return False
+        try:
+            return self.redis_client.get(self.key) == self.value
+        except Exception as e:
+            logger.warning(f"Could not verify lease on '{self.key}': {e}")
+            return False
+
+    def release(self):
+        """
+        Stops the heartbeat and deletes the key if it still holds our value.
+        """
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        if self.value is None:
+            return False
+        try:
+            return bool(self._release(keys=[self.key], args=[self.value]))
+        finally:
+            self.value = None
+
+#-------------------------- TAG WRITES ----------------------------
+# Highest fencing token that has written under each lease, see write_tweet_tags
+TAGGER_FENCE_DDL = """
+CREATE TABLE IF NOT EXISTS tagger_fence (
+    name text PRIMARY KEY,
+    token bigint NOT NULL
+)
+"""
+
+# Records the token unless a higher one is stored; no row back means a newer holder has written
+FENCE_CHECK_QUERY = """
+INSERT INTO tagger_fence (name, token) VALUES (%(name)s, %(token)s)
+ON CONFLICT (name) DO UPDATE SET token = EXCLUDED.token
+WHERE tagger_fence.token <= EXCLUDED.token
+RETURNING token
+"""
+
+class StaleLeaseError(Exception):
+    """
+    Raised when a write is refused because a newer lease holder has already written.
+    """
+
+# Parts of 'tagger.py schema install' found in the database, see check_tagger_schema
+tagger_schema = None
+
+def check_tagger_schema():
+    """
+    Checks once per process which parts of 'tagger.py schema install' exist.
+    A missing part is logged once and worked around, so an upgraded tagger keeps
+    tagging until the command has run: tags are written without the fencing
+    check or the tagged_at stamp, and function_4 scans the old column_44 window.
+
+    Returns:
+    - dict: {'fence': bool, 'tagged_at': bool}
+    """
+    global tagger_schema
+    if tagger_schema is not None:
+        return tagger_schema
+    query = """
+    SELECT to_regclass('tagger_fence') IS NOT NULL AS fence,
+           EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'table_9' AND column_name = 'tagged_at') AS tagged_at
+    """
+    rows = Send_query_to_DB_records(query)
+    if not rows:
+        # Not cached, the next call checks again
+        return {'fence': False, 'tagged_at': False}
+    schema = {'fence': rows[0][0], 'tagged_at': rows[0][1]}
+    if not schema['fence']:
+        logger.error("Table tagger_fence is missing, tags are written without the fencing check until 'tagger.py schema install' has run")
+    if not schema['tagged_at']:
+        logger.error("Column table_9.tagged_at is missing, RT handle cleanup scans the last 24 hours of tweets until 'tagger.py schema install' has run")
+    tagger_schema = schema
+    return tagger_schema
+
+# Compiled tag UPDATEs, keyed by (rows must still be claimed by the writer, tagged_at is stamped)
+tweet_tags_queries = {}
+
+def get_tweet_tags_query(claimed=False, stamp=True):
+    """
+    The unnest UPDATE writing tags to table_9 by id, compiled once with the table's column types.
+    With claimed, only rows whose claimed_by is %(worker)s are written; with stamp, tagged_at is set.
+    """
+    if (claimed, stamp) not in tweet_tags_queries:
+        column_types = get_table_column_types('table_9')
+        query = sql.SQL(
+            "UPDATE table_9 SET tags = data.tags::{tags_type}{stamp} "
+            "FROM unnest(%(ids)s::{id_type}[], %(tags)s::text[]) AS data (id, tags) "
+            "WHERE table_9.id = data.id"
+        ).format(
+            tags_type=sql.SQL(column_types['tags']),
+            stamp=sql.SQL(", tagged_at = now()" if stamp else ""),
+            id_type=sql.Identifier(column_types['id']),
+        )
+        with get_connection() as connection:
+            query = query.as_string(connection)
+        if claimed:
+            query += " AND table_9.claimed_by = %(worker)s"
+        tweet_tags_queries[(claimed, stamp)] = query + " RETURNING table_9.id"
+    return tweet_tags_queries[(claimed, stamp)]
+
+def write_tweet_tags(tweets, fence=None, worker=None):
+    """
+    Writes the tags of TweetRecords to table_9 in one transaction and stamps
+    tagged_at, which function_4 uses to find the rows tagged since its last pass.
+    Without tagger_fence or tagged_at (see check_tagger_schema) the fencing
+    check or the stamp is skipped.
+
+    Parameters:
+    - tweets (list): TweetRecord with their tags filled in.
+    - fence (tuple): (lease name, fencing token) the write is made under. The token is
+      stored in tagger_fence in the same transaction, and the write is refused with
+      StaleLeaseError if a higher token is stored already, i.e. the lease expired and
+      a newer holder has written since. The row lock on tagger_fence also keeps two
+      holders from writing at the same time.
+    - worker (str): in claim mode, the worker the rows were claimed by. Rows whose
+      claim expired and went to another worker are not written.
+
+    Returns:
+    - set: ids of the rows that were updated.
+    """
+    schema = check_tagger_schema()
+    if not schema['fence']:
+        fence = None
+    query = get_tweet_tags_query(claimed=worker is not None, stamp=schema['tagged_at'])
+    written = set()
+    try:
+        with get_connection() as connection:
+            with connection.cursor() as cursor:
+                if fence is not None:
+                    cursor.execute(FENCE_CHECK_QUERY, {'name': fence[0], 'token': fence[1]})
+                    if cursor.fetchone() is None:
+                        raise StaleLeaseError(f"Fencing token {fence[1]} of '{fence[0]}' is stale, a newer lease holder has written")
+                for start in range(0, len(tweets), update_chunk_size):
+                    chunk = tweets[start:start + update_chunk_size]
+                    params = {
+                        'ids': [tweet.id for tweet in chunk],
+                        'tags': [to_pg_array_literal(tweet.tags) for tweet in chunk],
+                        'worker': worker,
+                    }
+                    cursor.execute(query, params, prepare=True)
+                    written.update(row[0] for row in cursor.fetchall())
+            connection.commit()
+    except (psycopg.errors.UndefinedColumn, psycopg.errors.UndefinedTable):
+        logger.error("tagger_fence or a table_9 column it needs is missing, run 'tagger.py schema install' once")
+        raise
+    logger.info(f"Tags written for {len(written)} tweets in 'table_9'.")
+    return written
+
+# Raises the Redis fencing counter to the stored token, never lowers it
+RAISE_FENCE_COUNTER_SCRIPT = """
+if tonumber(redis.call('get', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+    return redis.call('set', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+def renew_stale_lease(redis_client, lock):
+    """
+    Makes sure a freshly acquired lease can write. If Redis lost its fencing
+    counter (flushed, restarted without persistence) the new token is not above
+    the one stored in tagger_fence and every write would be refused, so the
+    counter is raised past it and the lease taken again with a new token.
+
+    Returns:
+    - bool: True if the lease is held with a usable token.
+    """
+    if not check_tagger_schema()['fence']:
+        return True
+    stored = Send_query_to_DB_records("SELECT token FROM tagger_fence WHERE name = %(name)s", {'name': lock.key})
+    if not stored or stored[0][0] < lock.fencing_token:
+        return True
+    logger.warning(f"Fencing token {lock.fencing_token} of '{lock.key}' is not above the stored {stored[0][0]}, the Redis counter was reset. Raising it.")
+    redis_client.register_script(RAISE_FENCE_COUNTER_SCRIPT)(keys=[f"{lock.key}:fence"], args=[stored[0][0]])
+    lock.release()
+    return lock.acquire()
+
+def execute_outside_transaction(statement):
+    """
+    Runs a statement that cannot run inside a transaction block, such as
+    CREATE INDEX CONCURRENTLY, on a pooled connection in autocommit mode.
+    """
+    with get_connection() as connection:
+        connection.autocommit = True
+        try:
+            connection.execute(statement)
+        finally:
+            connection.autocommit = False
+
+def install_tagger_schema():
+    """
+    Creates what the tagger needs besides table_9 itself: tagger_fence, the
+    table_9.tagged_at column, the claimed_by / claimed_at columns of claim mode
+    and their indexes. Run once by an operator with DDL rights:
+    tagger.py schema install. Safe to run again.
+    """
+    global tagger_schema
+    logger.info("Installing tagger_fence and the table_9 tagging columns")
+    with get_connection() as connection:
+        connection.execute(TAGGER_FENCE_DDL)
+        connection.execute("ALTER TABLE table_9 ADD COLUMN IF NOT EXISTS tagged_at timestamptz")
+        connection.execute("ALTER TABLE table_9 ADD COLUMN IF NOT EXISTS claimed_by text")
+        connection.execute("ALTER TABLE table_9 ADD COLUMN IF NOT EXISTS claimed_at timestamptz")
+    # Checked again by the next write
+    tagger_schema = None
+    # Built without blocking writes to table_9; a build that failed leaves an INVALID index, drop it and run again
+    execute_outside_transaction("CREATE INDEX CONCURRENTLY IF NOT EXISTS table_9_tagged_at_idx ON table_9 (tagged_at)")
+    execute_outside_transaction("CREATE INDEX CONCURRENTLY IF NOT EXISTS table_9_untagged_idx ON table_9 (column_44 DESC) WHERE tags IS NULL")
+    invalidate_table_writers('table_9')
+
+#-------------------------- TAG FAST PATH ----------------------------
+URL_PATTERN = re.compile(r'https?://\S+')
+MECHANICAL_TAG_PATTERN = re.compile(
+    r'(?<![\w#])(?P<hashtag>#[A-Za-z0-9_]+)'
+    r'|(?<![\w@])(?P<handle>@[A-Za-z0-9_]+)'
+    r'|(?<![\w$])(?P<cashtag>\$[A-Za-z][A-Za-z0-9_]*)'
+    r'|={4,}\s*(?P<marker>[A-Za-z0-9_]+)'
+)
+RESIDUAL_TEXT_PATTERN = re.compile(r'[\W_]+')
+
+def extract_mechanical_tags(content):
+    """
+    Extracts the tags the system prompt asks the LLM to ALWAYS collect:
+    hashtags, handles, $tickers and ==== markers, lowercased and in order of appearance.
+    URLs are ignored so fragments such as '/#/page' do not become hashtags.
+    """
+    if not content:
+        return []
+    text = URL_PATTERN.sub(' ', content)
+    tags = []
+    for match in MECHANICAL_TAG_PATTERN.finditer(text):
+        token = match.group('marker') or match.group(0)
+        tags.append(token.lower())
+    return list(dict.fromkeys(tags))
+
+def is_token_only(content):
+    """
+    True if the content contains at least one mechanical tag and nothing else
+    than such tags, URLs, punctuation and whitespace.
+    """
+    if not content:
+        return False
+    text = URL_PATTERN.sub(' ', content)
+    if not MECHANICAL_TAG_PATTERN.search(text):
+        return False
+    residual = MECHANICAL_TAG_PATTERN.sub(' ', text)
+    return not RESIDUAL_TEXT_PATTERN.sub('', residual)
+
+RT_AUTHOR_PATTERN = re.compile(r'^RT @([A-Za-z0-9_]+): ')
+
+def strip_retweet_author(content, tags):
+    """
+    Removes the retweeted author's handle ('RT @handle: ...') from the tags,
+    the same handle function_4 removes in the datatag_5.
+    """
+    if not tags or not isinstance(content, str):
+        return tags
+    match = RT_AUTHOR_PATTERN.match(content)
+    if not match:
+        return tags
+    handle = '@' + match.group(1).lower()
+    return [tag for tag in tags if tag != handle]
+
+def merge_tags(llm_tags, extracted_tags):
+    """
+    Merges LLM tags with locally extracted ones, without duplicates.
+    """
+    return list(dict.fromkeys(list(llm_tags or []) + list(extracted_tags or [])))
+
+def tag_tweets_concurrently(tweets, max_in_flight=None, timeout=None, cache=None, fast_path=None, batch_size=None, vocabulary=None):
+    """
+    Tags a list of tweets in place, keeping several LLM requests in flight at once.
+
+    Tweets are deduplicated on their normalized content, so a retweet or a
+    copy-pasted post costs one LLM request per batch, and zero when the
+    content is already in the cache. Depending on the fast path policy,
+    mechanical tags are extracted locally and merged with the LLM output,
+    and token-only tweets skip the LLM. The handle of a retweet's author is
+    removed from its tags.
+
+    Parameters:
+    - tweets (list): TweetRecord, or any objects with 'content' and 'tags' attributes.
+    - max_in_flight (int): Maximum number of concurrent LLM requests, defaults to llm_max_in_flight.
+    - timeout (float): Per-request timeout in seconds, defaults to llm_request_timeout.
+    - cache (TagCache): Optional tag cache consulted before calling the LLM.
+    - fast_path (str): 'off', 'merge' or 'skip_llm', defaults to tag_fast_path.
+    - batch_size (int): Tweets packed into one LLM request, defaults to llm_batch_size.
+    - vocabulary (TagVocabulary): Optional vocabulary the LLM tags are canonicalized against.
+
+    Returns:
+    - list: The same tweets with 'tags' filled in. Tweets whose request failed keep their original tags.
+    """
+    if not tweets:
+        return tweets
+
+    max_in_flight = max_in_flight or llm_max_in_flight
+    fast_path = (fast_path or tag_fast_path).lower()
+    batch_size = max(1, batch_size or llm_batch_size)
+    contents = [normalize_content(tweet.content) for tweet in tweets]
+    tags = [tweet.tags for tweet in tweets]
+    unique_contents = list(dict.fromkeys(content for content in contents if content))
+
+    # -- local extraction of hashtags, handles, cashtags and markers --
+    extracted = {}
+    if fast_path in ('merge', 'skip_llm'):
+        extracted = {content: extract_mechanical_tags(content) for content in unique_contents}
+    skipped = set()
+    if fast_path == 'skip_llm':
+        skipped = {content for content in unique_contents if is_token_only(content)}
+        if skipped:
+            logger.info(f"Fast path: {len(skipped)} token-only tweet(s) tagged without the LLM")
+
+    # -- cache lookup, remaining tweets grouped by normalized content --
+    lookup = [content for content in unique_contents if content not in skipped]
+    cached = dict(zip(lookup, cache.get_many(lookup))) if cache is not None else {}
+    pending = {}
+    for position, content in enumerate(contents):
+        if not content:
+            continue
+        if content in skipped:
+            tags[position] = list(extracted[content])
+        elif cached.get(content) is not None:
+            tags[position] = merge_tags(cached[content], extracted.get(content))
+        else:
+            pending.setdefault(content, []).append(position)
+
+    # -- LLM requests for the misses, batch_size tweets per request --
+    fresh = {}
+    if pending:
+        pending_contents = list(pending)
+        chunks = [pending_contents[i:i + batch_size] for i in range(0, len(pending_contents), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='llm') as executor:
+            futures = [executor.submit(request_tags_for_chunk, chunk, timeout) for chunk in chunks]
+            for future in as_completed(futures):
+                try:
+                    tagged = future.result()
+                except Exception as e:
+                    logger.error(f"Error tagging a chunk of tweets: {e}")
+                    continue
+                for content, result in tagged.items():
+                    if result is None:
+                        continue
+                    if vocabulary is not None:
+                        result = vocabulary.canonicalize(result)
+                    fresh[content] = result
+                    for position in pending[content]:
+                        tags[position] = merge_tags(result, extracted.get(content))
+
+    if cache is not None:
+        cache.set_many(fresh)
+
+    # -- the retweeted author is not a tag of the retweet --
+    for tweet, tweet_tags in zip(tweets, tags):
+        tweet.tags = strip_retweet_author(tweet.content, tweet_tags)
+    return tweets
+
+SUMMARY_SYSTEM_PROMPT = """
+    You are an AI assistant that summarizes social media posts for a given tag. Your task is to read the following posts related to a specific tag and provide a concise summary highlighting the most valuable information.
+    """
 
-    except Exception as e:
-        logger.error(f"An error occurred while retrieving posts with tags: {e}")
-        return pd.DataFrame(columns=['tag', 'posts', 'users', 'post_dates'])
+SUMMARY_USER_TEMPLATE = """
+    Tag: {tag}
+    Posts:
+    {formatted_posts}
+    """
 
-def update_tags(row):
-    system_prompt = """
-    Assign the most accurate tags for a give tweet about tag_25. If the very similar tag already exists in Existing_Tags, use that one. If tweet contains a column_14 (starts with ====) ALWAYS extract the column_14 as a tag in small letters. If tweet has a hashtag (starts with #) ALWAYS collect the hashtag. If tweet has a handle (starts with @) ALWAYS collect the handle. try to find and identify names of the tag_25 and save them as well. Do not use tags from Banned_Tags list.
-    Existing_Tags: ["tag_1", "tag_2", "tag_3", "tag_4", "tag_5", "tag_6", "tag_7", "tag_8", "tag_9", "tag_10", "tag_11", "tag_12"]
-    Banned_Tags: ["tag_25", "tag_27"]
-    Examples:
-    1.
-        Tweet: "Imagine that the king of #hashtag_1 tag_13 will hit $1+ this cycle and the king of AI tag_14 will hit $5K.
-            The two biggest column_12s: AI + hashtag_1. @handle_1"
-        Output: { "tags": ["tag_13", "tag_14", "ai", "tag_15", "@handle_1", "#hashtag_1"] }
-    2.
-        Tweet: "Welcome to the $PNUT fam."
-        Output: { "tags": ["$pnut"] }
-    3.
-        Tweet: "tag_16 continues to make new highs. tag_17 is the biggest tag_15 on #hashtag_2. tag_18 is my favorite runner up after tag_17.
-            Both will send hard this cycle."
-        Output: { "tags": ["#hashtag_2", "tag_16", "tag_15", "tag_17", "tag_18"] }
-    4.
-        Tweet: "tag_19 IS DESTINED FOR 1 BILLION."
-        Output: { "tags": ["tag_19"] }
-    5.
-        Tweet: "@handle_2 predicted that tag_5 is going to kick off in a big way, The #tag_6 tag_20 has been designed specifically to onboard new retail. Currently accumulating a bunch of tag_5 hashtag_1 including this one $tag_9 - any pullbacks into blue ill be adding"
-        Output: { "tags": ["tag_5", "tag_6", "tag_20", "$tag_9", "#tag_6", "@handle_2"] }
-    6.
-        Tweet: "tag_21 I think you know what’s about to happen "
-        Output: { "tags": ["tag_22", "tag_21"] }
-    7.
-        Tweet: "This 440 point move on tag_23 was shared in the Hedge Experimental zone. 
-            tag_9 signals or conservative scalps on big caps, we’ve got you covered. 
-            Sign up for our automation: https://tag_24.finance
-            tag_26 #tag_24"
-        Output: { "tags": ["tag_25", "tag_23", "tag_24", "tag_9", "tag_26", "#tag_24"] }
-    8.
-        Tweet: "Zero1 Labs is excited to unveil our v2 token vision next week.
-            A bold step forward for the only community-run and launched AI ecosystem.
-            tag_28 will be the primary asset driving decentralized AI, supporting both tag_29 and tag_30s.
-            The first PoS chain with full…"
-        Output: { "tags": ["tag_28", "tag_29", "tag_30", "tag_31", "tag_32", "ai", "pos"] }
-    9.
-        Tweet: "tag_6 and tag_7 to list #moodeng"
-        Output: { "tags": ["moodeng", "tag_6", "tag_7"]
+SUMMARY_REDUCE_SYSTEM_PROMPT = """
+    You are an AI assistant that summarizes social media posts for a given tag. The posts were summarized in parts. Your task is to merge the following partial summaries into one concise summary highlighting the most valuable information, without repeating points.
     """
-    user_prompt = f"""
-    Tweet: {row['content']}
+
+SUMMARY_REDUCE_TEMPLATE = """
+    Tag: {tag}
+    Partial summaries:
+    {formatted_posts}
     """
-    output_schema = {
-        "type": "json_schema",
-        "json_schema": {
-            "name": "tags_schema",
-            "schema": {
-                "type": "object",
-                "properties": {
-                    "tags": {
-                        "type": "array",
-                        "items": {
-                            "type": "string",
-                            "pattern": "^[a-z0-9 @#$_]+$"
-                        },
-                        "minItems": 1,
-                        "maxItems": 17
-                    }
-                },
-                "required": ["tags"],
-                "additionalProperties": False
-            }
-        }
-    }
-    
-    response = llm_client.chat.completions.create(
-      model="qwen2.5-14b-instruct",
-      messages=[
+
+SUMMARY_DELTA_SYSTEM_PROMPT = """
+    You are an AI assistant that summarizes social media posts for a given tag. Your task is to update the previous summary of a specific tag with the following new posts and provide a concise summary highlighting the most valuable information.
+    """
+
+SUMMARY_DELTA_TEMPLATE = """
+    Tag: {tag}
+    Previous summary:
+    {previous_summary}
+    New posts:
+    {formatted_posts}
+    """
+
+def chunk_lines(lines, max_tokens):
+    """
+    Packs consecutive lines into chunks of at most max_tokens. A single line
+    longer than max_tokens is truncated into a chunk of its own.
+
+    Returns:
+    - list: The chunks as strings.
+    """
+    chunks = []
+    current = []
+    used = 0
+    for line in lines:
+        line_tokens = count_tokens(line)
+        if line_tokens > max_tokens:
+            line = truncate_to_tokens(line, max_tokens).rstrip('\n') + '\n'
+            line_tokens = max_tokens
+        if current and used + line_tokens > max_tokens:
+            chunks.append(''.join(current))
+            current = []
+            used = 0
+        current.append(line)
+        used += line_tokens
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+def summary_prompt_budget(system_prompt, template):
+    """
+    Tokens left for the posts in one summary request: SUMMARY_CHUNK_TOKENS,
+    capped by what fits in the context window next to the prompt and the reply.
+    """
+    overhead = count_message_tokens([
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-      ],
-      response_format=output_schema,
-      temperature=0.3,
+        {"role": "user", "content": template}
+    ])
+    return max(1, min(summary_chunk_tokens, llm_context_window - llm_completion_reserve - overhead))
+
+def request_summary(system_prompt, template, tag, formatted_posts, previous_summary=None):
+    user_prompt = template.replace('{tag}', str(tag), 1).replace('{formatted_posts}', formatted_posts, 1)
+    if previous_summary is not None:
+        user_prompt = user_prompt.replace('{previous_summary}', previous_summary, 1)
+    response = chat_completion(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.6,
+        max_tokens=llm_completion_reserve,
+        timeout=llm_request_timeout,
     )
-    resp_content = response.choices[0].message.content
-    try:
-        extracted_json = json.loads(resp_content)
-        tags = extracted_json.get("tags", [])
-        unique_tags = list(set(tags))  # Convert the set back to a list
-        row['tags'] = unique_tags  # Assign the list to row['tags']
-        #logger.info(f"{unique_tags}")
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing JSON: {e}")
+    return response.choices[0].message.content.strip()
 
-    return row
+def summarise_top_tags(df, max_in_flight=None, cache=None):
+    """
+    Summarises the posts of every tag in df (function_1 rows: tag, posts, users,
+    post_dates) with a map-reduce over one shared pool of LLM requests.
+
+    Each tag's posts are split into chunks of SUMMARY_CHUNK_TOKENS that are
+    summarised concurrently (map). As soon as all chunks of a tag are done their
+    partial summaries are merged (reduce), again in chunks if they do not fit in
+    one request, until one summary is left. A tag with a single chunk is
+    summarised in one call as before. All tags share max_in_flight requests, so
+    a run takes about as long as its slowest tag instead of the sum of all tags.
+
+    With a SummaryCache (the default when SUMMARY_CACHE_ENABLED), a tag whose
+    posts are all covered by its cached summary costs no request, and a tag
+    with only new posts updates the cached summary with just those posts. If
+    that update fails, the cached summary is output and left in the cache, so
+    the next run retries the update.
+
+    Returns:
+    - pd.DataFrame: df with a 'summary' column, '' where summarisation failed.
+    """
+    max_in_flight = max_in_flight or llm_max_in_flight
+    if cache is None and summary_cache_enabled:
+        cache = SummaryCache(get_redis_client())
+    start = time.time()
+    token_usage.reset()
+    map_budget = summary_prompt_budget(SUMMARY_SYSTEM_PROMPT, SUMMARY_USER_TEMPLATE.replace('{tag}', ''))
+    reduce_budget = summary_prompt_budget(SUMMARY_REDUCE_SYSTEM_PROMPT, SUMMARY_REDUCE_TEMPLATE.replace('{tag}', ''))
+
+    tags = list(df['tag'])
+    summaries = [''] * len(tags)
+    # Per tag: results of the stage in flight, how many are still pending and
+    # a previous summary to fold into the next reduce
+    stages = [None] * len(tags)
+    # Per tag: post hashes the new summary covers, None if it must not be cached
+    covered = [None] * len(tags)
+    # Per tag: cached summary being updated, output if the update fails
+    fallbacks = [None] * len(tags)
+    cached_entries = cache.get_many(tags) if cache is not None else [None] * len(tags)
+    request_count = 0
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {}
+
+        def submit_stage(position, system_prompt, template, chunks, previous_summary=None, seed=None):
+            nonlocal request_count
+            stages[position] = {'results': [None] * len(chunks), 'pending': len(chunks), 'seed': seed}
+            for index, chunk in enumerate(chunks):
+                future = executor.submit(request_summary, system_prompt, template, tags[position], chunk, previous_summary)
+                futures[future] = (position, index)
+            request_count += len(chunks)
+
+        for position, (posts, users, post_dates) in enumerate(zip(df['posts'], df['users'], df['post_dates'])):
+            hashes = [post_hash(post) for post in posts]
+            lines = [f"- [{date}] {user}: {post}\n" for post, user, date in zip(posts, users, post_dates)]
+            plan, previous = ('full', None)
+            if cache is not None:
+                plan, previous = cache.plan(cached_entries[position], hashes)
+
+            if plan == 'reuse':
+                summaries[position] = previous['summary']
+                continue
+            if plan == 'delta':
+                covered[position] = set(previous['posts']) | set(hashes)
+                fallbacks[position] = previous['summary']
+                seen = set(previous['posts'])
+                lines = [line for line, digest in zip(lines, hashes) if digest not in seen]
+                delta_budget = summary_prompt_budget(SUMMARY_DELTA_SYSTEM_PROMPT, SUMMARY_DELTA_TEMPLATE.replace('{tag}', '').replace('{previous_summary}', previous['summary']))
+                chunks = chunk_lines(lines, delta_budget)
+                if len(chunks) == 1:
+                    submit_stage(position, SUMMARY_DELTA_SYSTEM_PROMPT, SUMMARY_DELTA_TEMPLATE, chunks, previous_summary=previous['summary'])
+                else:
+                    # Too many new posts for one update, map them and merge with the previous summary
+                    submit_stage(position, SUMMARY_SYSTEM_PROMPT, SUMMARY_USER_TEMPLATE, chunk_lines(lines, map_budget), seed=previous['summary'])
+                continue
+
+            covered[position] = set(hashes)
+            chunks = chunk_lines(lines, map_budget)
+            if not chunks:
+                continue
+            if len(chunks) > 1:
+                logger.info(f"Summarising {len(lines)} posts for tag '{tags[position]}' in {len(chunks)} chunks")
+            submit_stage(position, SUMMARY_SYSTEM_PROMPT, SUMMARY_USER_TEMPLATE, chunks)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                position, index = futures.pop(future)
+                stage = stages[position]
+                try:
+                    stage['results'][index] = future.result()
+                except Exception as e:
+                    logger.error(f"Error during summarization for tag '{tags[position]}': {e}", exc_info=True)
+                    covered[position] = None
+                stage['pending'] -= 1
+                if stage['pending']:
+                    continue
+
+                partials = [result for result in stage['results'] if result]
+                if stage['seed']:
+                    partials.insert(0, stage['seed'])
+                if len(partials) <= 1:
+                    summaries[position] = partials[0] if partials else ''
+                    if partials:
+                        logger.info(f"Summary for tag '{tags[position]}': {summaries[position]}")
+                    elif fallbacks[position]:
+                        logger.warning(f"Update of the cached summary for tag '{tags[position]}' failed, using the cached summary")
+                        summaries[position] = fallbacks[position]
+                        covered[position] = None
+                    continue
+
+                lines = [f"- {partial}\n" for partial in partials]
+                chunks = chunk_lines(lines, reduce_budget)
+                if len(chunks) >= len(partials):
+                    # Partials too long to pair up, merge what fits in one request so the reduce terminates
+                    chunks = [truncate_to_tokens(''.join(lines), reduce_budget)]
+                submit_stage(position, SUMMARY_REDUCE_SYSTEM_PROMPT, SUMMARY_REDUCE_TEMPLATE, chunks)
+
+    if cache is not None:
+        cache.set_many({
+            tag: (covered[position], summaries[position])
+            for position, tag in enumerate(tags)
+            if covered[position] and summaries[position]
+        })
+        cache.log_stats()
+    logger.info(f"Summarised {len(tags)} tags with {request_count} LLM requests in {time.time() - start:.1f}s")
+    token_usage.log_summary('Summarisation')
+    summarised = df.copy()
+    summarised['summary'] = summaries
+    return summarised
 
 def summarise_posts(row):
-    system_prompt = """
-    You are an AI assistant that summarizes social media posts for a given tag. Your task is to read the following posts related to a specific tag and provide a concise summary highlighting the most valuable information.
     """
-    # Ensure that posts, users, and post_dates are lists
+    Summarises one function_1 row, see summarise_top_tags. Prefer calling
+    summarise_top_tags with all rows so the tags are summarised in parallel.
+    """
     posts = row['posts']
     users = row['users']
     post_dates = row['post_dates']
@@ -784,129 +3167,617 @@ def summarise_posts(row):
     if not isinstance(post_dates, list):
         post_dates = list(post_dates)
 
-    # Format the posts into a readable string
-    formatted_posts = ''
-    for post, user, date in zip(posts, users, post_dates):
-        formatted_posts += f"- [{date}] {user}: {post}\n"
+    single = pd.DataFrame({'tag': [row['tag']], 'posts': [posts], 'users': [users], 'post_dates': [post_dates]})
+    row['summary'] = summarise_top_tags(single)['summary'].iloc[0]
+    return row
 
-    user_prompt = f"""
-    Tag: {row['tag']}
-    Posts:
-    {formatted_posts}
+
+#-------------------------- DRAIN MODE ----------------------------
+class AdaptiveBatchSizer:
     """
-    try:
-        response = llm_client.chat.completions.create(
-            model="qwen2.5-14b-instruct",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.6,
-        )
-        # Get the assistant's reply
-        assistant_reply = response.choices[0].message.content
-        # Assign the summary to the row
-        row['summary'] = assistant_reply.strip()
-        logger.info(f"Summary for tag '{row['tag']}': {row['summary']}")
-    except Exception as e:
-        logger.error(f"Error during summarization for tag '{row['tag']}': {e}", exc_info=True)
-        row['summary'] = ''
-    return row
+    Chooses the next batch size so a batch takes about target_seconds, from an
+    exponentially weighted average of the observed time per tweet.
+    Kept at module level so the learned rate carries over between runs.
+    """
+    def __init__(self, initial_size, target_seconds, min_size, max_size, smoothing=0.3):
+        self.initial_size = initial_size
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.seconds_per_tweet = None
+
+    def record(self, tweets, seconds):
+        if tweets <= 0:
+            return
+        observed = seconds / tweets
+        if self.seconds_per_tweet is None:
+            self.seconds_per_tweet = observed
+        else:
+            self.seconds_per_tweet = self.smoothing * observed + (1 - self.smoothing) * self.seconds_per_tweet
+
+    def next_size(self, remaining_seconds=None):
+        if not self.seconds_per_tweet:
+            return self.initial_size
+        seconds = self.target_seconds
+        if remaining_seconds is not None:
+            seconds = min(seconds, remaining_seconds)
+        size = int(seconds / self.seconds_per_tweet)
+        return max(self.min_size, min(self.max_size, size))
+
+batch_sizer = AdaptiveBatchSizer(default_batch_size, target_batch_seconds, min_batch_size, max_batch_size)
+
+class RunProgress:
+    """
+    Turns the chunks committed during one run into progress events:
+    {"event": "progress", "run_id", "chunk", "rows", "tags", "high_watermark"}
+    - rows: tweets of the chunk written with tags
+    - tags: sorted tags those tweets received
+    - high_watermark: newest column_44 committed so far in the run (ISO 8601)
+    """
+    def __init__(self, run_id, on_progress):
+        self.run_id = run_id
+        self.on_progress = on_progress
+        self.chunks = 0
+        self.high_watermark = None
+
+    def committed(self, tweets):
+        tagged = [tweet for tweet in tweets if tweet.tags is not None]
+        if not tagged:
+            return
+        self.chunks += 1
+        latest = max((tweet.column_44 for tweet in tagged if tweet.column_44 is not None), default=None)
+        if latest is not None and (self.high_watermark is None or latest > self.high_watermark):
+            self.high_watermark = latest
+        event = {
+            "event": "progress",
+            "run_id": self.run_id,
+            "chunk": self.chunks,
+            "rows": len(tagged),
+            "tags": sorted({tag for tweet in tagged for tag in tweet.tags}),
+            "high_watermark": self.high_watermark.isoformat() if self.high_watermark is not None else None,
+        }
+        try:
+            self.on_progress(event)
+        except Exception as e:
+            logger.warning(f"Progress event for chunk {self.chunks} was not delivered: {e}")
+
+def dump_tweets_csv(tweets, path="labeled_tweets.csv"):
+    """
+    Writes the last batch to a CSV file for inspection, one row per TweetRecord.
+    """
+    names = [field.name for field in fields(TweetRecord)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for tweet in tweets:
+            writer.writerow([getattr(tweet, name) for name in names])
+
+def label_batch(unlabeled_tweets, lock=None, tag_cache=None, vocabulary=None, on_commit=None):
+    """
+    Tags one batch of tweets and writes the tags to table_9. With on_commit
+    (progress events) the batch is tagged and written commit_chunk_size tweets
+    at a time and on_commit is called with the tweets of each written chunk;
+    without it the whole batch is tagged concurrently and written once.
+
+    Parameters:
+    - unlabeled_tweets (list): TweetRecord from function_5 or claim_unlabeled_tweets.
+    - lock (LeaseLock): the lease the batch is written under, None in claim mode
+      where only rows still claimed by this worker are written.
+
+    Returns:
+    - int: number of tweets written with tags, 0 if the write failed or was skipped.
+    """
+    # Every slice drains the LLM executor and waits for its write, only worth it for progress events
+    step = max(commit_chunk_size if on_commit is not None else len(unlabeled_tweets), 1)
+    written = 0
+    for chunk_start in range(0, len(unlabeled_tweets), step):
+        chunk = unlabeled_tweets[chunk_start:chunk_start + step]
+        try:
+            tag_tweets_concurrently(chunk, cache=tag_cache, vocabulary=vocabulary)
+        except Exception as e:
+            logger.error(f"Error tagging posts: {e}", exc_info=True)
+        # Only tweets that received tags are written, the rest stay NULL for the next run
+        tagged = [tweet for tweet in chunk if tweet.tags is not None]
+        logger.info(f"labeled tweets: {len(tagged)}/{len(chunk)}")
+        if not tagged:
+            continue
 
+        try:
+            # is_held() is only an early exit, the fencing token is enforced by the write itself
+            if lock is None or lock.is_held():
+                with timed_stage('insert'):
+                    if lock is not None:
+                        written_ids = write_tweet_tags(tagged, fence=(lock.key, lock.fencing_token))
+                    else:
+                        # Rows whose claim expired may have been reclaimed by another worker
+                        written_ids = write_tweet_tags(tagged, worker=tagger_worker_id)
+                tagged = [tweet for tweet in tagged if tweet.id in written_ids]
+                if vocabulary is not None:
+                    vocabulary.record(tweet.tags for tweet in tagged)
+                written += len(tagged)
+                if on_commit is not None and tagged:
+                    on_commit(tagged)
+            else:
+                logger.error(f"Lease lost before the insert (fencing token {lock.fencing_token}), labeled tweets were not written")
+                break
+        except StaleLeaseError as e:
+            logger.error(f"Labeled tweets were not written: {e}")
+            break
+        except Exception as e:
+            logger.error(f"Error during insert to the table table_8: {e}", exc_info=True)
+            break
+    if unlabeled_tweets:
+        dump_tweets_csv(unlabeled_tweets)
+    return written
 
 # ================== MAIN PROGRAM ==================
-def post_labeling_program():
+def post_labeling_program(on_progress=None, run_id=None):
+    """
+    One tagging run: takes the lock, tags the backlog (one batch, or until it is
+    drained in drain mode) and cleans up RT handles.
+
+    Parameters:
+    - on_progress: optional callable receiving a RunProgress event after each committed chunk.
+    - run_id: identifier put in those events, generated when not given.
+
+    Returns:
+    - int: number of tweets written with tags.
+    """
+    global last_run_finished_at
     # --------------------- Redis Lock Acquisition ---------------------
     try:
-        # Initialize Redis client
-        redis_client = redis.Redis(
-            host=os.getenv('REDIS_HOST', 'localhost'),       # Redis server host
-            port=int(os.getenv('REDIS_PORT', 6379)),         # Redis server port
-            password=os.getenv('REDIS_PASSWORD', None),      # Redis password, if any
-            db=int(os.getenv('REDIS_DB', 0)),                # Redis datatag_5 number
-            decode_responses=True                            # Decode responses as strings
-        )
+        # Shared Redis client
+        redis_client = get_redis_client()
 
-        # Attempt to acquire the lock
-        have_lock = redis_client.set('post_labeling_program_lock', 'locked', nx=True)
-        if not have_lock:
-            logger.info("Process exited because it already exists.")
-            return
-        logger.info(f"Redis lock: post_labeling_program_lock acquired, starting application")
+        # Attempt to acquire the lease lock, claiming workers coordinate through table_9 instead
+        lock = None
+        if tagger_work_mode == 'claim':
+            logger.info(f"Work mode 'claim', starting application as worker {tagger_worker_id}")
+        else:
+            lock = LeaseLock(redis_client, 'post_labeling_program_lock')
+            if not lock.acquire():
+                logger.info("Process exited because it already exists.")
+                return 0
+            LOCK_HELD.set(1)
+            logger.info(f"Redis lock: post_labeling_program_lock acquired with fencing token {lock.fencing_token}, starting application")
     except Exception as e:
         logger.error(f"Falied to connect to redis and get the lock: {e}")
         sys.exit(1)
     # --------------------------------------------------------------
-    # -- Get the DB connection --
-    initialize_connection()
+    batches_labeled = 0
+    total_written = 0
+    # The lease is released even if the run fails, or its heartbeat would keep it alive
+    try:
+        # -- Get the DB connection pool (opened once per process) --
+        initialize_connection()
+        if lock is not None and not renew_stale_lease(redis_client, lock):
+            logger.info("Process exited because it already exists.")
+            return 0
 
-    # Record start time
-    start_time = time.time()
+        # Record start time
+        start_time = time.time()
+        token_usage.reset()
 
-    # Columns from table_8
-    table_8_columns = [
-        "id", "column_19_id", "content", "column_40", "column_41", "column_42", "name", "column_43", "column_44",
-        "column_45", "column_46", "column_47", "column_48", "column_49", "tags", "column_50"
-    ]
+        # -- labeling posts code --
+        tag_cache = TagCache(redis_client) if tag_cache_enabled else None
+        vocabulary = get_tag_vocabulary() if tag_vocabulary_enabled else None
+        progress = RunProgress(run_id or uuid.uuid4().hex, on_progress) if on_progress is not None else None
+        try:
+            batch_size = batch_sizer.next_size(drain_time_budget) if drain_mode else default_batch_size
+            iteration = 0
+            backlog = None
+            while True:
+                iteration += 1
+                logger.info(f"Getting data from the remote DB...")
+                with timed_stage('fetch'):
+                    unlabeled_tweets = claim_unlabeled_tweets(batch_size) if lock is None else function_5(batch_size)
+                logger.info(f"Unlabeled tweets: {len(unlabeled_tweets)}")
+                if not unlabeled_tweets:
+                    break
+
+                batch_start = time.time()
+                written = label_batch(unlabeled_tweets, lock, tag_cache, vocabulary, progress.committed if progress is not None else None)
+                batches_labeled += 1
+                total_written += written
+                TWEETS_TAGGED.inc(written)
+                batch_sizer.record(len(unlabeled_tweets), time.time() - batch_start)
+                if not drain_mode:
+                    break
+
+                # -- drain mode: keep going while there is backlog, time and progress --
+                backlog = count_unlabeled_tweets()
+                remaining = drain_time_budget - (time.time() - start_time)
+                logger.info(f"Drain iteration {iteration}: {written}/{len(unlabeled_tweets)} tweets tagged in {time.time() - batch_start:.2f}s, backlog {backlog}, {max(remaining, 0):.0f}s of budget left")
+                if not backlog or remaining <= 0 or written == 0:
+                    break
+                if lock is not None and not lock.is_held():
+                    break
+                batch_size = batch_sizer.next_size(remaining)
+                logger.info(f"Next batch size: {batch_size} (~{batch_sizer.seconds_per_tweet:.3f}s per tweet)")
 
-    # -- labeling posts code --
-    try:
-        logger.info(f"Getting data from the remote DB...")
-        unlabeled_tweets = function_5()
-        logger.info(f"Unlabeled tweets: {unlabeled_tweets}")
-        if not unlabeled_tweets.empty:
-            labeled_tweets = unlabeled_tweets.copy()
+            # -- removal of RT handles from tags --
+            if batches_labeled:
+                try:
+                    with timed_stage('rt_cleanup'):
+                        rmh = function_4()
+                except Exception as e:
+                    logger.warning(f"Warn: tags could not be removed due to a problem: {e}", exc_info=True)
+            # -- pruning of the trend rollup --
+            if trend_score_source == 'rollup' and tag_rollup_prune_interval > 0:
+                try:
+                    prune_tag_rollup_if_due(redis_client)
+                except Exception as e:
+                    logger.warning(f"Warn: rollup could not be pruned due to a problem: {e}", exc_info=True)
+            if backlog is None:
+                count_unlabeled_tweets()
+        except Exception as e:
+            logger.error(f"Failed to get tweets or tags: {e}")
+        if tag_cache is not None:
+            tag_cache.log_stats()
+        if vocabulary is not None:
+            logger.info(f"Tag vocabulary: {vocabulary.mapped} LLM tags canonicalized since start")
+
+        # Record end time and log the elapsed time
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        logger.info(f"Main task completed in {elapsed_time:.2f} seconds.")
+        last_run_finished_at = end_time
+        LAST_RUN.set(end_time)
+        if batches_labeled:
+            TWEETS_PER_SECOND.set(total_written / max(elapsed_time, 1e-9))
+        token_usage.log_summary()
+    finally:
+        # --------------------- Redis Lock Release ---------------------
+        if lock is not None:
             try:
-                labeled_tweets = labeled_tweets.apply(update_tags, axis=1)
-                logger.info(f"labeled tweets: {labeled_tweets}")
+                if lock.release():
+                    logger.debug("Lock released.")
+                else:
+                    logger.warning(f"Lock was no longer held at release (fencing token {lock.fencing_token}).")
             except Exception as e:
-                logger.error(f"Error tagging posts: {e}", exc_info=True)
-             # Add missing columns and initialize them with null (None)
-            for col in table_8_columns:
-                if col not in labeled_tweets.columns:
-                    labeled_tweets[col] = None  # Initialize missing columns with None
-            labeled_tweets.to_csv("labeled_tweets.csv", incolumn_3=False)
+                logger.error(f"Failed to release lock: {e}")
+            LOCK_HELD.set(0)
+        # --------------------------------------------------------------
+    return total_written
+
+#-------------------------- METRICS ----------------------------
+class _LazyMetric:
+    """
+    A prometheus_client metric that is registered on first use, like _LazyModule.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, kind, *args, **kwargs):
+        self._kind = kind
+        self._args = args
+        self._kwargs = kwargs
+        self._metric = None
+
+    def get(self):
+        if self._metric is None:
+            with _LazyMetric._lock:
+                if self._metric is None:
+                    self._metric = getattr(prometheus_client, self._kind)(*self._args, **self._kwargs)
+        return self._metric
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+STAGE_SECONDS = _LazyMetric(
+    'Histogram', 'tagger_stage_duration_seconds', 'Duration of one pipeline stage (llm is one LLM request)', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+TWEETS_TAGGED = _LazyMetric('Counter', 'tagger_tweets_tagged_total', 'Tweets written with tags')
+TWEETS_PER_SECOND = _LazyMetric('Gauge', 'tagger_tweets_per_second', 'Tweets tagged per second during the last run')
+BACKLOG = _LazyMetric('Gauge', 'tagger_backlog_tweets', 'Untagged tweets in table_9 at the last count')
+LOCK_HELD = _LazyMetric('Gauge', 'tagger_lock_held', '1 while this process holds post_labeling_program_lock')
+DB_RTT = _LazyMetric('Gauge', 'tagger_db_rtt_seconds', 'Round trip of a trivial query to the datatag_5')
+REDIS_RTT = _LazyMetric('Gauge', 'tagger_redis_rtt_seconds', 'Round trip of a Redis PING')
+RABBITMQ_LAG = _LazyMetric('Gauge', 'tagger_rabbitmq_message_lag_seconds', 'Age of the last start_tagging message when it was consumed')
+LAST_RUN = _LazyMetric('Gauge', 'tagger_last_run_timestamp_seconds', 'End time of the last post_labeling_program run')
+METRICS = (STAGE_SECONDS, TWEETS_TAGGED, TWEETS_PER_SECOND, BACKLOG, LOCK_HELD, DB_RTT, REDIS_RTT, RABBITMQ_LAG, LAST_RUN)
+last_run_finished_at = None
+
+# Recent raw stage durations, for percentiles outside Prometheus (see benchmark.py)
+stage_samples = {}
+stage_samples_lock = threading.Lock()
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    with stage_samples_lock:
+        stage_samples.setdefault(stage, deque(maxlen=metrics_sample_size)).append(seconds)
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+# Last probe results, refreshed at most every metrics_probe_interval seconds
+probe_state = {'checked_at': 0.0, 'db': None, 'redis': None}
+probe_lock = threading.Lock()
+
+def probe_dependencies(force=False):
+    """
+    Measures the DB and Redis round-trip times, None for a dependency that failed.
+    """
+    with probe_lock:
+        if not force and time.time() - probe_state['checked_at'] < metrics_probe_interval:
+            return probe_state
+        try:
+            started = time.perf_counter()
+            with get_connection() as connection:
+                connection.execute("SELECT 1")
+            probe_state['db'] = time.perf_counter() - started
+            DB_RTT.set(probe_state['db'])
+        except Exception as e:
+            logger.warning(f"Datatag_5 health probe failed: {e}")
+            probe_state['db'] = None
+        try:
+            started = time.perf_counter()
+            get_redis_client().ping()
+            probe_state['redis'] = time.perf_counter() - started
+            REDIS_RTT.set(probe_state['redis'])
+        except Exception as e:
+            logger.warning(f"Redis health probe failed: {e}")
+            probe_state['redis'] = None
+        probe_state['checked_at'] = time.time()
+        return probe_state
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics: Prometheus text format. GET /healthz: 200 when the datatag_5
+    and Redis answer, 503 otherwise, with the round-trip times as JSON.
+    """
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            probe_dependencies()
+            self._reply(200, prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST)
+        elif path == '/healthz':
+            state = probe_dependencies()
+            healthy = state['db'] is not None and state['redis'] is not None
+            body = {
+                'status': 'ok' if healthy else 'unavailable',
+                'db_rtt_seconds': state['db'],
+                'redis_rtt_seconds': state['redis'],
+                'last_run': last_run_finished_at,
+            }
+            self._reply(200 if healthy else 503, json.dumps(body).encode('utf-8'), 'application/json')
+        else:
+            self._reply(404, b'not found\n', 'text/plain')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format % args)
+
+metrics_server = None
+
+def start_metrics_server(port=None):
+    """
+    Serves /metrics and /healthz from a daemon thread, once per process.
+    A port that cannot be bound is logged and the tagger keeps running.
+    """
+    global metrics_server
+    if metrics_server is not None:
+        return metrics_server
+    port = metrics_port if port is None else port
+    # Register every metric up front so /metrics lists them before their first update
+    for metric in METRICS:
+        metric.get()
+    try:
+        metrics_server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    except OSError as e:
+        logger.warning(f"Metrics server could not listen on port {port}: {e}")
+        return None
+    threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics server listening on port {metrics_server.server_address[1]}")
+    return metrics_server
+
+#-------------------------- SCHEDULER ----------------------------
+class Scheduler:
+    """
+    Periodic trigger for post_labeling_program inside the consumer, in place of
+    a cron job that cold-starts a new interpreter every few minutes.
+    Ticks sit on a fixed grid of `interval` seconds, each delayed by up to
+    `jitter` seconds so that replicas do not all reach for the lock at once.
+    Timers are pika call_later callbacks on the connection thread. A tick only
+    hands the run to the consumer's worker and returns, so ticks keep their
+    grid during long runs; the worker coalesces the ticks that arrive while
+    it is busy (and queued requests) into one catch-up run.
+    """
+    def __init__(self, interval, jitter=0.0):
+        self.interval = interval
+        self.jitter = jitter
+        self.next_due = time.monotonic()
+
+    def delay(self):
+        """
+        Seconds until the next tick, jitter included.
+        """
+        return max(self.next_due - time.monotonic(), 0.0) + random.uniform(0, self.jitter)
+
+    def advance(self):
+        """
+        Moves the grid to the first tick after now.
+        """
+        now = time.monotonic()
+        self.next_due += self.interval
+        if self.next_due <= now:
+            # The connection thread was held up past whole ticks, e.g. by a reconnect
+            self.next_due += (int((now - self.next_due) // self.interval) + 1) * self.interval
 
+    def attach(self, connection, run):
+        """
+        Arms the next tick on a pika BlockingConnection. Called again after a
+        reconnect, the grid carries over from the previous connection.
+        """
+        def tick():
             try:
-                insert_df_to_table(labeled_tweets, 'table_9')
+                run()
             except Exception as e:
-                logger.error(f"Error during insert to the table table_8: {e}", exc_info=True)
+                logger.error(f"Scheduled run failed: {e}", exc_info=True)
+            self.advance()
+            if connection.is_open:
+                connection.call_later(self.delay(), tick)
 
-            # -- removal of RT handles from tags --
+        connection.call_later(self.delay(), tick)
+
+#---------------- Consumer part ------------------------
+class TaggingConsumer:
+    """
+    Runs post_labeling_program on a worker thread, so the pika connection
+    thread keeps serving heartbeats during long LLM runs.
+    start_tagging messages that arrive while a run is in progress are
+    coalesced into one follow-up run and acked together with a single
+    multiple=True ack when it finishes. So are Scheduler ticks; more than
+    one tick behind a run means the run overran the schedule interval. With TAGGER_PROGRESS_EVENTS a progress
+    event is published to the progress queue for each chunk the run commits;
+    the done event goes to generate_top_20. Acks and publishes are handed back to
+    the connection thread with add_callback_threadsafe, the only pika call
+    that is safe from another thread.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._connection = None
+        self._channel = None
+        self._delivery_tags = []
+        self._scheduled_ticks = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name='tagging-worker', daemon=True)
+            self._thread.start()
+
+    def attach(self, connection, channel):
+        """
+        Switches to a new connection after a (re)connect. Deliveries of the
+        previous channel are forgotten, the broker redelivers them.
+        """
+        with self._condition:
+            self._connection = connection
+            self._channel = channel
+            self._delivery_tags = []
+
+    # Funkcja callback do obsługi wiadomości (connection thread)
+    def on_message(self, ch, method, properties, body):
+        if properties is not None and properties.timestamp:
+            RABBITMQ_LAG.set(max(time.time() - properties.timestamp, 0))
+        with self._condition:
+            self._delivery_tags.append(method.delivery_tag)
+            self._condition.notify()
+
+    def request_scheduled_run(self):
+        with self._condition:
+            self._scheduled_ticks += 1
+            self._condition.notify()
+
+    def publish(self, routing_key: str, body: Dict[str, Any]):
+        """
+        Publishes on the current channel, must be called on the connection thread.
+        """
+        body_json = json.dumps(body)
+        try:
+            if self._channel.basic_publish(exchange='', routing_key=routing_key, body=body_json):
+                print(f"Message published to queue: {routing_key}")
+            else:
+                print(f"NOT PUBLISHED to queue: {routing_key}")
+        except Exception as e:
+            logger.error(f"Message was not published to queue: {e}")
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._delivery_tags and not self._scheduled_ticks:
+                    self._condition.wait()
+                channel = self._channel
+                delivery_tags, self._delivery_tags = self._delivery_tags, []
+                scheduled_ticks, self._scheduled_ticks = self._scheduled_ticks, 0
+            if len(delivery_tags) > 1:
+                logger.info(f"Coalesced {len(delivery_tags)} start_tagging requests into one run")
+            if scheduled_ticks > 1:
+                logger.warning(f"Tagging run overran the schedule interval, {scheduled_ticks - 1} missed tick(s) coalesced into one catch-up run")
+
+            run_id = uuid.uuid4().hex
+            last_event = {}
+
+            def on_progress(event):
+                last_event.update(event)
+                self._call_threadsafe(lambda: self._publish_if_open(progress_queue, event))
+
+            message = None
             try:
-                rmh = function_4()
-            except Exception as e:
-                logger.warning(f"Warn: tags could not be removed due to a problem: {e}", exc_info=True)
-    except Exception as e:
-        logger.error(f"Failed to get tweets or tags: {e}")
+                written = post_labeling_program(on_progress=on_progress if progress_events_enabled else None, run_id=run_id)
+                # Queued requests are always answered, scheduled runs only when they tagged something
+                if delivery_tags or written:
+                    # "posty" keeps the message meaningful to consumers that predate the progress events
+                    message = {
+                        "posty": "gotowe",
+                        "event": "done",
+                        "run_id": run_id,
+                        "chunks": last_event.get("chunk", 0),
+                        "rows": written,
+                        "high_watermark": last_event.get("high_watermark"),
+                    }
+            except (Exception, SystemExit) as e:
+                logger.error(f"Error processing message from Q: {e}")
+            self._complete(channel, delivery_tags[-1] if delivery_tags else None, message)
 
-    # Record end time and log the elapsed time
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    logger.info(f"Main task completed in {elapsed_time:.2f} seconds.")
+    def _publish_if_open(self, routing_key, body):
+        if self._channel is not None and self._channel.is_open:
+            self.publish(routing_key, body)
 
-    # -- Disconnect from DB --
-    try:
-        close_connection()
-    except Exception as e:
-        logger.error(f"Failed close the DB connection: {e}")
-    # --------------------- Redis Lock Release ---------------------
-    try:
-        redis_client.delete('post_labeling_program_lock')
-        logger.debug("Lock released.")
-    except Exception as e:
-        logger.error(f"Failed to release lock: {e}")
-    # --------------------------------------------------------------
+    def _call_threadsafe(self, callback):
+        with self._condition:
+            connection = self._connection
+        try:
+            connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            logger.warning(f"Could not hand the run result to the connection thread: {e}")
+
+    def _complete(self, channel, last_delivery_tag, message):
+        def finish():
+            if message is not None:
+                self._publish_if_open("generate_top_20", message)
+            if last_delivery_tag is None:
+                return
+            if channel is self._channel and channel.is_open:
+                channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                logger.info(f"Finished processing request from Q")
+            else:
+                logger.warning("Channel was replaced during the run, its messages will be redelivered")
+
+        self._call_threadsafe(finish)
 
-#---------------- Consumer part ------------------------
 def start_consuming():
+    # Open the shared DB pool and Redis client once for the lifetime of the consumer
+    initialize_connection()
+    get_redis_client()
+    # Logs at startup what 'tagger.py schema install' has not created yet
+    check_tagger_schema()
+    start_metrics_server()
+
+    consumer = TaggingConsumer()
+    consumer.start()
+    scheduler = Scheduler(schedule_interval, schedule_jitter) if schedule_interval > 0 else None
     rabbit_connection = None
     while rabbit_connection is None:
         try:
             rabbit_connection = create_connection()
             channel = rabbit_connection.channel()
             #channel1 = rabbit_connection.channel()
-            channel.basic_qos(prefetch_count=1)
+            # Messages queued behind a run are delivered, so they can be coalesced into the next one
+            channel.basic_qos(prefetch_count=rabbitmq_prefetch)
 
             # Deklaracja kolejki tagowania
             channel.queue_declare(
@@ -917,35 +3788,16 @@ def start_consuming():
             channel.queue_declare(
                 queue='generate_top_20'
             )
+            if progress_events_enabled:
+                channel.queue_declare(queue=progress_queue)
             channel.confirm_delivery()
-
-            def publish(routing_key: str, body: Dict[str, Any]):
-                body_json = json.dumps(body)
-
-                #ensure_connection()  # Sprawdzenie i ewentualne ponowne nawiązanie połączenia
-                try:
-                    if channel.basic_publish(exchange='', routing_key=routing_key, body=body_json):
-                        print(f"Message published to queue: {routing_key}")
-                    else:
-                        print(f"NOT PUBLISHED to queue: {routing_key}")
-                except Exception as e:
-                    logger.error(f"Message was not published to queue: {e}")
-                    ensure_connection()  # Próba ponownego połączenia w razie błędu
-
-            # Funkcja callback do obsługi wiadomości
-            def callback(ch, method, properties, body):
-                try:
-                    post_labeling_program()
-                    message = {"posty": "gotowe"}
-                    publish("generate_top_20", message)
-                    logger.info(f"Finished processing request from Q")
-                    channel.basic_ack(delivery_tag=method.delivery_tag)
-                except Exception as e:
-                    logger.error(f"Error processing message from Q: {e}")
-                    channel.basic_ack(delivery_tag=method.delivery_tag)
+            consumer.attach(rabbit_connection, channel)
 
             # Konfiguracja konsumowania wiadomości
-            channel.basic_consume(queue='start_tagging', on_message_callback=callback, auto_ack=False)
+            channel.basic_consume(queue='start_tagging', on_message_callback=consumer.on_message, auto_ack=False)
+            if scheduler is not None:
+                scheduler.attach(rabbit_connection, consumer.request_scheduled_run)
+                logger.info(f"Scheduled runs every {schedule_interval:.0f}s (+ up to {schedule_jitter:.0f}s jitter)")
 
             logger.info('STARTED CONSUMING')
 
@@ -957,5 +3809,109 @@ def start_consuming():
             rabbit_connection = None
             time.sleep(5)
 
+def consume_command(args):
+    """
+    Long-running entry point: tagger.py [consume]
+    """
+    start_consuming()
+
+def run_once_command(args):
+    """
+    Single tagging run for cron: tagger.py run-once
+    """
+    initialize_connection()
+    post_labeling_program()
+
+def crontab_command(args):
+    """
+    Adds or removes the cron.jobs entries in the current user's crontab:
+    tagger.py crontab add|remove
+    Only needed with TAGGER_SCHEDULE_INTERVAL=0, the consumer schedules runs itself otherwise.
+    """
+    action = args[0] if args else 'add'
+    if action not in ('add', 'remove'):
+        logger.error(f"Unknown crontab command: {action}")
+        sys.exit(2)
+    jobs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cron.jobs')
+    try:
+        with open(jobs_path) as f:
+            jobs = [line.rstrip('\n') for line in f if line.strip() and not line.lstrip().startswith('#')]
+        listed = subprocess.run(['crontab', '-l'], capture_output=True, text=True)
+        current = listed.stdout.splitlines() if listed.returncode == 0 else []
+        if action == 'add':
+            lines = current + [job for job in jobs if job not in current]
+        else:
+            lines = [line for line in current if line not in jobs]
+        if lines == current:
+            logger.info("Crontab already up to date.")
+            return
+        subprocess.run(['crontab', '-'], input='\n'.join(lines) + '\n', text=True, check=True)
+        logger.info(f"Crontab updated from {jobs_path} ({action}).")
+    except Exception as e:
+        logger.error(f"Failed to update the crontab: {e}")
+        sys.exit(1)
+
+def schema_command(args):
+    """
+    Maintenance entry point: tagger.py schema install
+    """
+    initialize_connection()
+    action = args[0] if args else 'install'
+    if action == 'install':
+        install_tagger_schema()
+    else:
+        logger.error(f"Unknown schema command: {action}")
+        sys.exit(2)
+
+def rollup_command(args):
+    """
+    Maintenance entry point: tagger.py rollup install|backfill|prune|check [YYYY-MM-DD HH:MM:SS]
+    """
+    initialize_connection()
+    action = args[0] if args else 'check'
+    if action == 'install':
+        install_tag_rollup()
+    elif action == 'backfill':
+        backfill_tag_rollup()
+    elif action == 'prune':
+        prune_tag_rollup()
+    elif action == 'check':
+        if not check_tag_rollup(' '.join(args[1:]) or None):
+            sys.exit(1)
+    else:
+        logger.error(f"Unknown rollup command: {action}")
+        sys.exit(2)
+
+def backtest_command(args):
+    """
+    Offline scoring entry point, writes CSV to stdout:
+    tagger.py backtest function_3|function_1 'START' 'END' [STEP_HOURS] [TOP_K]
+    """
+    if len(args) < 3 or args[0] not in TREND_WINDOWS:
+        logger.error("Usage: tagger.py backtest function_3|function_1 'YYYY-MM-DD HH:MM:SS' 'YYYY-MM-DD HH:MM:SS' [STEP_HOURS] [TOP_K]")
+        sys.exit(2)
+    initialize_connection()
+    step_hours = float(args[3]) if len(args) > 3 else 1
+    top_k = int(args[4]) if len(args) > 4 else 20
+    df = backtest_trends(args[0], args[1], args[2], step_hours, top_k)
+    df.to_csv(sys.stdout, index=False)
+
+COMMANDS = {
+    'consume': consume_command,
+    'run-once': run_once_command,
+    'crontab': crontab_command,
+    'schema': schema_command,
+    'rollup': rollup_command,
+    'backtest': backtest_command,
+}
+
 if __name__ == "__main__":
-    start_consuming()
\ No newline at end of file
+    command = sys.argv[1] if len(sys.argv) > 1 else 'consume'
+    if command not in COMMANDS:
+        logger.error(f"Unknown command: {command}, expected one of: {', '.join(COMMANDS)}")
+        sys.exit(2)
+    try:
+        COMMANDS[command](sys.argv[2:])
+    finally:
+        if db_pool is not None:
+            close_connection()
\ No newline at end of file
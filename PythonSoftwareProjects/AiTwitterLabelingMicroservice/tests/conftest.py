@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tagger
+
+# Throwaway Postgres database for the tests that write, e.g. "host=localhost dbname=tagger_test user=postgres"
+TEST_DSN = os.getenv('TAGGER_TEST_DSN')
+
+
+@pytest.fixture(scope='session')
+def datatag_5():
+    """
+    Opens the tagger's connection pool on TAGGER_TEST_DSN, skips the test without it.
+    """
+    if not TEST_DSN:
+        pytest.skip("TAGGER_TEST_DSN is not set")
+    from psycopg.conninfo import conninfo_to_dict
+    settings = conninfo_to_dict(TEST_DSN)
+    env = {
+        'POSTGRESQL_DB_NAME': settings.get('dbname'),
+        'POSTGRESQL_USER': settings.get('user'),
+        'POSTGRESQL_PASSWORD': settings.get('password'),
+        'POSTGRESQL_HOST': settings.get('host'),
+        'POSTGRESQL_PORT': settings.get('port'),
+    }
+    previous = {key: os.environ.get(key) for key in env}
+    os.environ.update({key: value for key, value in env.items() if value is not None})
+    tagger.initialize_connection()
+    yield
+    tagger.close_connection()
+    for key, value in previous.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
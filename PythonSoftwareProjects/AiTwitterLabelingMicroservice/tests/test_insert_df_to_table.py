@@ -0,0 +1,84 @@
+"""
+insert_df_to_table writes small frames with executemany and large ones with
+COPY + INSERT ... SELECT (copy_upsert). Both paths must leave the same rows.
+
+Needs a throwaway Postgres database: TAGGER_TEST_DSN="host=... dbname=... user=..."
+The tables table_1, table_2 and table_5 are dropped and recreated in it.
+"""
+import pandas as pd
+import pytest
+
+import tagger
+
+pytestmark = pytest.mark.usefixtures('datatag_5')
+
+TABLES_DDL = {
+    'table_1': "CREATE TABLE table_1 (column_1 text PRIMARY KEY, column_2 text, column_3 integer, column_4 text)",
+    'table_2': "CREATE TABLE table_2 (column_5 text PRIMARY KEY, column_6 text, column_7 text)",
+    'table_5': "CREATE TABLE table_5 (column_8 text, column_10 text, PRIMARY KEY (column_8, column_10))",
+}
+
+
+def reset_table(table_name, rows=()):
+    with tagger.get_connection() as connection:
+        connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+        connection.execute(TABLES_DDL[table_name])
+        for row in rows:
+            placeholders = ', '.join(['%s'] * len(row))
+            connection.execute(f"INSERT INTO {table_name} VALUES ({placeholders})", row)
+    tagger.invalidate_table_writers(table_name)
+
+
+def table_rows(table_name):
+    with tagger.get_connection() as connection:
+        return sorted(connection.execute(f"SELECT * FROM {table_name}").fetchall(), key=repr)
+
+
+def write_both_ways(monkeypatch, table_name, existing, df):
+    """
+    Returns the table contents after writing df with executemany and with COPY,
+    each time starting from the same existing rows.
+    """
+    results = []
+    for threshold in (len(df) + 1, 1):
+        reset_table(table_name, existing)
+        monkeypatch.setattr(tagger, 'bulk_insert_threshold', threshold)
+        tagger.insert_df_to_table(df.copy(), table_name)
+        results.append(table_rows(table_name))
+    return results
+
+
+def test_do_update_with_duplicate_keys(monkeypatch):
+    df = pd.DataFrame({
+        'column_1': ['a', 'b', 'a', 'c', 'b'],
+        'column_2': ['a1', 'b1', 'a2', 'c1', 'b2'],
+        'column_3': [1, 2, 3, 4, 5],
+        'column_4': ['x', None, 'y', 'z', None],
+    })
+    executemany_rows, copy_rows = write_both_ways(monkeypatch, 'table_1', [('a', 'old', 0, 'old')], df)
+    assert copy_rows == executemany_rows
+    # The last row of a repeated key wins
+    assert executemany_rows == [('a', 'a2', 3, 'y'), ('b', 'b2', 5, None), ('c', 'c1', 4, 'z')]
+
+
+def test_coalesce_special_handling(monkeypatch):
+    df = pd.DataFrame({
+        'column_5': ['k1', 'k2', 'k3'],
+        'column_6': [None, 'new2', None],
+        'column_7': ['v1', 'v2', 'v3'],
+    })
+    existing = [('k1', 'kept1', 'old1'), ('k2', 'old2', 'old2')]
+    executemany_rows, copy_rows = write_both_ways(monkeypatch, 'table_2', existing, df)
+    assert copy_rows == executemany_rows
+    # A NULL column_6 keeps the stored value
+    assert executemany_rows == [('k1', 'kept1', 'v1'), ('k2', 'new2', 'v2'), ('k3', None, 'v3')]
+
+
+def test_do_nothing_on_conflict(monkeypatch):
+    df = pd.DataFrame({
+        'column_8': ['p1', 'p2', 'p2', 'p3'],
+        'column_10': ['t1', 't2', 't2', 't3'],
+    })
+    executemany_rows, copy_rows = write_both_ways(monkeypatch, 'table_5', [('p1', 't1')], df)
+    assert copy_rows == executemany_rows
+    assert executemany_rows == [('p1', 't1'), ('p2', 't2'), ('p3', 't3')]
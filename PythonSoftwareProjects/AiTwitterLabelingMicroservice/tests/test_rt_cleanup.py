@@ -0,0 +1,65 @@
+"""
+function_4 against a throwaway database (TAGGER_TEST_DSN), table_9 is dropped
+and recreated in it. The Redis watermark is kept in a dict.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import tagger
+
+pytestmark = pytest.mark.usefixtures('datatag_5')
+
+
+@pytest.fixture(autouse=True)
+def table_9(monkeypatch):
+    with tagger.get_connection() as connection:
+        connection.execute("DROP TABLE IF EXISTS table_9 CASCADE")
+        connection.execute("CREATE TABLE table_9 (id bigint PRIMARY KEY, content text, column_44 timestamp, column_50 text, tags text[])")
+    tagger.install_tagger_schema()
+    monkeypatch.setattr(tagger, 'tweet_tags_queries', {})
+    stored = {}
+    monkeypatch.setattr(tagger, 'get_rt_cleanup_watermark', lambda: stored.get('watermark'))
+    monkeypatch.setattr(tagger, 'set_rt_cleanup_watermark', lambda watermark: stored.update(watermark=watermark))
+    return stored
+
+
+def insert_retweet(id, created):
+    with tagger.get_connection() as connection:
+        connection.execute("INSERT INTO table_9 (id, content, column_44) VALUES (%s, %s, %s)", (id, f"RT @Author{id}: hello $btc", created))
+
+
+def tags_of(id):
+    with tagger.get_connection() as connection:
+        return connection.execute("SELECT tags FROM table_9 WHERE id = %s", (id,)).fetchone()[0]
+
+
+def test_old_tweet_tagged_after_the_last_pass_is_cleaned(table_9):
+    insert_retweet(1, datetime.now() - timedelta(days=3))
+    tagger.function_4()
+    assert table_9['watermark'] is not None
+
+    # Created long before the watermark, tagged after it
+    tagger.write_tweet_tags([tagger.TweetRecord(id=1, content=None, column_44=None, column_50=None, tags=['@author1', '$btc'])])
+    assert int(tagger.function_4()['removed'].iloc[0]) == 1
+    assert tags_of(1) == ['$btc']
+
+
+def test_rows_tagged_before_the_overlap_are_not_scanned(table_9, monkeypatch):
+    insert_retweet(1, datetime.now())
+    tagger.write_tweet_tags([tagger.TweetRecord(id=1, content=None, column_44=None, column_50=None, tags=['@author1'])])
+    monkeypatch.setattr(tagger, 'rt_cleanup_overlap_seconds', 0)
+    table_9['watermark'] = datetime.now().astimezone() + timedelta(minutes=1)
+    assert int(tagger.function_4()['removed'].iloc[0]) == 0
+    assert tags_of(1) == ['@author1']
+
+
+def test_falls_back_to_the_creation_window_without_tagged_at(monkeypatch):
+    with tagger.get_connection() as connection:
+        connection.execute("ALTER TABLE table_9 DROP COLUMN tagged_at")
+    monkeypatch.setattr(tagger, 'tagger_schema', None)
+    insert_retweet(1, datetime.now() - timedelta(hours=1))
+    insert_retweet(2, datetime.now() - timedelta(days=3))
+    tagger.write_tweet_tags([tagger.TweetRecord(id=id, content=None, column_44=None, column_50=None, tags=[f'@author{id}']) for id in (1, 2)])
+    assert int(tagger.function_4()['removed'].iloc[0]) == 1
+    assert tags_of(1) == [] and tags_of(2) == ['@author2']
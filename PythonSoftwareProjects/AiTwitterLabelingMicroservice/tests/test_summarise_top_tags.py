@@ -0,0 +1,60 @@
+"""
+summarise_top_tags with request_summary replaced and the summary cache kept in a dict.
+"""
+import pandas as pd
+import pytest
+
+import tagger
+
+
+class DictSummaryCache(tagger.SummaryCache):
+    def __init__(self):
+        super().__init__(redis_client=None)
+        self.entries = {}
+
+    def get_many(self, tags):
+        return [self.entries.get(tag) for tag in tags]
+
+    def set_many(self, entries_by_tag):
+        for tag, (post_hashes, summary) in entries_by_tag.items():
+            self.entries[tag] = {'posts': sorted(post_hashes), 'summary': summary}
+
+
+def top_tags(posts):
+    return pd.DataFrame({
+        'tag': ['$btc'],
+        'posts': [posts],
+        'users': [[f"user{i}" for i in range(len(posts))]],
+        'post_dates': [['2024-11-15 12:00:00'] * len(posts)],
+    })
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError("LLM unavailable")
+
+
+def test_failed_delta_keeps_the_cached_summary(monkeypatch):
+    cache = DictSummaryCache()
+    old_posts = ['btc up', 'btc flat', 'btc down']
+    cache.set_many({'$btc': ({tagger.post_hash(post) for post in old_posts}, 'cached summary')})
+    before = dict(cache.entries['$btc'])
+
+    monkeypatch.setattr(tagger, 'request_summary', fail)
+    summarised = tagger.summarise_top_tags(top_tags(old_posts + ['btc new high']), max_in_flight=2, cache=cache)
+
+    assert summarised['summary'].tolist() == ['cached summary']
+    # Left as it was, so the next run retries the update
+    assert cache.entries['$btc'] == before
+
+
+def test_delta_updates_the_cached_summary(monkeypatch):
+    cache = DictSummaryCache()
+    old_posts = ['btc up', 'btc flat', 'btc down']
+    cache.set_many({'$btc': ({tagger.post_hash(post) for post in old_posts}, 'cached summary')})
+
+    monkeypatch.setattr(tagger, 'request_summary', lambda *args, **kwargs: 'updated summary')
+    summarised = tagger.summarise_top_tags(top_tags(old_posts + ['btc new high']), max_in_flight=2, cache=cache)
+
+    assert summarised['summary'].tolist() == ['updated summary']
+    assert cache.entries['$btc']['summary'] == 'updated summary'
+    assert len(cache.entries['$btc']['posts']) == 4
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+import tagger
+
+
+@pytest.fixture
+def vocabulary():
+    vocabulary = tagger.TagVocabulary(redis_client=None, size=100, min_count=3, refresh_seconds=3600)
+    for tag, count in {
+        '$coin1': 50, '#topic1': 40, '@user1': 30, '$pnut': 20,
+        '#bitcoin': 25, 'bitcoin': 10, 'ethereum': 12, 'rarely': 1,
+    }.items():
+        vocabulary._index(tag, count)
+    # The index is filled by hand, keep canonicalize() away from Redis
+    vocabulary.loaded_at = time.time()
+    return vocabulary
+
+
+def test_new_tickers_and_hashtags_are_kept(vocabulary):
+    assert vocabulary.canonicalize(['$coin2', '#topic7', '$coin12']) == ['$coin2', '#topic7', '$coin12']
+
+
+@pytest.mark.parametrize('tag', ['$coin2', '#topic7', '@user2', '#bitcoim', '$bitcoim', 'coin2', 'topic12'])
+def test_sigil_and_digit_tags_are_not_fuzzy_matched(vocabulary, tag):
+    assert vocabulary._resolve(tag) == tag
+
+
+def test_same_key_maps_to_most_used_sigil_compatible_tag(vocabulary):
+    assert vocabulary._resolve('PNUT') == '$pnut'
+    assert vocabulary._resolve('$PNUT') == '$pnut'
+    assert vocabulary._resolve('#Bitcoin') == '#bitcoin'
+    # A tag with a sigil never maps to another sigil
+    assert vocabulary._resolve('@pnut') == '@pnut'
+
+
+def test_plain_words_fuzzy_match_plain_words_only(vocabulary):
+    assert vocabulary._resolve('etherium') == 'ethereum'
+    # '#bitcoin' is more used, but a plain word is only mapped to a plain word
+    assert vocabulary._resolve('bitcoim') == 'bitcoin'
+
+
+def test_rare_and_distant_tags_are_kept(vocabulary):
+    # Below min_count, so never a target
+    assert vocabulary._resolve('rarely') == 'rarely'
+    assert vocabulary._resolve('rarelyy') == 'rarelyy'
+    # More than one edit away for a key shorter than 9 characters
+    assert vocabulary._resolve('ethxxeum') == 'ethxxeum'
+    # Too short for fuzzy matching
+    assert vocabulary._resolve('pnat') == 'pnat'
@@ -0,0 +1,69 @@
+"""
+write_tweet_tags against a throwaway database (TAGGER_TEST_DSN), table_9 and
+tagger_fence are dropped and recreated in it.
+"""
+from datetime import datetime
+
+import pytest
+
+import tagger
+
+pytestmark = pytest.mark.usefixtures('datatag_5')
+
+LEASE = 'post_labeling_program_lock'
+
+
+@pytest.fixture(autouse=True)
+def table_9(monkeypatch):
+    with tagger.get_connection() as connection:
+        connection.execute("DROP TABLE IF EXISTS table_9 CASCADE")
+        connection.execute("DROP TABLE IF EXISTS tagger_fence")
+        connection.execute("CREATE TABLE table_9 (id bigint PRIMARY KEY, content text, column_44 timestamp, column_50 text, tags text[])")
+        connection.execute("INSERT INTO table_9 (id, content, column_44) SELECT i, 'tweet ' || i, now() FROM generate_series(1, 3) AS i")
+    tagger.install_tagger_schema()
+    monkeypatch.setattr(tagger, 'tweet_tags_queries', {})
+    tagger.invalidate_table_writers()
+
+
+def tweet(id, tags):
+    return tagger.TweetRecord(id=id, content=f"tweet {id}", column_44=datetime.now(), column_50=None, tags=tags)
+
+
+def stored_tags():
+    with tagger.get_connection() as connection:
+        return dict(connection.execute("SELECT id, tags FROM table_9 ORDER BY id").fetchall())
+
+
+def test_writes_tags_and_returns_written_ids():
+    written = tagger.write_tweet_tags([tweet(1, ['#a', '$b']), tweet(2, ['@c "quoted"']), tweet(99, ['#missing'])])
+    assert written == {1, 2}
+    assert stored_tags() == {1: ['#a', '$b'], 2: ['@c "quoted"'], 3: None}
+
+
+def test_stale_fencing_token_is_refused():
+    assert tagger.write_tweet_tags([tweet(1, ['#new'])], fence=(LEASE, 7)) == {1}
+    # The holder with token 7 keeps writing
+    assert tagger.write_tweet_tags([tweet(2, ['#new'])], fence=(LEASE, 7)) == {2}
+    # A holder whose lease expired before token 7 was handed out
+    with pytest.raises(tagger.StaleLeaseError):
+        tagger.write_tweet_tags([tweet(1, ['#stale']), tweet(3, ['#stale'])], fence=(LEASE, 6))
+    assert stored_tags() == {1: ['#new'], 2: ['#new'], 3: None}
+
+
+def test_claimed_write_skips_rows_reclaimed_by_another_worker():
+    with tagger.get_connection() as connection:
+        connection.execute("UPDATE table_9 SET claimed_by = CASE WHEN id = 2 THEN 'other' ELSE 'me' END, claimed_at = now()")
+    written = tagger.write_tweet_tags([tweet(1, ['#mine']), tweet(2, ['#mine'])], worker='me')
+    assert written == {1}
+    assert stored_tags() == {1: ['#mine'], 2: None, 3: None}
+
+
+def test_writes_without_the_installed_schema(monkeypatch):
+    with tagger.get_connection() as connection:
+        connection.execute("DROP TABLE tagger_fence")
+        connection.execute("ALTER TABLE table_9 DROP COLUMN tagged_at")
+    monkeypatch.setattr(tagger, 'tagger_schema', None)
+    assert tagger.check_tagger_schema() == {'fence': False, 'tagged_at': False}
+    # The fence is skipped instead of failing every write
+    assert tagger.write_tweet_tags([tweet(1, ['#a'])], fence=(LEASE, 1)) == {1}
+    assert stored_tags() == {1: ['#a'], 2: None, 3: None}